@@ -0,0 +1,267 @@
+#
+# Audio capture decoupled from the video recording. The audio of each footage file is captured by
+# a separate lightweight FFmpeg into an MP3 sidecar file, so that an ALSA error only restarts the
+# audio capture and never stops the video. When the footage file is closed, the sidecar is muxed
+# into it by stream copy in the background, and removed.
+#
+# The capture is restarted after a backoff if it fails. The MP3 stream is appended to the sidecar,
+# and the gap while it was down is filled with silence, so that the audio stays in sync with the
+# video after the restart.
+#
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+import ivr
+import pressure
+import remux
+import telemetry
+
+# Extension of the audio sidecar file captured along with the footage file.
+AUDIO_FILE_EXT = "mp3"
+
+# Bitrate of the captured audio. MP3 is the codec that FFmpeg writes to AVI by default.
+AUDIO_BITRATE = "64k"
+
+# Band of the voice and the engine sounds to be kept by the noise reduction. It cuts the
+# low-frequency rumble of the road and the high-frequency hiss of the microphone at little CPU.
+NOISE_REDUCTION_FILTERS = ["highpass=f=200", "lowpass=f=4000"]
+
+# Seconds to wait before the capture is restarted, doubled on each consecutive failure.
+MIN_RESTART_SECONDS = 1
+MAX_RESTART_SECONDS = 30
+
+# Seconds of a capture after which it's considered to have been working, and the backoff is reset.
+STABLE_SECONDS = 60
+
+# Gap shorter than this isn't filled with silence.
+MIN_GAP_SECONDS = 0.05
+
+# Seconds by which the muxed footage may be shorter than the original, such as by the rounding of
+# the last frame. The muxed one isn't used if it's any shorter, since the video would be lost.
+MUX_DURATION_TOLERANCE = 1.0
+
+# FFmpeg subprocesses muxing the audio into the footage files, and the threads running them.
+mux_processes = set()
+mux_threads = []
+mux_lock = threading.Lock()
+
+
+# A thread that captures the audio of the footage being recorded into the sidecar file until
+# stopped, restarting FFmpeg if it fails.
+class AudioRecorder(threading.Thread):
+    def __init__(self, dev_audio, sampling_rate, noise_reduction, footage_file, start):
+        super().__init__(daemon=True)
+        self.dev_audio = dev_audio
+        self.sampling_rate = sampling_rate
+        self.noise_reduction = noise_reduction
+        self.file = ivr.footage_sidecar_file(footage_file, AUDIO_FILE_EXT)
+        self.start_time = start.timestamp()
+        self.stopped = threading.Event()
+        self.process = None
+        self.lock = threading.Lock()
+
+    # Build the FFmpeg command that writes the MP3 stream to the standard output. The gap is
+    # filled with silence at the beginning of the stream. The stream has no headers, so that the
+    # streams of the restarts can be appended to the same file.
+    def command(self, gap):
+        filters = []
+        if gap >= MIN_GAP_SECONDS:
+            filters.append("adelay={}:all=1".format(int(gap * 1000)))
+        if self.noise_reduction:
+            filters.extend(NOISE_REDUCTION_FILTERS)
+        command = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+        command.extend(["-f", "alsa", "-thread_queue_size", "8192"])
+        if self.sampling_rate is not None:
+            command.extend(["-ar", self.sampling_rate])
+        command.extend(["-i", "hw:{}".format(self.dev_audio)])
+        if len(filters) != 0:
+            command.extend(["-af", ",".join(filters)])
+        command.extend(["-c:a", "libmp3lame", "-b:a", AUDIO_BITRATE])
+        command.extend(["-write_xing", "0", "-id3v2_version", "0", "-write_id3v1", "0"])
+        command.extend(["-f", "mp3", "pipe:1"])
+        return command
+
+    def run(self):
+        backoff = MIN_RESTART_SECONDS
+        written_until = self.start_time
+        while not self.stopped.is_set():
+            gap = max(0, time.time() - written_until)
+            started = time.monotonic()
+            with open(self.file, mode="ab") as f:
+                with self.lock:
+                    if self.stopped.is_set():
+                        break
+                    self.process = subprocess.Popen(
+                        self.command(gap),
+                        stdin=subprocess.DEVNULL,
+                        stdout=f,
+                        stderr=subprocess.PIPE,
+                    )
+                ivr.log(
+                    "start audio capture[{}]: {}".format(
+                        self.process.pid, " ".join(self.process.args)
+                    )
+                )
+                line = self.process.stderr.readline()
+                while line:
+                    ivr.log("FFmpeg[audio]: {}".format(line.decode("utf-8").strip()))
+                    line = self.process.stderr.readline()
+                ret = self.process.wait()
+            # the sidecar is regarded as having caught up with the time it stopped
+            written_until = time.time()
+            if self.stopped.is_set():
+                break
+
+            if time.monotonic() - started >= STABLE_SECONDS:
+                backoff = MIN_RESTART_SECONDS
+            ivr.log(
+                "WARN: audio capture has been terminated with: {}; restart after {} sec".format(
+                    ret, backoff
+                )
+            )
+            self.stopped.wait(backoff)
+            backoff = min(MAX_RESTART_SECONDS, backoff * 2)
+
+    # Stop the capture. The sidecar contains the audio until now.
+    def stop(self):
+        with self.lock:
+            self.stopped.set()
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+        self.join(10)
+
+
+# Refer to the footage file that shares the base name with the file, which may have been remuxed
+# into MP4 since it was recorded, or None if it has been removed.
+def current_footage_file(file):
+    for ext in ["avi", remux.REMUX_FILE_EXT]:
+        footage = ivr.footage_sidecar_file(file, ext)
+        if os.path.isfile(footage):
+            return footage
+    return None
+
+
+# Mux the audio sidecar file into the footage file by stream copy, and replace the footage with it.
+# The whole video is kept even if the audio ends early, such as when the capture has failed. The
+# modification time is kept so that the order of deletion doesn't change. Returns False if it fails,
+# in which case the sidecar is left to be muxed on the next start.
+def mux(footage_file):
+    audio_file = ivr.footage_sidecar_file(footage_file, AUDIO_FILE_EXT)
+    part = ivr.footage_sidecar_file(footage_file, remux.PARTIAL_FILE_EXT)
+    if not os.path.isfile(audio_file):
+        return True
+    if os.path.getsize(audio_file) == 0:
+        os.remove(audio_file)
+        return True
+    if not remux.lock_partial_file(part):
+        # the footage is being converted by another job
+        return False
+
+    # the footage may have been remuxed into MP4 before the lock
+    footage_file = current_footage_file(footage_file)
+    if footage_file is None:
+        os.remove(part)
+        return True
+    ext = ivr.file_extension(footage_file)[1:]
+
+    command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+    command.extend(["-i", footage_file, "-f", "mp3", "-i", audio_file])
+    command.extend(["-map", "0:v", "-map", "1:a", "-c", "copy"])
+    if ext == remux.REMUX_FILE_EXT:
+        command.extend(["-movflags", remux.MP4_MOVFLAGS])
+    command.extend(["-f", ext, part])
+    name = os.path.basename(footage_file)
+    returncode, stderr = pressure.run_low_priority(
+        command,
+        "muxing the audio into {}".format(name),
+        on_start=lambda proc: add_mux_process(proc),
+    )
+
+    try:
+        if returncode != 0:
+            ivr.log(
+                "ERROR: failed to mux the audio into {}: {}".format(name, stderr.strip())
+            )
+            return False
+        try:
+            stat = os.stat(footage_file)
+        except FileNotFoundError:
+            # the footage has been removed by ensure_storage_space() while muxing
+            return True
+        original = remux.media_duration(footage_file)
+        muxed = remux.media_duration(part)
+        if original is None or muxed is None or muxed < original - MUX_DURATION_TOLERANCE:
+            ivr.log(
+                "ERROR: the footage muxed with the audio is shorter than {}: {} < {} sec".format(
+                    name, muxed, original
+                )
+            )
+            return False
+        os.utime(part, (stat.st_atime, stat.st_mtime))
+        os.rename(part, footage_file)
+        os.remove(audio_file)
+        ivr.log(
+            "audio muxed: {} ({}B)".format(
+                footage_file, ivr.with_aux_unit(os.path.getsize(footage_file))
+            )
+        )
+        return True
+    finally:
+        if os.path.isfile(part):
+            os.remove(part)
+
+
+def add_mux_process(proc):
+    with mux_lock:
+        mux_processes.add(proc)
+
+
+# Mux the audio into the footage files in a background thread, one after another at low priority.
+def mux_in_background(footage_files):
+    def run():
+        for file in footage_files:
+            try:
+                mux(file)
+            except Exception as e:
+                ivr.log("ERROR: failed to mux the audio into {}: {}".format(file, e))
+        with mux_lock:
+            for proc in [p for p in mux_processes if p.poll() is not None]:
+                mux_processes.discard(proc)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    with mux_lock:
+        mux_threads[:] = [t for t in mux_threads if t.is_alive()] + [thread]
+
+
+# Refer to the footage files whose audio sidecar hasn't been muxed, such as by a power cut, except
+# for the ones being recorded.
+def unmuxed_footage_files(dir):
+    recording = telemetry.recording_files()
+    files = []
+    for f in os.listdir(dir):
+        if not re.fullmatch(ivr.FOOTAGE_FILE_PATTERN, f):
+            continue
+        if ivr.file_extension(f) != "." + AUDIO_FILE_EXT:
+            continue
+        footage = current_footage_file(os.path.join(dir, f))
+        if footage is not None and os.path.basename(footage) not in recording:
+            files.append(footage)
+    return sorted(files)
+
+
+# Terminate the running muxes, and wait for them to clean up. The sidecars are left to be muxed on
+# the next start.
+def stop_muxing():
+    with mux_lock:
+        for proc in mux_processes:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGCONT)
+                proc.terminate()
+        threads = list(mux_threads)
+    for thread in threads:
+        thread.join(5)
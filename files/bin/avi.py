@@ -0,0 +1,237 @@
+#
+# Minimal reader for the RIFF/AVI structure of the footage written by FFmpeg. This reads only chunk
+# headers, so it's possible to find keyframes without decoding or scanning the whole video data.
+#
+import os
+import re
+import struct
+import subprocess
+
+CHUNK_HEADER = struct.Struct("<4sI")
+INDEX_ENTRY = struct.Struct("<4sIII")
+
+AVIIF_KEYFRAME = 0x10
+
+# Number of bytes at the beginning of a video chunk used to detect a keyframe.
+PEEK_SIZE = 64
+
+# Video codecs whose every frame can be decoded independently.
+H264_CODECS = [b"H264", b"h264", b"X264", b"x264", b"avc1", b"AVC1"]
+
+
+# Returns True if the chunk ID is of stream data such as 00dc or 01wb.
+def is_stream_chunk(fourcc):
+    return fourcc[:2].isdigit() and fourcc[2:] in (b"dc", b"db", b"wb", b"tx")
+
+
+# Returns True if the beginning of H.264 frame contains IDR picture or SPS.
+def is_h264_keyframe(data):
+    i = data.find(b"\x00\x00\x01")
+    while i >= 0 and i + 3 < len(data):
+        if data[i + 3] & 0x1F in (5, 7):
+            return True
+        i = data.find(b"\x00\x00\x01", i + 3)
+    return False
+
+
+# Keyframe index of an AVI file. The index can be updated incrementally while the file is being
+# written, and is used to cut out a part of the footage at keyframes by stream copy.
+class Index:
+    def __init__(self, file):
+        self.file = file
+        self.identity = None
+        self.reset()
+
+    def reset(self):
+        self.header = None  # bytes from the beginning of file to the first stream chunk
+        self.movi = 0  # offset of the movi LIST in the first RIFF
+        self.video = None  # chunk ID prefix of the video stream such as b"00"
+        self.all_keyframes = False
+        self.scale = 1
+        self.rate = 1
+        self.frames = 0  # number of video frames indexed
+        self.keyframes = []  # list of (frame number, offset of the chunk)
+        self.position = 0  # offset of the next chunk to be scanned
+
+    # Duration of the indexed part in seconds.
+    def duration(self):
+        return self.frames * self.scale / self.rate
+
+    # Time of the specified frame number in seconds.
+    def frame_time(self, frame):
+        return frame * self.scale / self.rate
+
+    # Read new chunks written after the last update.
+    # Returns False if the file isn't an AVI or its header hasn't been written yet.
+    def update(self):
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return False
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self.identity or stat.st_size < self.position:
+            self.identity = identity
+            self.reset()
+        with open(self.file, mode="rb") as f:
+            if self.header is None:
+                if not self.read_header(f):
+                    return False
+                self.read_legacy_index(f, stat.st_size)
+            self.scan(f, stat.st_size)
+        return True
+
+    def read_header(self, f):
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:] != b"AVI ":
+            return False
+        position = 12
+        while True:
+            f.seek(position)
+            head = f.read(12)
+            if len(head) < 12:
+                return False
+            fourcc, length = CHUNK_HEADER.unpack_from(head)
+            if fourcc == b"LIST" and head[8:] == b"hdrl":
+                self.read_stream_header(f.read(length - 4))
+            elif fourcc == b"LIST" and head[8:] == b"movi":
+                if self.video is None:
+                    return False
+                self.movi = position
+                self.position = position + 12
+                f.seek(0)
+                self.header = f.read(self.position)
+                return True
+            position += 8 + length + (length & 1)
+
+    def read_stream_header(self, hdrl):
+        streams = [m.start() for m in re.finditer(b"strh", hdrl)]
+        for i, offset in enumerate(streams):
+            strh = hdrl[offset + 8 : offset + 8 + 28]
+            if len(strh) < 28 or strh[:4] != b"vids":
+                continue
+            self.video = b"%02d" % i
+            self.scale, self.rate = struct.unpack_from("<II", strh, 20)
+            if self.scale == 0 or self.rate == 0:
+                self.scale, self.rate = 1, 30
+            strf = hdrl.find(b"strf", offset)
+            codec = hdrl[strf + 8 + 16 : strf + 8 + 20] if strf >= 0 else b""
+            self.all_keyframes = codec not in H264_CODECS
+            return
+
+    # Load the idx1 of the file that has been closed normally. This avoids scanning the whole file.
+    def read_legacy_index(self, f, size):
+        f.seek(self.movi)
+        fourcc, length = CHUNK_HEADER.unpack(f.read(8))
+        idx1 = self.movi + 8 + length + (length & 1)
+        if length == 0 or idx1 + 8 > size:
+            return
+        f.seek(idx1)
+        fourcc, length = CHUNK_HEADER.unpack(f.read(8))
+        if fourcc != b"idx1":
+            return
+        data = f.read(length)
+        base = self.movi + 8
+        for ckid, flags, offset, _ in INDEX_ENTRY.iter_unpack(
+            data[: len(data) // 16 * 16]
+        ):
+            if ckid[:2] == self.video and ckid[2:] in (b"dc", b"db"):
+                if flags & AVIIF_KEYFRAME:
+                    self.keyframes.append((self.frames, base + offset))
+                self.frames += 1
+
+        # continue to scan the extended RIFF (AVIX) of OpenDML, if any
+        f.seek(4)
+        self.position = 8 + struct.unpack("<I", f.read(4))[0]
+
+    def scan(self, f, size):
+        position = self.position
+        while position + 8 <= size:
+            f.seek(position)
+            head = f.read(8 + PEEK_SIZE)
+            fourcc, length = CHUNK_HEADER.unpack_from(head)
+            if fourcc in (b"RIFF", b"LIST"):
+                position += 12  # step into AVIX, movi, or rec
+                continue
+            end = position + 8 + length + (length & 1)
+            if end > size:
+                break  # the chunk hasn't been written completely yet
+            if fourcc[:2] == self.video and fourcc[2:] in (b"dc", b"db"):
+                data = head[8 : 8 + length]
+                if length != 0 and (self.all_keyframes or is_h264_keyframe(data)):
+                    self.keyframes.append((self.frames, position))
+                self.frames += 1
+            position = end
+        self.position = position
+
+    # Refer to the keyframe at or before the specified time, or the first keyframe.
+    def keyframe_before(self, seconds):
+        frame = seconds * self.rate / self.scale
+        found = self.keyframes[0] if len(self.keyframes) != 0 else None
+        for keyframe in self.keyframes:
+            if keyframe[0] > frame:
+                break
+            found = keyframe
+        return found
+
+    # Refer to the offset of the first keyframe after the specified time, or the end of scanned.
+    def keyframe_after(self, seconds):
+        frame = seconds * self.rate / self.scale
+        for keyframe in self.keyframes:
+            if keyframe[0] > frame:
+                return keyframe[1]
+        return self.position
+
+    # Write the stream chunks between the specified offsets as an AVI file by stream copy.
+    # The header of the original file is reused with the sizes rewritten, and passed to FFmpeg
+    # through a pipe, so that FFmpeg doesn't need to seek in the original file.
+    def extract(self, begin, end, output):
+        keyframe = self.keyframe_before(begin)
+        if keyframe is None:
+            return None
+        start = keyframe[1]
+        stop = self.keyframe_after(end)
+
+        # collect stream chunks in the range
+        chunks = []
+        with open(self.file, mode="rb") as f:
+            position = start
+            while position + 8 <= stop:
+                f.seek(position)
+                fourcc, length = CHUNK_HEADER.unpack(f.read(8))
+                if fourcc in (b"RIFF", b"LIST"):
+                    position += 12
+                    continue
+                end_of_chunk = position + 8 + length + (length & 1)
+                if is_stream_chunk(fourcc):
+                    chunks.append((position, end_of_chunk - position))
+                position = end_of_chunk
+
+            body = sum([length for _, length in chunks])
+            header = bytearray(self.header)
+            struct.pack_into("<I", header, 4, len(header) - 8 + body)
+            struct.pack_into("<I", header, self.movi + 4, 4 + body)
+
+            command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+            command.extend(["-f", "avi", "-i", "pipe:0"])
+            command.extend(["-c", "copy", "-f", "avi", output])
+            proc = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            try:
+                proc.stdin.write(header)
+                for position, length in chunks:
+                    f.seek(position)
+                    proc.stdin.write(f.read(length))
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            stderr = proc.stderr.read()
+            proc.wait()
+        if proc.returncode != 0:
+            raise IOError(
+                "failed to extract {}: {}".format(self.file, stderr.decode("utf-8"))
+            )
+        return self.frame_time(keyframe[0])
@@ -0,0 +1,102 @@
+#
+# Timing of the phases from power-on to the first frame of the footage. The phases are marked with
+# the uptime, which doesn't depend on the system clock that is often wrong at boot without RTC.
+# startup.sh marks the first two phases, and the recorder marks the rest.
+#
+import os
+import time
+
+import ivr
+
+# Phases of the boot in order:
+#   startup:     startup.sh has been started
+#   mounted:     the data directory has been mounted
+#   exec:        the recorder process has been started
+#   imported:    the recorder has imported its modules
+#   detected:    the camera and audio devices have been determined
+#   ffmpeg:      FFmpeg has been launched
+#   first_frame: FFmpeg has reported the first frame of the footage
+PHASES = ["startup", "mounted", "exec", "imported", "detected", "ffmpeg", "first_frame"]
+
+
+# Refer to the seconds since the system was booted.
+def uptime():
+    with open("/proc/uptime", mode="r") as f:
+        return float(f.read().split()[0])
+
+
+# Refer to the identifier of the current boot.
+def boot_id():
+    with open("/proc/sys/kernel/random/boot_id", mode="r") as f:
+        return f.read().strip()
+
+
+# Refer to the uptime at which the current process was started.
+def process_start():
+    with open("/proc/self/stat", mode="r") as f:
+        stat = f.read()
+    # the fields after the command name, which may contain spaces, from the state (3rd field)
+    fields = stat.rpartition(")")[2].split()
+    return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+# Refer to the file in which the phases of the current boot are marked.
+def marks_file():
+    return os.path.join(ivr.temp_dir(), "boot.txt")
+
+
+# Refer to the file to which the timing of each boot is appended.
+def report_file(dir):
+    return os.path.join(dir, "boot-timing.tsv")
+
+
+# Read the uptime of each phase marked in the current boot.
+def load_marks():
+    current = boot_id()
+    marks = {}
+    try:
+        with open(marks_file(), mode="r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[0] == current:
+                    marks.setdefault(fields[1], float(fields[2]))
+    except (FileNotFoundError, ValueError):
+        pass
+    return marks
+
+
+# Mark that the phase has been reached at the specified uptime, or now. Only the first mark of each
+# phase in a boot is kept, so that restarting the recorder doesn't change the timing. Returns False
+# if the phase has already been marked.
+def mark(phase, at=None):
+    try:
+        if phase in load_marks():
+            return False
+        at = uptime() if at is None else at
+        with open(marks_file(), mode="a") as f:
+            f.write("{} {} {:.3f}\n".format(boot_id(), phase, at))
+    except OSError as e:
+        ivr.log("WARN: failed to mark the boot phase {}: {}".format(phase, e))
+        return False
+    return True
+
+
+# Mark the first frame and append the timing of the current boot to the report in the data
+# directory. Does nothing if the first frame of this boot has already been reported.
+def report_first_frame(dir):
+    if not mark("first_frame"):
+        return
+    marks = load_marks()
+    file = report_file(dir)
+    row = [time.strftime("%F %T"), boot_id()]
+    row.extend(["{:.3f}".format(marks[p]) if p in marks else "" for p in PHASES])
+    try:
+        with open(file, mode="a") as f:
+            if f.tell() == 0:
+                f.write("\t".join(["date", "boot_id"] + PHASES) + "\n")
+            f.write("\t".join(row) + "\n")
+    except OSError as e:
+        ivr.log("WARN: failed to write the boot timing: {}: {}".format(file, e))
+
+    timing = ["{}={:.1f}s".format(p, marks[p]) for p in PHASES if p in marks]
+    ivr.log("boot timing: {}".format(", ".join(timing)))
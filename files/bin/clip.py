@@ -0,0 +1,101 @@
+#
+# Cut out a time range from the footage files by stream copy, without re-encoding.
+#
+import os
+import re
+import subprocess
+
+import avi
+import ivr
+
+
+# Refer to the footage files of the primary camera in order of newest to oldest, up to the
+# specified number.
+def recent_footage_files(dir, count):
+    files = []
+    for f in os.listdir(dir):
+        m = re.fullmatch(ivr.camera_footage_pattern(), f)
+        if m is not None and ivr.file_extension(f) == ".avi":
+            file = os.path.join(dir, f)
+            files.append((os.stat(file).st_mtime, file))
+    files.sort(reverse=True)
+    return [f for _, f in files[:count]]
+
+
+# Keep the keyframe indices of the specified footage files up-to-date. The indices of files that
+# are no longer specified are discarded.
+def update_indices(indices, files):
+    for file in list(indices.keys()):
+        if file not in files:
+            del indices[file]
+    for file in files:
+        if file not in indices:
+            indices[file] = avi.Index(file)
+        indices[file].update()
+    return indices
+
+
+# Refer to the time range of the footage in epoch seconds. The end of footage is assumed to be the
+# last modified time of the file.
+def footage_range(index):
+    end = os.stat(index.file).st_mtime
+    return (end - index.duration(), end)
+
+
+# Write the footage between the specified epoch times to the output file. The beginning is aligned
+# to the keyframe at or before it. Returns False if no footage exists in the range.
+def extract(indices, begin, end, output):
+    ranges = []
+    for index in indices.values():
+        if index.header is None:
+            continue
+        first, last = footage_range(index)
+        if first < end and begin < last:
+            ranges.append((first, last, index))
+    ranges.sort(key=lambda r: r[0])
+    if len(ranges) == 0:
+        return False
+
+    # cut out each part from the footage files
+    dir = os.path.dirname(output)
+    name = os.path.basename(output)
+    parts = []
+    try:
+        for i, (first, last, index) in enumerate(ranges):
+            part = os.path.join(dir, ".{}.part{}.avi".format(name, i))
+            if index.extract(max(0, begin - first), end - first, part) is not None:
+                parts.append(part)
+        if len(parts) == 0:
+            return False
+
+        # concatenate the parts into a single file
+        temp = os.path.join(dir, ".{}".format(name))
+        if len(parts) == 1:
+            os.rename(parts[0], temp)
+        else:
+            concat(parts, temp)
+        os.rename(temp, output)
+    finally:
+        for part in parts:
+            if os.path.isfile(part):
+                os.remove(part)
+    return True
+
+
+# Concatenate the specified footage files by stream copy using the concat demuxer.
+def concat(files, output):
+    list_file = os.path.join(os.path.dirname(output), ".concat.txt")
+    with open(list_file, mode="w") as f:
+        for file in files:
+            f.write("file '{}'\n".format(file.replace("'", "'\\''")))
+    try:
+        command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+        command.extend(["-f", "concat", "-safe", "0", "-i", list_file])
+        command.extend(["-c", "copy", "-f", "avi", output])
+        ret = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+        if ret.returncode != 0:
+            raise IOError(
+                "failed to concatenate {}: {}".format(files, ret.stderr.decode("utf-8"))
+            )
+    finally:
+        os.remove(list_file)
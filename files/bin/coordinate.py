@@ -5,55 +5,171 @@
 #
 import argparse
 import datetime
+import gzip
 import os
 import re
 import signal
+import shutil
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
 import ivr
+import pressure
+import profiling
+import remux
+import retention
+import thumbnail
+import upload
 
 
 def remove(file, reason=None):
-    os.remove(file)
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        return
     reason = "" if reason is None else " ({})".format(reason)
     ivr.log("file removed: {}{}".format(file, reason))
 
 
 # Remote files with older timestamps so that the total size of files with filenames of the
 # specified pattern doesn't exceed the maximum capacity (but the least min_fises remain).
-def ensure_storage_space(dir, file_pattern, max_capacity, min_files):
+# Files that share the same base name, such as a footage and its subtitle, are treated as a group
+# and are kept or removed together. If the names of uploaded files are specified, the groups that
+# have been uploaded are removed first.
+@profiling.timed
+def ensure_storage_space(dir, file_pattern, max_capacity, min_files, uploaded=None):
 
     # retrie all footage files and sort them in order of newest to oldest
-    files = []
+    groups = {}
     for f in os.listdir(dir):
         if re.fullmatch(file_pattern, f):
             file = os.path.join(dir, f)
-            files.append((os.stat(file).st_mtime, file))
-    files.sort(reverse=True)
-    files = [f for _, f in files]
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                # replaced by the remux worker in the meantime
+                continue
+            key = os.path.splitext(file)[0]
+            mtime, size, members = groups.get(key, (0, 0, []))
+            mtime = max(mtime, stat.st_mtime)
+            groups[key] = (mtime, size + stat.st_size, members + [file])
+    groups = list(groups.values())
+    groups.sort(reverse=True)
 
     # exclude the latest files from being removed
     total_size = 0
     for _ in range(min_files):
-        if len(files) == 0:
+        if len(groups) == 0:
             break
         else:
-            file = files.pop(0)
-            total_size += os.path.getsize(file)
+            _, size, _ = groups.pop(0)
+            total_size += size
+
+    # remove old files that have already been uploaded first
+    if uploaded is not None:
+        excess = total_size + sum([size for _, size, _ in groups]) - max_capacity
+        for group in list(reversed(groups)):
+            _, size, members = group
+            if excess <= 0:
+                break
+            if all([os.path.basename(file) in uploaded for file in members]):
+                for file in members:
+                    remove(file, "exceeding the storage capacity, uploaded")
+                groups.remove(group)
+                excess -= size
 
     # remove old files that have exceeded storage capacity
-    for file in files:
-        if total_size + os.path.getsize(file) > max_capacity:
-            remove(file, "exceeding the storage capacity")
+    for _, size, members in groups:
+        if total_size + size > max_capacity:
+            for file in members:
+                remove(file, "exceeding the storage capacity")
         else:
-            total_size += os.path.getsize(file)
+            total_size += size
 
     return
 
 
+# Files to be compressed after their day has rolled over.
+COMPRESSIBLE_FILE_PATTERNS = [ivr.IVRLOG_FILE_PATTERN, ivr.TRACKLOG_FILE_PATTERN]
+
+# Seconds since the last modification after which the file of a past day is compressed.
+COMPRESSION_DELAY_SECONDS = 10 * 60
+
+# Size of the buffer to compress the file in constant memory.
+COMPRESSION_BUFFER_SIZE = 64 * 1024
+
+
+# Compress the log and tracklog files of the past days with gzip, one by one in a low priority
+# thread. The modification time is kept so that the order of deletion doesn't change, and the
+# compressed size is counted by ensure_storage_space() because the pattern includes ".gz".
+def compress_closed_files(dir):
+    if compress_closed_files.thread is not None:
+        if compress_closed_files.thread.is_alive():
+            return
+    today = datetime.date.today()
+    files = []
+    for f in os.listdir(dir):
+        for pattern in COMPRESSIBLE_FILE_PATTERNS:
+            m = re.fullmatch(pattern, f)
+            if m is None or m.group(4) is not None:
+                continue
+            try:
+                date = datetime.date(*[int(x) for x in m.groups()[0:3]])
+                mtime = os.stat(os.path.join(dir, f)).st_mtime
+            except (ValueError, FileNotFoundError):
+                continue
+            if date < today and time.time() - mtime >= COMPRESSION_DELAY_SECONDS:
+                files.append(os.path.join(dir, f))
+    if len(files) != 0:
+        compress_closed_files.thread = threading.Thread(
+            target=compress_files, args=(files,), daemon=True
+        )
+        compress_closed_files.thread.start()
+
+
+compress_closed_files.thread = None
+
+
+def compress_files(files):
+    ivr.lower_priority(threading.get_native_id())
+    for file in files:
+        if pressure.under_pressure() is not None:
+            # try again on the next interval
+            break
+        compress(file)
+
+
+# Compress the file into the one with ".gz", and replace the original with it.
+def compress(file):
+    compressed = "{}.{}".format(file, ivr.COMPRESSED_FILE_EXT)
+    temp = os.path.join(
+        os.path.dirname(file), ".{}.tmp".format(os.path.basename(compressed))
+    )
+    try:
+        stat = os.stat(file)
+        with open(file, mode="rb") as src:
+            with gzip.open(temp, mode="wb") as dst:
+                shutil.copyfileobj(src, dst, COMPRESSION_BUFFER_SIZE)
+        os.utime(temp, (stat.st_atime, stat.st_mtime))
+        os.rename(temp, compressed)
+        os.remove(file)
+    except FileNotFoundError:
+        # removed by ensure_storage_space() in the meantime
+        if os.path.isfile(temp):
+            os.remove(temp)
+        return
+    ivr.log(
+        "file compressed: {} ({}B -> {}B)".format(
+            file,
+            ivr.with_aux_unit(stat.st_size),
+            ivr.with_aux_unit(os.path.getsize(compressed)),
+        )
+    )
+
+
 def check_for_updates_to_the_telop(file):
     overwrite = False
     if not os.path.isfile(file):
@@ -128,6 +244,21 @@ if __name__ == "__main__":
         default="2G",
         help="Total size of track log file to be retained, such as 32G, 32000M (default: 2G)",
     )
+    parser.add_argument(
+        "-le",
+        "--limit-event",
+        metavar="CAPACITY",
+        default="2G",
+        help="Total size of event clip files to be retained, such as 2G, 2000M (default: 2G)",
+    )
+    parser.add_argument(
+        "-lc",
+        "--limit-camera",
+        metavar="NAME=CAPACITY",
+        action="append",
+        default=[],
+        help="Total size of footage files of the secondary camera, such as rear=20G, within the footage limit (default: no limit)",
+    )
     parser.add_argument(
         "-i",
         "--interval",
@@ -136,9 +267,40 @@ if __name__ == "__main__":
         default=20,
         help="Interval at which to monitor the directory (default: 20 sec)",
     )
+    parser.add_argument(
+        "-rt",
+        "--retention",
+        metavar="TIERS",
+        help="Convert aging footage to lower quality instead of deleting it, such as 48h:full,7d:500k,30d:key (default: disabled)",
+    )
+    parser.add_argument(
+        "-r",
+        "--remux",
+        action="store_true",
+        help="Convert the closed footage files into MP4 in the background (default: disabled)",
+    )
+    parser.add_argument(
+        "-rw",
+        "--remux-workers",
+        metavar="NUM",
+        type=int,
+        default=1,
+        help="Number of footage files to be converted at the same time (default: 1)",
+    )
+    parser.add_argument(
+        "-tn",
+        "--thumbnails",
+        metavar="SECONDS",
+        type=int,
+        help="Make a contact sheet of the keyframes every SECONDS for each closed footage file, such as 60 (default: disabled)",
+    )
 
+    remux_queue = None
+    retention_engine = None
+    thumbnail_indexer = None
     try:
         ivr.save_pid()
+        profiling.start()
 
         # register SIGTERM handler
         signal.signal(signal.SIGTERM, ivr.term_handler)
@@ -148,6 +310,11 @@ if __name__ == "__main__":
         dir = args.dir
         telop = args.telop
         limit_tracklog = ivr.without_aux_unit(args.limit_tracklog)
+        limit_event = ivr.without_aux_unit(args.limit_event)
+        limit_cameras = []
+        for spec in args.limit_camera:
+            name, _, capacity = spec.partition("=")
+            limit_cameras.append((name, ivr.without_aux_unit(capacity)))
         limit_log = ivr.without_aux_unit("5M")
         interval = args.interval
 
@@ -157,21 +324,50 @@ if __name__ == "__main__":
         else:
             dev, size = partition_size(dir)
             ivr.log("device capacity: {} ({}B)".format(dev, ivr.with_aux_unit(size)))
-            limit_footage = max(0, int(size * 0.95) - (limit_tracklog + limit_log))
+            limit_footage = int(size * 0.95) - (limit_tracklog + limit_log + limit_event)
+            limit_footage = max(0, limit_footage)
 
         ivr.log(
-            "available storage: {} = {}B(footage) + {}B(tracklog) + {}B(log)".format(
-                ivr.with_aux_unit(limit_footage + limit_tracklog + limit_log),
+            "available storage: {} = {}B(footage) + {}B(tracklog) + {}B(log) + {}B(event)".format(
+                ivr.with_aux_unit(
+                    limit_footage + limit_tracklog + limit_log + limit_event
+                ),
                 ivr.with_aux_unit(limit_footage),
                 ivr.with_aux_unit(limit_tracklog),
                 ivr.with_aux_unit(limit_log),
+                ivr.with_aux_unit(limit_event),
             )
         )
+        if args.retention is not None:
+            tiers = retention.parse_tiers(args.retention)
+            retention_engine = retention.RetentionEngine(dir, tiers, limit_footage)
+        if args.remux:
+            remux_queue = remux.RemuxQueue(dir)
+            remux_queue.start(args.remux_workers)
+        if args.thumbnails is not None:
+            thumbnail_indexer = thumbnail.ThumbnailIndexer(dir, args.thumbnails)
+
         while True:
-            ensure_storage_space(dir, ivr.FOOTAGE_FILE_PATTERN, limit_footage, 2)
-            ensure_storage_space(dir, ivr.TRACKLOG_FILE_PATTERN, limit_tracklog, 2)
-            ensure_storage_space(dir, ivr.IVRLOG_FILE_PATTERN, limit_log, 2)
+            if retention_engine is not None:
+                retention_engine.update()
+            uploaded = upload.uploaded_files(dir)
+            for name, limit_camera in limit_cameras:
+                pattern = ivr.camera_footage_pattern(name)
+                ensure_storage_space(dir, pattern, limit_camera, 2, uploaded)
+            ensure_storage_space(
+                dir, ivr.FOOTAGE_FILE_PATTERN, limit_footage, 2, uploaded
+            )
+            ensure_storage_space(
+                dir, ivr.TRACKLOG_FILE_PATTERN, limit_tracklog, 2, uploaded
+            )
+            ensure_storage_space(dir, ivr.IVRLOG_FILE_PATTERN, limit_log, 2, uploaded)
+            ensure_storage_space(dir, ivr.EVENT_FILE_PATTERN, limit_event, 2, uploaded)
+            compress_closed_files(dir)
             check_for_updates_to_the_telop(telop)
+            if remux_queue is not None:
+                remux_queue.enqueue_closed_footage()
+            if thumbnail_indexer is not None:
+                thumbnail_indexer.update()
             time.sleep(interval)
 
     except ivr.TermException as e:
@@ -184,4 +380,10 @@ if __name__ == "__main__":
         ivr.beep("coordinator has stopped due to an error")
         sys.exit(1)
     finally:
+        if remux_queue is not None:
+            remux_queue.stop()
+        if retention_engine is not None:
+            retention_engine.stop()
+        if thumbnail_indexer is not None:
+            thumbnail_indexer.stop()
         ivr.remove_pid()
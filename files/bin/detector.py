@@ -0,0 +1,81 @@
+#
+# Motion detection over a low-resolution grayscale frame stream, which FFmpeg outputs along with
+# the footage.
+#
+import importlib.util
+import threading
+import time
+
+import ivr
+
+# Width and frame rate of the frames to be analyzed.
+ANALYSIS_WIDTH = 64
+ANALYSIS_FPS = 2
+
+# Difference of brightness (0-255) to consider that a pixel has changed.
+PIXEL_THRESHOLD = 24
+
+# Weight of the latest frame when updating the background.
+BACKGROUND_WEIGHT = 0.2
+
+# Monotonic time when the last motion was detected.
+last_motion = time.monotonic()
+
+
+# Returns True if the motion detection is available in this environment. NumPy isn't imported
+# here but by the detector thread, since it takes seconds to be imported on single-core models and
+# would delay the start of the recording.
+def available():
+    return importlib.util.find_spec("numpy") is not None
+
+
+# Refer to the size of the frames to be analyzed for the specified resolution such as 640x360.
+def analysis_size(resolution):
+    width, height = [int(x) for x in resolution.lower().split("x")]
+    return (ANALYSIS_WIDTH, max(2, round(ANALYSIS_WIDTH * height / width / 2) * 2))
+
+
+# FFmpeg output options to write the frames to be analyzed to the standard output.
+def ffmpeg_output_options(width, height):
+    vf = "fps={},scale={}:{},format=gray".format(ANALYSIS_FPS, width, height)
+    return ["-map", "0:v", "-vf", vf, "-f", "rawvideo", "pipe:1"]
+
+
+# Refer to the number of seconds since the last motion was detected.
+def seconds_since_last_motion():
+    return time.monotonic() - last_motion
+
+
+# A thread that reads frames from the stream and detects motions by comparing them with the
+# background. This must keep reading the stream so that FFmpeg doesn't block on the pipe.
+class MotionDetector(threading.Thread):
+    def __init__(self, stream, width, height, sensitivity):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.sensitivity = sensitivity  # ratio of changed pixels to detect motion
+
+    def run(self):
+        global last_motion
+        import numpy
+
+        size = self.width * self.height
+        background = None
+        moving = False
+        while True:
+            buffer = self.stream.read(size)
+            if len(buffer) < size:
+                break
+            frame = numpy.frombuffer(buffer, dtype=numpy.uint8).astype(numpy.float32)
+            if background is None:
+                background = frame
+                continue
+            changed = numpy.count_nonzero(numpy.abs(frame - background) > PIXEL_THRESHOLD)
+            background += (frame - background) * BACKGROUND_WEIGHT
+            ratio = changed / size
+            if ratio >= self.sensitivity:
+                last_motion = time.monotonic()
+                if not moving:
+                    ivr.log("motion detected: {:.1f}%".format(ratio * 100))
+            moving = ratio >= self.sensitivity
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+# Save the footage before and after an incident as an event clip, so that it won't be removed by
+# the rolling deletion of footage files. An event is triggered by SIGUSR2, a message to the local
+# socket, or `event.py --trigger`.
+#
+import argparse
+import datetime
+import os
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import clip
+import ivr
+import profiling
+
+# Number of recent footage files to be indexed for the pre-roll.
+INDEXED_FOOTAGE_FILES = 3
+
+# Seconds to wait for FFmpeg to flush the footage after the post-roll.
+FLUSH_WAIT_SECONDS = 3
+
+
+# Send an event trigger to the event service. Returns False if the service isn't running.
+# The pre-roll and post-roll of the service can be overridden for this event.
+def notify(reason, pre_roll=None, post_roll=None):
+    message = reason
+    if pre_roll is not None and post_roll is not None:
+        message = "{}\t{}\t{}".format(reason, pre_roll, post_roll)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode("utf-8"), ivr.event_socket_file())
+        return True
+    except OSError:
+        return False
+
+
+# A handler that records the event triggered by SIGUSR2.
+def signal_handler(signum, frame):
+    signal_handler.triggered.append("signal")
+
+
+signal_handler.triggered = []
+
+
+# Parse the message received from the socket into the reason, pre-roll and post-roll.
+def parse_message(message, pre_roll, post_roll):
+    fields = message.split("\t")
+    if len(fields) == 3:
+        try:
+            return (fields[0], float(fields[1]), float(fields[2]))
+        except ValueError:
+            pass
+    return (message or "socket", pre_roll, post_roll)
+
+
+# Add the event that occurred at the specified time to the pending events. If the range overlaps
+# with the last pending event, they are merged into one clip.
+def add_event(events, now, reason, pre_roll, post_roll):
+    begin = now - pre_roll
+    end = now + post_roll
+    if len(events) != 0 and begin <= events[-1][1]:
+        events[-1][1] = max(events[-1][1], end)
+        events[-1][2].append(reason)
+    else:
+        events.append([begin, end, [reason]])
+    ivr.log("event triggered: {}".format(reason))
+
+
+# Wait for event triggers and save the event clips.
+def start_event_service(dir, pre_roll, post_roll):
+    file = ivr.event_socket_file()
+    if os.path.exists(file):
+        os.remove(file)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(file)
+    ivr.log("start event service: {}".format(file))
+
+    events = []
+    indices = {}
+    try:
+        while True:
+            readable, _, _ = select.select([sock], [], [], 1.0)
+            now = time.time()
+            if len(readable) != 0:
+                message = sock.recv(1024).decode("utf-8", errors="replace").strip()
+                reason, pre, post = parse_message(message, pre_roll, post_roll)
+                add_event(events, now, reason, pre, post)
+            while len(signal_handler.triggered) != 0:
+                reason = signal_handler.triggered.pop(0)
+                add_event(events, now, reason, pre_roll, post_roll)
+
+            # keep the index of recent footage up-to-date so that the clip can be cut out quickly
+            files = clip.recent_footage_files(dir, INDEXED_FOOTAGE_FILES)
+            clip.update_indices(indices, files)
+
+            # save the clips whose post-roll has passed
+            while len(events) != 0 and events[0][1] + FLUSH_WAIT_SECONDS <= now:
+                begin, end, reasons = events.pop(0)
+                save_event_clip(dir, indices, begin, end, reasons)
+    finally:
+        sock.close()
+        os.remove(file)
+
+
+# Save the footage between the specified epoch times as an event clip.
+def save_event_clip(dir, indices, begin, end, reasons):
+    clip.update_indices(indices, list(indices.keys()))
+    tm = datetime.datetime.fromtimestamp(begin + (end - begin) / 2)
+    output = os.path.join(dir, ivr.event_file_name(tm, "avi"))
+    t0 = time.monotonic()
+    try:
+        if clip.extract(indices, begin, end, output):
+            ivr.log(
+                "event clip saved: {} ({}B, {:.1f} sec): {}".format(
+                    output,
+                    ivr.with_aux_unit(os.path.getsize(output)),
+                    time.monotonic() - t0,
+                    ", ".join(reasons),
+                )
+            )
+            ivr.beep("the event has been recorded")
+        else:
+            ivr.log("WARN: no footage to save the event: {}".format(", ".join(reasons)))
+    except IOError as e:
+        ivr.log("ERROR: failed to save the event clip: {}".format(e))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Save the footage around incidents as protected event clips"
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory where the footage and event files are stored (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-pre",
+        "--pre-roll",
+        metavar="SECONDS",
+        type=int,
+        default=30,
+        help="Seconds of footage to be saved before the event (default: 30 sec)",
+    )
+    parser.add_argument(
+        "-post",
+        "--post-roll",
+        metavar="SECONDS",
+        type=int,
+        default=30,
+        help="Seconds of footage to be saved after the event (default: 30 sec)",
+    )
+    parser.add_argument(
+        "-t",
+        "--trigger",
+        metavar="REASON",
+        nargs="?",
+        const="command",
+        help="Trigger an event to the running event service, and exit",
+    )
+
+    args = parser.parse_args()
+    if args.trigger is not None:
+        if not notify(args.trigger):
+            print("ERROR: event service is not running")
+            sys.exit(1)
+        sys.exit(0)
+
+    try:
+        ivr.save_pid()
+        profiling.start()
+
+        # register SIGTERM handler
+        signal.signal(signal.SIGTERM, ivr.term_handler)
+        signal.signal(signal.SIGINT, ivr.term_handler)
+        signal.signal(signal.SIGUSR2, signal_handler)
+
+        start_event_service(args.dir, args.pre_roll, args.post_roll)
+
+    except ivr.TermException as e:
+        ivr.log("IVR terminates the event service")
+    except Exception as e:
+        t = "".join(list(traceback.TracebackException.from_exception(e).format()))
+        ivr.log("ERROR: {}".format(t))
+        ivr.log("IVR terminates the event service by an error")
+        ivr.beep("event service has stopped due to an error")
+        sys.exit(1)
+    finally:
+        ivr.remove_pid()
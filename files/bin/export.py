@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#
+# Export the footage of a wall-clock time range, such as 14:58-15:04 across the hourly segments, as
+# a single clip. The clip is made by stream copy with the concat demuxer in a single pass, so it
+# only takes seconds. The track points of the range can be exported as a GPX file together.
+#
+#   $ export.py --begin "2022-02-01 14:58" --end "2022-02-01 15:04" --gpx
+#
+import argparse
+import datetime
+import os
+import re
+import subprocess
+import sys
+
+import avi
+import clip
+import gpsfix
+import gpx
+import ivr
+import remux
+
+# Formats of the time accepted by --begin and --end. The date is today if omitted.
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%H:%M:%S", "%H:%M"]
+
+# Track point in the GPX files written by gpx.py.
+TRKPT_PATTERN = re.compile(
+    r'<trkpt lat="([^"]+)" lon="([^"]+)">(.*?)</trkpt>', re.DOTALL
+)
+ELE_PATTERN = re.compile(r"<ele>([^<]*)</ele>")
+TIME_PATTERN = re.compile(r"<time>([^<]*)</time>")
+
+
+# Parse the time of --begin and --end as a local datetime.
+def parse_time(text):
+    for format in TIME_FORMATS:
+        try:
+            tm = datetime.datetime.strptime(text, format)
+        except ValueError:
+            continue
+        if "%Y" not in format:
+            today = datetime.date.today()
+            tm = tm.replace(year=today.year, month=today.month, day=today.day)
+        return tm
+    raise ValueError("invalid time: {}".format(text))
+
+
+# Refer to the footage files of the camera that may overlap the range, by their names. A footage
+# file is named by the hour it started in, and lasts until the next hour, or the one after next if
+# it started in the last minute of the hour. The footage may have been remuxed into MP4.
+def candidate_files(dir, begin, end, camera=None):
+    files = []
+    for f in os.listdir(dir):
+        m = re.fullmatch(ivr.camera_footage_pattern(camera), f)
+        if m is None or ivr.file_extension(f) not in [".avi", "." + remux.REMUX_FILE_EXT]:
+            continue
+        hour = datetime.datetime(*[int(m.group(i)) for i in range(2, 6)])
+        if hour <= end and begin < hour + datetime.timedelta(hours=2):
+            files.append(os.path.join(dir, f))
+    return files
+
+
+# Refer to the parts of the footage in the range as a list of (file, inpoint, outpoint, start) in
+# order of time. The inpoint and the outpoint are in seconds from the beginning of the file, and
+# the inpoint is aligned to the keyframe at or before it so that the clip starts with a decodable
+# frame. The outpoint is None if the range reaches the end of the file. The start is the epoch time
+# of the beginning of the file.
+#
+# The MP4 footage has no AVI index, so its range is probed by ffprobe, and the inpoint is left to
+# the concat demuxer, which starts the stream copy from the keyframe at or before it.
+def locate(dir, begin, end, camera=None):
+    t0 = begin.timestamp()
+    t1 = end.timestamp()
+    ranges = []
+    for file in candidate_files(dir, begin, end, camera):
+        if ivr.file_extension(file) == "." + remux.REMUX_FILE_EXT:
+            duration = remux.media_duration(file)
+            if duration is None or duration == 0:
+                print("WARN: failed to read the duration of {}".format(file))
+                continue
+            last = os.stat(file).st_mtime
+            first = last - duration
+            index = None
+        else:
+            index = avi.Index(file)
+            if not index.update() or index.frames == 0:
+                continue
+            first, last = clip.footage_range(index)
+        if first < t1 and t0 < last:
+            ranges.append((first, last, file, index))
+    ranges.sort(key=lambda r: r[0])
+
+    parts = []
+    for first, last, file, index in ranges:
+        if index is None:
+            inpoint = max(0, t0 - first)
+        else:
+            keyframe = index.keyframe_before(max(0, t0 - first))
+            if keyframe is None:
+                continue
+            inpoint = index.frame_time(keyframe[0])
+        outpoint = None if t1 >= last else t1 - first
+        parts.append((file, inpoint, outpoint, first))
+    return parts
+
+
+# Export the footage between the specified local times to the output file by stream copy. The
+# container is determined by the extension of the output file. Returns the actual range of the clip
+# as a pair of datetimes, or None if no footage exists in the range.
+def export(dir, begin, end, output, camera=None):
+    parts = locate(dir, begin, end, camera)
+    if len(parts) == 0:
+        return None
+
+    out_dir = os.path.dirname(os.path.abspath(output))
+    name = os.path.basename(output)
+    list_file = os.path.join(out_dir, ".{}.concat.txt".format(name))
+    temp = os.path.join(out_dir, ".{}".format(name))
+    with open(list_file, mode="w") as f:
+        for file, inpoint, outpoint, _ in parts:
+            f.write("file '{}'\n".format(file.replace("'", "'\\''")))
+            f.write("inpoint {:.3f}\n".format(inpoint))
+            if outpoint is not None:
+                f.write("outpoint {:.3f}\n".format(outpoint))
+    try:
+        command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+        command.extend(["-f", "concat", "-safe", "0", "-i", list_file])
+        command.extend(["-c", "copy", temp])
+        ret = subprocess.run(
+            ivr.low_priority_command(command),
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+        if ret.returncode != 0:
+            raise IOError(
+                "failed to export {}: {}".format(
+                    [p[0] for p in parts], ret.stderr.decode("utf-8")
+                )
+            )
+        os.rename(temp, output)
+    finally:
+        os.remove(list_file)
+        if os.path.isfile(temp):
+            os.remove(temp)
+
+    file, inpoint, _, start = parts[0]
+    actual_begin = datetime.datetime.fromtimestamp(start + inpoint)
+    file, _, outpoint, start = parts[-1]
+    if outpoint is None:
+        actual_end = datetime.datetime.fromtimestamp(os.stat(file).st_mtime)
+    else:
+        actual_end = datetime.datetime.fromtimestamp(start + outpoint)
+    return (actual_begin, actual_end)
+
+
+# Export the track points between the specified local times in the track-log files to the output
+# GPX file. Returns the number of the track points.
+def export_gpx(dir, begin, end, output):
+    t0 = begin.astimezone()
+    t1 = end.astimezone()
+    fixes = []
+    for f in sorted(os.listdir(dir)):
+        m = re.fullmatch(ivr.TRACKLOG_FILE_PATTERN, f)
+        if m is None:
+            continue
+        date = datetime.date(*[int(m.group(i)) for i in range(1, 4)])
+        if date < begin.date() or end.date() < date:
+            continue
+        with ivr.open_text(os.path.join(dir, f)) as r:
+            text = r.read()
+        for lat, lon, body in TRKPT_PATTERN.findall(text):
+            time_match = TIME_PATTERN.search(body)
+            if time_match is None:
+                continue
+            time_text = time_match.group(1)
+            tm = gpsfix.parse_time(time_text)
+            if tm is None or tm < t0 or t1 < tm:
+                continue
+            ele_match = ELE_PATTERN.search(body)
+            alt = None if ele_match is None else gpsfix.number(ele_match.group(1))
+            fix = gpsfix.Fix(tm, time_text, None, None, alt, None, None, None)
+            fixes.append((tm, gpsfix.number(lat), gpsfix.number(lon), fix))
+    fixes.sort(key=lambda x: x[0])
+
+    tracks = [gpx.gpx_track(lat, lon, fix) for _, lat, lon, fix in fixes]
+    ivr.write(output, gpx.gpx_header(t0) + "".join(tracks) + gpx.gpx_trailer())
+    return len(fixes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the footage of a time range as a single clip by stream copy"
+    )
+    parser.add_argument(
+        "-b",
+        "--begin",
+        metavar="TIME",
+        required=True,
+        help="Beginning of the range in local time, such as '2022-02-01 14:58' or '14:58'",
+    )
+    parser.add_argument(
+        "-e",
+        "--end",
+        metavar="TIME",
+        required=True,
+        help="End of the range in local time, such as '2022-02-01 15:04' or '15:04'",
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory of the footage and track-log files (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="Clip file, whose extension determines the container (default: export-<begin>.avi)",
+    )
+    parser.add_argument(
+        "-c",
+        "--camera",
+        metavar="NAME",
+        help="Name of the secondary camera to be exported (default: the primary camera)",
+    )
+    parser.add_argument(
+        "-g",
+        "--gpx",
+        action="store_true",
+        help="Export the track points of the range to a GPX file beside the clip",
+    )
+    args = parser.parse_args()
+
+    try:
+        begin = parse_time(args.begin)
+        end = parse_time(args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    if end <= begin:
+        parser.error("the end must be after the beginning")
+    output = args.output
+    if output is None:
+        output = "export-{}.avi".format(begin.strftime("%Y%m%d%H%M%S"))
+
+    try:
+        actual = export(args.dir, begin, end, output, args.camera)
+    except IOError as e:
+        print("ERROR: {}".format(e))
+        sys.exit(1)
+    if actual is None:
+        print("ERROR: no footage exists between {} and {}".format(begin, end))
+        sys.exit(1)
+    print("{}: {} - {}".format(output, actual[0], actual[1]))
+
+    if args.gpx:
+        gpx_output = os.path.splitext(output)[0] + ".gpx"
+        count = export_gpx(args.dir, begin, end, gpx_output)
+        print("{}: {} track points".format(gpx_output, count))
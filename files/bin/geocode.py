@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+#
+# Offline reverse geocoding by a prebuilt index of a gazetteer, such as the cities500.txt of
+# GeoNames (https://download.geonames.org/export/dump/) or a CSV file of "name,lat,lon".
+# The index is a sorted array of places by their geohash cell, and it's memory-mapped so that a
+# lookup only reads a few pages of the file and the resident memory stays small.
+#
+#   $ geocode.py --build cities500.txt --output /opt/ivr/gazetteer.idx
+#   $ geocode.py --index /opt/ivr/gazetteer.idx --lookup 35.6812,139.7671
+#
+import argparse
+import collections
+import math
+import mmap
+import os
+import struct
+import sys
+
+# The index file consists of this magic number (including version), the header, the records
+# sorted by cell, and the UTF-8 names of the places.
+MAGIC = b"IVRG\x01\x00\x00\x00"
+
+# bits of the cells, the number of records, and the offsets of the records and the names
+HEADER = struct.Struct("<IIII")
+
+# cell, latitude, longitude, offset and length of the name
+RECORD = struct.Struct("<IffIH2x")
+
+# Bits of the geohash cells that the places are bucketed by, about 4.9km x 4.9km at the equator.
+CELL_BITS = 25
+
+# Bits of the geohash cells that the lookups are cached by, about 150m x 150m at the equator.
+CACHE_BITS = 35
+
+# Number of the cached lookups.
+CACHE_SIZE = 256
+
+# Maximum distance to the place to be reported.
+MAX_DISTANCE_METERS = 5000
+
+EARTH_RADIUS_METERS = 6371000
+
+# Columns of the name, latitude and longitude in the GeoNames tab-separated files.
+GEONAMES_COLUMNS = (2, 4, 5)
+
+
+# Refer to the geohash cell of the location as an integer of the specified bits, interleaving the
+# bits of the longitude and the latitude.
+def geohash(lat, lon, bits):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    cell = 0
+    for i in range(bits):
+        value, range_ = (lon, lon_range) if i % 2 == 0 else (lat, lat_range)
+        mid = (range_[0] + range_[1]) / 2
+        cell <<= 1
+        if value >= mid:
+            cell |= 1
+            range_[0] = mid
+        else:
+            range_[1] = mid
+    return cell
+
+
+# Refer to the cells around the location, including its own cell.
+def neighbor_cells(lat, lon, bits):
+    dlat = 180.0 / (1 << (bits // 2))
+    dlon = 360.0 / (1 << ((bits + 1) // 2))
+    cells = set()
+    for i in [-1, 0, 1]:
+        for j in [-1, 0, 1]:
+            y = min(90.0 - 1e-9, max(-90.0, lat + i * dlat))
+            x = (lon + j * dlon + 180.0) % 360.0 - 180.0
+            cells.add(geohash(y, x, bits))
+    return sorted(cells)
+
+
+# Refer to the approximate distance in meters between two locations, which is accurate enough for
+# the distances within a few cells.
+def distance(lat1, lon1, lat2, lon2):
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.sqrt(x * x + y * y) * EARTH_RADIUS_METERS
+
+
+# Read the places from the gazetteer file as a list of the name, latitude and longitude. The lines
+# that can't be parsed, such as a header, are skipped.
+def read_gazetteer(file):
+    places = []
+    with open(file, mode="r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) > max(GEONAMES_COLUMNS):
+                name, lat, lon = [fields[i] for i in GEONAMES_COLUMNS]
+            else:
+                fields = line.strip().rsplit(",", 2)
+                if len(fields) != 3:
+                    continue
+                name, lat, lon = fields
+            try:
+                places.append((name.strip(), float(lat), float(lon)))
+            except ValueError:
+                continue
+    return places
+
+
+# Build the index file from the gazetteer file. Returns the number of places.
+def build(gazetteer, output):
+    places = read_gazetteer(gazetteer)
+    records = []
+    names = bytearray()
+    for name, lat, lon in places:
+        encoded = name.encode("utf-8")[:0xFFFF]
+        records.append(
+            (geohash(lat, lon, CELL_BITS), lat, lon, len(names), len(encoded))
+        )
+        names.extend(encoded)
+    records.sort()
+
+    records_offset = len(MAGIC) + HEADER.size
+    names_offset = records_offset + RECORD.size * len(records)
+    temp = "{}.tmp".format(output)
+    with open(temp, mode="wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(CELL_BITS, len(records), records_offset, names_offset))
+        for record in records:
+            f.write(RECORD.pack(*record))
+        f.write(names)
+    os.rename(temp, output)
+    return len(records)
+
+
+# A memory-mapped index of the gazetteer that resolves the nearest place of a location.
+class Gazetteer:
+    def __init__(self, file):
+        with open(file, mode="rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[: len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError("not a gazetteer index: {}".format(file))
+        header = HEADER.unpack_from(self.map, len(MAGIC))
+        self.bits, self.count, self.records_offset, self.names_offset = header
+        self.cache = collections.OrderedDict()
+
+    def close(self):
+        self.map.close()
+
+    def record(self, i):
+        return RECORD.unpack_from(self.map, self.records_offset + RECORD.size * i)
+
+    # Refer to the index of the first record whose cell is equal to or greater than the cell.
+    def lower_bound(self, cell):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < cell:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Refer to the name of the nearest place within MAX_DISTANCE_METERS, or None if there is no
+    # such place.
+    def nearest(self, lat, lon):
+        best = None
+        for cell in neighbor_cells(lat, lon, self.bits):
+            i = self.lower_bound(cell)
+            while i < self.count:
+                c, y, x, offset, length = self.record(i)
+                if c != cell:
+                    break
+                d = distance(lat, lon, y, x)
+                if d <= MAX_DISTANCE_METERS and (best is None or d < best[0]):
+                    best = (d, offset, length)
+                i += 1
+        if best is None:
+            return None
+        _, offset, length = best
+        start = self.names_offset + offset
+        return self.map[start : start + length].decode("utf-8", errors="replace")
+
+    # Refer to the name of the place nearest to the location. The result is cached by the small
+    # geohash cell of the location, so that it's resolved only when the vehicle enters a new cell.
+    def lookup(self, lat, lon):
+        key = geohash(lat, lon, CACHE_BITS)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        name = self.nearest(lat, lon)
+        self.cache[key] = name
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build or look up the gazetteer index for offline reverse geocoding"
+    )
+    parser.add_argument(
+        "-b",
+        "--build",
+        metavar="GAZETTEER",
+        help="Build the index from the GeoNames or CSV (name,lat,lon) file",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="Index file to be built",
+    )
+    parser.add_argument(
+        "-i",
+        "--index",
+        metavar="FILE",
+        help="Index file to be looked up",
+    )
+    parser.add_argument(
+        "-l",
+        "--lookup",
+        metavar="LAT,LON",
+        help="Location to be looked up, such as 35.6812,139.7671",
+    )
+    args = parser.parse_args()
+
+    if args.build is not None:
+        if args.output is None:
+            parser.error("--output is required to build the index")
+        count = build(args.build, args.output)
+        print("{} places are indexed: {}".format(count, args.output))
+    elif args.index is not None and args.lookup is not None:
+        lat, lon = [float(x) for x in args.lookup.split(",")]
+        gazetteer = Gazetteer(args.index)
+        print(gazetteer.lookup(lat, lon))
+        gazetteer.close()
+    else:
+        parser.print_usage()
+        sys.exit(1)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# Decoder of the gpsd reports into fix records. Only the TPV reports are JSON-decoded, and the
+# timestamp is parsed by a fixed-format parser, so that the reports are decoded once per message
+# and shared by the telop, the tracklog and the telemetry.
+# See also: https://gpsd.gitlab.io/gpsd/gpsd_json.html
+#
+import argparse
+import datetime
+import json
+import math
+import timeit
+
+# Marker of the TPV reports, which gpsd writes without whitespace.
+TPV_MARKER = '"class":"TPV"'
+
+# Directions of 16 points, from north clockwise.
+DIRECTIONS = [
+    "N",
+    "NNE",
+    "NE",
+    "ENE",
+    "E",
+    "ESE",
+    "SE",
+    "SSE",
+    "S",
+    "SSW",
+    "SW",
+    "WSW",
+    "W",
+    "WNW",
+    "NW",
+    "NNW",
+]
+
+UTC = datetime.timezone.utc
+
+
+# A fix reported by gpsd. Missing values are None. The time is an aware datetime, and time_text
+# is the ISO 8601 text as reported.
+class Fix:
+    __slots__ = ["time", "time_text", "lat", "lon", "alt", "speed", "track", "ept"]
+
+    def __init__(self, time, time_text, lat, lon, alt, speed, track, ept):
+        self.time = time
+        self.time_text = time_text
+        self.lat = lat  # degrees
+        self.lon = lon  # degrees
+        self.alt = alt  # meters
+        self.speed = speed  # meters per second
+        self.track = track  # degrees from true north
+        self.ept = ept  # estimated timestamp error in seconds
+
+
+# Parse the ISO 8601 time of gpsd such as "2022-02-01T12:34:56.000Z" by slicing the fixed
+# positions. Returns None if it's not in that format.
+def parse_time(text):
+    if text is None:
+        return None
+    try:
+        if len(text) < 20 or text[-1] != "Z" or text[10] != "T":
+            raise ValueError(text)
+        micro = 0
+        if len(text) > 20:
+            fraction = text[20:-1]
+            micro = int(fraction[:6].ljust(6, "0"))
+        return datetime.datetime(
+            int(text[0:4]),
+            int(text[5:7]),
+            int(text[8:10]),
+            int(text[11:13]),
+            int(text[14:16]),
+            int(text[17:19]),
+            micro,
+            UTC,
+        )
+    except ValueError:
+        try:
+            return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f%z")
+        except ValueError:
+            return None
+
+
+# Refer to the value as a float, or None if it's missing.
+def number(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Decode a report from gpsd into a Fix. Returns None if the report isn't TPV, without decoding the
+# JSON.
+def decode(report):
+    if TPV_MARKER not in report:
+        return None
+    try:
+        tpv = json.loads(report)
+    except ValueError:
+        return None
+    if tpv.get("class") != "TPV":
+        return None
+    time_text = tpv.get("time")
+    return Fix(
+        parse_time(time_text),
+        time_text,
+        number(tpv.get("lat")),
+        number(tpv.get("lon")),
+        number(tpv.get("alt")),
+        number(tpv.get("speed")),
+        number(tpv.get("track")),
+        number(tpv.get("ept")),
+    )
+
+
+# Refer to the direction of 16 points of the track in degrees.
+def direction(track):
+    return DIRECTIONS[math.ceil((track % 360 - 11.25) / 22.5) % len(DIRECTIONS)]
+
+
+# Compare the decoding with the DataStream of gps3, which is used before this module.
+def benchmark(iterations):
+    from gps3 import gps3
+
+    # the linear scan of the direction labels used with gps3
+    labels = [(i * 22.5 + 11.25, d) for i, d in enumerate(DIRECTIONS)]
+    reports = [
+        '{"class":"TPV","device":"/dev/ttyACM0","mode":3,"time":"2022-02-01T12:34:56.000Z",'
+        '"ept":0.005,"lat":35.681236,"lon":139.767125,"alt":40.125,"epx":3.2,"epy":4.1,'
+        '"epv":9.8,"track":123.4,"speed":12.345,"climb":0.1,"eps":8.2,"epc":19.6}',
+        '{"class":"SKY","device":"/dev/ttyACM0","xdop":0.66,"ydop":0.92,"vdop":1.21,'
+        '"tdop":0.85,"hdop":1.06,"gdop":1.85,"pdop":1.61,"satellites":[{"PRN":5,"el":31,'
+        '"az":86,"ss":42,"used":true},{"PRN":13,"el":49,"az":42,"ss":37,"used":true},'
+        '{"PRN":15,"el":52,"az":299,"ss":33,"used":true},{"PRN":18,"el":13,"az":170,'
+        '"ss":0,"used":false},{"PRN":20,"el":20,"az":246,"ss":25,"used":true}]}',
+    ]
+
+    def with_gps3():
+        ds = gps3.DataStream()
+        for report in reports:
+            ds.unpack(report)
+            tm = datetime.datetime.strptime(ds.TPV["time"], "%Y-%m-%dT%H:%M:%S.%f%z")
+            tm.astimezone()
+            lat, lon = float(ds.TPV["lat"]), float(ds.TPV["lon"])
+            "{}{:.4f}/{}{:.4f}".format("N", lat, "E", lon)
+            degree = float(ds.TPV["track"])
+            for max_degree, label in labels:
+                if degree <= max_degree:
+                    break
+            "{:.1f}m {:.1f}km/h".format(
+                float(ds.TPV["alt"]), float(ds.TPV["speed"]) * 3600 / 1000
+            )
+
+    def with_gpsfix():
+        for report in reports:
+            fix = decode(report)
+            if fix is None:
+                continue
+            fix.time.astimezone()
+            "{}{:.4f}/{}{:.4f}".format("N", fix.lat, "E", fix.lon)
+            direction(fix.track)
+            "{:.1f}m {:.1f}km/h".format(fix.alt, fix.speed * 3600 / 1000)
+
+    for label, func in [("gps3.DataStream", with_gps3), ("gpsfix", with_gpsfix)]:
+        elapsed = min(timeit.repeat(func, number=iterations, repeat=5))
+        print(
+            "{:<16}: {:.1f} usec per TPV+SKY reports".format(
+                label, elapsed / iterations * 1000 * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of the decoding of gpsd reports"
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        metavar="NUM",
+        type=int,
+        default=10000,
+        help="Number of iterations (default: 10000)",
+    )
+    args = parser.parse_args()
+    benchmark(args.number)
@@ -8,87 +8,51 @@ import time
 import traceback
 
 import clock
+import event
+import geocode
+import gpsfix
 import gpx
 import ivr
-import tzlocal
+import motion
+import profiling
+import telemetry
 from gps3 import gps3
 
-DIRECTION = [
-    "N",
-    "NNE",
-    "NE",
-    "ENE",
-    "E",
-    "ESE",
-    "SE",
-    "SSE",
-    "S",
-    "SSW",
-    "SW",
-    "WSW",
-    "W",
-    "WNW",
-    "NW",
-    "NNW",
-]
-
-DIRECTION_LABEL = [
-    (i * 360 / len(DIRECTION) + 360 / len(DIRECTION) / 2, d)
-    for i, d in enumerate(DIRECTION)
-]
-
-TZ = tzlocal.get_localzone()
-
 ACQUISION_INTERVAL_SECONDS = 5  # seconds
 
 
-def parse_time(tm):
-    if tm is None or tm == "n/a":
-        return None
-    tm = datetime.datetime.strptime(tm, "%Y-%m-%dT%H:%M:%S.%f%z")
-    return tm.astimezone(TZ)
-
-
 def latlon_text(ll, ne, sw):
-    if ll is None or ll == "n/a" or abs(float(ll)) <= 0.000001:
+    if ll is None or abs(ll) <= 0.000001:
         return None
     else:
-        ll = float(ll)
         return "{}{:.4f}".format(ne if ll >= 0.0 else sw, abs(ll))
 
 
 def altitude_text(alt):
-    if alt is not None and alt != "n/a":
-        alt = float(alt)
+    if alt is not None:
         return "{:.1f}m".format(alt)
     else:
         return None
 
 
 def speed_text(speed):
-    if speed is not None and speed != "n/a":
-        speed = float(speed) * 3600 / 1000
-        return "{:.1f}km/h".format(speed)
+    if speed is not None:
+        return "{:.1f}km/h".format(speed * 3600 / 1000)
     else:
         return None
 
 
 def direction(dir):
-    if dir is not None and dir != "n/a":
-        degree = float(dir)
-        dir = DIRECTION[0]
-        for max_degree, label in DIRECTION_LABEL:
-            if degree <= max_degree:
-                dir = label
-                break
-        return "{:>3}".format(label)
+    if dir is not None:
+        return "{:>3}".format(gpsfix.direction(dir))
     else:
         return None
 
 
+@profiling.timed
 def position(socket):
     # see also: https://gpsd.gitlab.io/gpsd/gpsd_json.html
-    ds = gps3.DataStream()
+    fix = None
     delta, lat, lon, alt, dir, speed = None, None, None, None, None, None
     time_detected = 0
     time_not_available = 0
@@ -96,26 +60,25 @@ def position(socket):
     for new_data in socket:
         now = datetime.datetime.now()
         if new_data:
-            ds.unpack(new_data)
-            tm = ds.TPV["time"]
-            gps_time = parse_time(tm)
-            if gps_time is not None:
-                delta = gps_time - now.astimezone(TZ)
-                lat = latlon_text(ds.TPV["lat"], "N", "S") if lat is None else lat
-                lon = latlon_text(ds.TPV["lon"], "E", "W") if lon is None else lon
-                alt = altitude_text(ds.TPV["alt"]) if alt is None else alt
-                dir = direction(ds.TPV["track"]) if dir is None else dir
-                speed = speed_text(ds.TPV["speed"]) if speed is None else speed
+            current = gpsfix.decode(new_data)
+            if current is None:
+                # not TPV
+                continue
+            fix = current
+            if fix.time is not None:
+                delta = fix.time - now.astimezone()
+                lat = latlon_text(fix.lat, "N", "S") if lat is None else lat
+                lon = latlon_text(fix.lon, "E", "W") if lon is None else lon
+                alt = altitude_text(fix.alt) if alt is None else alt
+                dir = direction(fix.track) if dir is None else dir
+                speed = speed_text(fix.speed) if speed is None else speed
                 time_not_available = 0
                 time_detected += 1
-            elif tm is not None:
-                # if TPV.time presents but the value is "n/a"
+            else:
+                # if TPV presents without time
                 time_not_available += 1
                 if time_not_available >= 3:
                     break
-            else:
-                # probably it was not TPV
-                continue
 
             # finish if enough data has been acquired or the specified number of times has been exceeded.
             if (
@@ -138,12 +101,30 @@ def position(socket):
     dir = "---" if dir is None else dir
     speed = "--.-km/h" if speed is None else speed
     pos = "{}/{}  {}  {}:{}".format(lat, lon, alt, dir, speed)
-    return (delta, pos, ds)
+    return (delta, pos, fix)
+
+
+# Trigger an event if the speed drops suddenly, such as a collision.
+# The speed_drop is the decrease in km/h within the interval between two fixes.
+def detect_sudden_stop(now, fix, speed_drop):
+    speed = telemetry.parse_float(fix.speed) * 3600 / 1000
+    last = detect_sudden_stop.last
+    detect_sudden_stop.last = (now, speed)
+    if speed_drop is None or last is None or speed != speed:  # NaN
+        return
+    elapsed = (now - last[0]).total_seconds()
+    if elapsed <= ACQUISION_INTERVAL_SECONDS * 2 and last[1] - speed >= speed_drop:
+        reason = "speed dropped from {:.1f}km/h to {:.1f}km/h".format(last[1], speed)
+        if not event.notify(reason):
+            ivr.log("WARN: event service is not available: {}".format(reason))
+
+
+detect_sudden_stop.last = None
 
 
 # Start GPS positioning.
 # This function writes the information obtained from the GPS to the specified file.
-def start_gps_recording(file, logdir, clock_adjust):
+def start_gps_recording(file, logdir, clock_adjust, speed_drop=None, gazetteer=None):
     ivr.log("start gps logging service: {}".format(file))
 
     ivr.write(file, "Connecting GPSd...")
@@ -152,51 +133,72 @@ def start_gps_recording(file, logdir, clock_adjust):
     socket.watch()
 
     ivr.write(file, "Detecting GPS device...")
-    delta = datetime.timedelta()
-    ept = 0.0
-    while True:
-        localtime_trusted = clock.can_localtime_trust()
-
-        # obtain gps position
-        current_delta, text, ds = position(socket)
-        if current_delta is not None:
-            delta = current_delta
-
-        # save the track log
-        if ds is not None:
-            gpx.add_track_log(logdir, datetime.datetime.now(), ds)
-
-        # to reduce the load, a few seconds are slipped without actually being acquired from GPS
-        for i in range(ACQUISION_INTERVAL_SECONDS):
-            now = datetime.datetime.now()
-            if localtime_trusted:
-                tm_text = now.strftime("%F %T")
-            else:
-                now = now + delta
-                tm_text = now.strftime("%F %T")
-                if ept >= 1.0:
-                    tm_text = "{}±{}".format(tm_text, int(ept))
-                if current_delta is None:
-                    tm_text = "{}*".format(tm_text)
-            try:
-                ivr.write(file, "{} {}".format(tm_text, text))
-            except FileNotFoundError:
-                # TODO: The cause is unknown, but occurs rarely
-                # FileNotFoundError: [Errno 2] No such file or directory: '/opt/ivr/tmp/telop.txt.tmp'
-                ivr.log("WARN: fail to write GPS position")
-
-            if i == 0 and clock_adjust and not localtime_trusted:
-                if ds is not None and ds.TPV["ept"] is not None:
-                    ept = float(ds.TPV["ept"])
-                    if current_delta is not None:
-                        if clock.correct_local_time(current_delta, ept):
-                            delta = datetime.timedelta()
-
-            tm = datetime.datetime(now.year, now.month, now.day, now.hour, now.minute)
-            tm = tm + datetime.timedelta(seconds=1)
-            interval = (tm - datetime.datetime.now()).microseconds / 1000 / 1000
-            if interval > 0:
-                time.sleep(interval)
+    tlm = telemetry.TelemetryWriter()
+    try:
+        delta = datetime.timedelta()
+        ept = 0.0
+        while True:
+            localtime_trusted = clock.can_localtime_trust()
+
+            # obtain gps position
+            current_delta, text, fix = position(socket)
+            if current_delta is not None:
+                delta = current_delta
+
+            # append the name of the nearest place to the telop
+            if gazetteer is not None and fix is not None and fix.lat is not None:
+                place = gazetteer.lookup(fix.lat, fix.lon)
+                if place is not None:
+                    text = "{} {}".format(text, place)
+
+            # share the motion state with the recorder
+            speed = None if fix is None else telemetry.parse_float(fix.speed)
+            motion.update(None if speed is None else speed * 3600 / 1000)
+            stationary = motion.update.since is not None
+
+            # save the track log and the telemetry of the footage being recorded
+            if fix is not None:
+                now = datetime.datetime.now()
+                gpx.add_track_log(logdir, now, fix)
+                tlm.add(now, fix, localtime_trusted)
+                detect_sudden_stop(now, fix, speed_drop)
+
+            # to reduce the load, a few seconds are slipped without actually being acquired from GPS,
+            # but not while stationary so that the recorder can notice the start of movement quickly
+            for i in range(1 if stationary else ACQUISION_INTERVAL_SECONDS):
+                now = datetime.datetime.now()
+                if localtime_trusted:
+                    tm_text = now.strftime("%F %T")
+                else:
+                    now = now + delta
+                    tm_text = now.strftime("%F %T")
+                    if ept >= 1.0:
+                        tm_text = "{}±{}".format(tm_text, int(ept))
+                    if current_delta is None:
+                        tm_text = "{}*".format(tm_text)
+                try:
+                    ivr.write(file, "{} {}".format(tm_text, text))
+                except FileNotFoundError:
+                    # TODO: The cause is unknown, but occurs rarely
+                    # FileNotFoundError: [Errno 2] No such file or directory: '/opt/ivr/tmp/telop.txt.tmp'
+                    ivr.log("WARN: fail to write GPS position")
+
+                if i == 0 and clock_adjust and not localtime_trusted:
+                    if fix is not None and fix.ept is not None:
+                        ept = fix.ept
+                        if current_delta is not None:
+                            if clock.correct_local_time(current_delta, ept):
+                                delta = datetime.timedelta()
+
+                tm = datetime.datetime(
+                    now.year, now.month, now.day, now.hour, now.minute
+                )
+                tm = tm + datetime.timedelta(seconds=1)
+                interval = (tm - datetime.datetime.now()).microseconds / 1000 / 1000
+                if interval > 0:
+                    time.sleep(interval)
+    finally:
+        tlm.flush()
     return
 
 
@@ -226,9 +228,23 @@ if __name__ == "__main__":
         action="store_true",
         help="Set the GPS time to system clock if the time isn't sync with NTPd (default: false)",
     )
+    parser.add_argument(
+        "-e",
+        "--event-speed-drop",
+        metavar="KMH",
+        type=float,
+        help="Trigger an event when the speed drops by this km/h between fixes (default: disabled)",
+    )
+    parser.add_argument(
+        "-g",
+        "--gazetteer-index",
+        metavar="FILE",
+        help="Index built by geocode.py to show the nearest place name in the telop (default: none)",
+    )
 
     try:
         ivr.save_pid()
+        profiling.start()
 
         # register SIGTERM handler
         signal.signal(signal.SIGTERM, ivr.term_handler)
@@ -238,8 +254,15 @@ if __name__ == "__main__":
         file = args.output
         dir = args.dir
         clock_adjust = args.clock_adjust
+        speed_drop = args.event_speed_drop
+        gazetteer = None
+        if args.gazetteer_index is not None:
+            try:
+                gazetteer = geocode.Gazetteer(args.gazetteer_index)
+            except (OSError, ValueError) as e:
+                ivr.log("WARN: the gazetteer index is not available: {}".format(e))
 
-        start_gps_recording(file, dir, clock_adjust)
+        start_gps_recording(file, dir, clock_adjust, speed_drop, gazetteer)
 
     except ivr.TermException as e:
         ivr.log("IVR terminates the GPS logging")
@@ -2,18 +2,17 @@ import fcntl
 import os
 
 import ivr
+import profiling
 
 
 # Add GPS positioning information to the track log file.
-def add_track_log(dir, now, ds):
+@profiling.timed
+def add_track_log(dir, now, fix):
     file_name = ivr.tracklog_file_name(now, 0)
     file = os.path.join(dir, file_name)
 
-    def parse_float(x):
-        return None if x is None or x == "n/a" else float(x)
-
-    lat = parse_float(ds.TPV["lat"])
-    lon = parse_float(ds.TPV["lon"])
+    lat = fix.lat
+    lon = fix.lon
     if lat is None or lon is None or abs(lat) < 0.000001 or abs(lon) < 0.000001:
         return
 
@@ -37,9 +36,9 @@ def add_track_log(dir, now, ds):
                     file, ivr.with_aux_unit(size)
                 )
             )
-            return add_track_log(dir, now, ds)
+            return add_track_log(dir, now, fix)
 
-        f.write(gpx_track(lat, lon, ds).encode("utf-8"))
+        f.write(gpx_track(lat, lon, fix).encode("utf-8"))
         f.write(gpx_trailer().encode("utf-8"))
         f.truncate(f.tell())
         f.flush()
@@ -112,18 +111,18 @@ def gpx_header(tm):
     )
 
 
-def gpx_track(lat, lon, ds):
+def gpx_track(lat, lon, fix):
     def attr(name, value):
         return (
             ""
-            if value is None or value == "n/a"
+            if value is None
             else "\n        <{0}>{1}</{0}>".format(name, value)
         )
 
     return """  <trkpt lat="{}" lon="{}">{}{}
       </trkpt>
     """.format(
-        lat, lon, attr("ele", ds.TPV["alt"]), attr("time", ds.TPV["time"])
+        lat, lon, attr("ele", fix.alt), attr("time", fix.time_text)
     )
 
 
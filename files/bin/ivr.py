@@ -1,11 +1,16 @@
 import datetime
 import fcntl
+import gzip
 import os
 import re
+import shutil
+import socket
 import subprocess
 import sys
 import time
 
+import profiling
+
 DEFAULT_TELOP = "iVR 1.0"
 
 
@@ -52,18 +57,38 @@ def without_aux_unit(num):
     return float(num.replace(",", "")) * multi
 
 
-FOOTAGE_FILE_PATTERN = r"footage-(\d{6})-(\d{4})(\d{2})(\d{2})(\d{2})\.[a-zA-Z0-9]+"
-TRACKLOG_FILE_PATTERN = r"tracklog-(\d{4})(\d{2})(\d{2})\.gpx"
-IVRLOG_FILE_PATTERN = r"ivr-(\d{4})(\d{2})(\d{2})\.log"
+# The footage of the secondary cameras has the camera name after the date (see record.py --camera).
+FOOTAGE_FILE_PATTERN = r"footage-(\d{6})-(\d{4})(\d{2})(\d{2})(\d{2})(?:-([a-zA-Z0-9]+))?\.[a-zA-Z0-9]+"
+TRACKLOG_FILE_PATTERN = r"tracklog-(\d{4})(\d{2})(\d{2})\.gpx(\.gz)?"
+IVRLOG_FILE_PATTERN = r"ivr-(\d{4})(\d{2})(\d{2})\.log(\.gz)?"
+
+# Extension of the log and tracklog files that have been compressed after their day.
+COMPRESSED_FILE_EXT = "gz"
+EVENT_FILE_PATTERN = r"event-(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})(\d{2})\.[a-zA-Z0-9]+"
 
 
-# Generate a footage file name from the specified date and sequence number.
-def footage_file_name(date, sequence, extension):
+# Generate a footage file name from the specified date and sequence number. The camera is the name
+# of the secondary camera, or None for the primary camera.
+def footage_file_name(date, sequence, extension, camera=None):
     date_part = date.strftime("%Y%m%d%H")
     seq_part = "{:06d}".format(sequence % 1000000)
+    if camera is not None:
+        date_part += "-" + camera
     return "footage-%s-%s.%s" % (seq_part, date_part, extension)
 
 
+# Pattern of the footage file names of the specified camera, or of the primary camera if None.
+def camera_footage_pattern(camera=None):
+    suffix = "" if camera is None else "-({})".format(re.escape(camera))
+    return r"footage-(\d{6})-(\d{4})(\d{2})(\d{2})(\d{2})" + suffix + r"\.[a-zA-Z0-9]+"
+
+
+# Refer to the name of the camera that recorded the footage file, or None for the primary camera.
+def footage_camera(file):
+    m = re.fullmatch(FOOTAGE_FILE_PATTERN, os.path.basename(file))
+    return None if m is None else m.group(6)
+
+
 # Generate a track-log file name from the specified date and sequence number.
 def tracklog_file_name(date, sequence):
     date_part = date.strftime("%Y%m%d")
@@ -71,7 +96,27 @@ def tracklog_file_name(date, sequence):
     return "tracklog-%s%s.gpx" % (date_part, seq_part)
 
 
+# Refer to the file with the specified extension that accompanies the footage file, such as
+# subtitles. Sidecar files share the base name with the footage so that they can be kept or deleted
+# together with it.
+def footage_sidecar_file(footage, extension):
+    return "%s.%s" % (os.path.splitext(footage)[0], extension)
+
+
+# Generate an event clip file name from the specified date.
+def event_file_name(date, extension):
+    return "event-%s.%s" % (date.strftime("%Y%m%d%H%M%S"), extension)
+
+
+# Open the text file for reading. The file compressed after its day is decompressed transparently.
+def open_text(file):
+    if file_extension(file) == "." + COMPRESSED_FILE_EXT:
+        return gzip.open(file, mode="rt", encoding="utf-8")
+    return open(file, mode="r", encoding="utf-8")
+
+
 # Perform an atomic update to the specified file.
+@profiling.timed
 def write(file, text):
     i = 0
     file_not_found_error = 0
@@ -132,22 +177,74 @@ def execute(cmd):
     return ret.stdout.decode("utf-8")
 
 
-# Notify the user of the specified text.
+# Lower the CPU and I/O priority of the process so that its disk access doesn't disturb the
+# recording. The I/O scheduling class is set to idle, which only gets the disk time that no other
+# process needs. Threads started after this call inherit the priorities.
+def lower_priority(pid=None):
+    if pid is None:
+        pid = os.getpid()
+    os.setpriority(os.PRIO_PROCESS, pid, 10)
+    try:
+        execute(["ionice", "-c", "3", "-p", str(pid)])
+    except FileNotFoundError:
+        log("WARN: ionice is not available, I/O priority is not lowered")
+
+
+# Prefix the command so that it runs at the lowest CPU and idle I/O priority.
+def low_priority_command(command):
+    prefix = ["nice", "-n", "19"]
+    if shutil.which("ionice") is not None:
+        prefix.extend(["ionice", "-c", "3"])
+    return prefix + command
+
+
+# Command to synthesize the speech of notifications.
+ESPEAK_COMMAND = ["espeak-ng", "-p", "30", "-g", "11"]
+
+
+# Refer to the sound to be played before the speech of notifications. The speech is prefixed with
+# "notice" if it doesn't exist.
+def announce_file():
+    return os.path.join(bin_dir(), "announce.wav")
+
+
+# Refer to the text to be spoken for the notification. It's prefixed with "notice" only if there is
+# no announce sound to be played before it.
+def speech_text(speech):
+    if os.path.isfile(announce_file()):
+        return speech
+    return "notice, {}".format(speech)
+
+
+# Notify the user of the specified text. The text is sent to the notification service, which plays
+# the notifications one by one. If the service isn't running, the announce sound and the speech are
+# played directly.
 def beep(speech):
-    cmd = ""
-    announce = os.path.join(bin_dir(), "announce.wav")
-    if os.path.isfile(announce):
-        cmd += "aplay {}; ".format(announce)
-    else:
-        speech = "notice, {}".format(speech)
-    if len(speech) != 0:
-        cmd += 'espeak-ng -p 30 -g 11 "{}"'.format(speech)
-    subprocess.Popen(
-        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True
-    )
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(speech.encode("utf-8"), notify_socket_file())
+        return
+    except OSError:
+        pass
+    text = speech_text(speech)
+    command = [] if len(text) == 0 else ESPEAK_COMMAND + [text]
+    if os.path.isfile(announce_file()):
+        # the sound and the speech are passed as the arguments, not in the script
+        script = 'aplay "$0"; [ $# -eq 0 ] || exec "$@"'
+        command = ["sh", "-c", script, announce_file()] + command
+    try:
+        subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        pass
 
 
 # Output the specified message as log to the standard output.
+@profiling.timed
 def log(msg):
     now = datetime.datetime.now()
     log_file = "ivr-%s.log" % now.strftime("%Y%m%d")
@@ -195,3 +292,34 @@ def data_dir():
 # Refer to the text file to overlay on the footage
 def telop_file():
     return os.path.join(temp_dir(), "telop.txt")
+
+
+# Refer to the file that contains the footage file currently being recorded and its start time,
+# by the specified secondary camera or by the primary camera if None.
+def segment_file(camera=None):
+    if camera is not None:
+        return os.path.join(temp_dir(), "segment-{}.txt".format(camera))
+    return os.path.join(temp_dir(), "segment.txt")
+
+
+# Refer to the latest-frame snapshot written by the specified secondary camera or by the primary
+# camera if None.
+def snapshot_file(camera=None):
+    if camera is not None:
+        return os.path.join(temp_dir(), "snapshot-{}.jpg".format(camera))
+    return os.path.join(temp_dir(), "snapshot.jpg")
+
+
+# Refer to the directory where the segments of live streaming are written.
+def live_dir():
+    return os.path.join(temp_dir(), "live")
+
+
+# Refer to the socket file that receives the notifications.
+def notify_socket_file():
+    return os.path.join(temp_dir(), "notify.sock")
+
+
+# Refer to the socket file that receives the event triggers.
+def event_socket_file():
+    return os.path.join(temp_dir(), "event.sock")
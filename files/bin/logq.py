@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+#
+# Query the log files of iVR by time range, program, level, and message. Since each daily log
+# ivr-YYYYMMDD.log is in order of time, the beginning of the range is found by a binary search on
+# the timestamp prefix of the memory-mapped file, and only the records in the range are read. The
+# compressed logs of the past days are read as a stream.
+#
+#   $ logq.py --since "2022-02-01 14:00" --until "2022-02-01 15:00" --program record
+#   $ logq.py --since 2h --level WARN
+#   $ logq.py --level ERROR --follow
+#
+import argparse
+import datetime
+import gzip
+import mmap
+import os
+import re
+import sys
+import time
+
+import ivr
+
+# Header of a log record written by ivr.log(). The message may continue over the following lines,
+# such as a traceback.
+HEADER_PATTERN = re.compile(
+    rb"\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})\] (\S+) - ", re.ASCII
+)
+
+# Length of the timestamp in the header, which can be compared as bytes.
+TIMESTAMP_LENGTH = len("YYYY-MM-DD HH:MM:SS.mmm")
+
+# Levels of the records in order of severity. The level is given by the prefix of the message, and
+# the others are INFO.
+LEVELS = ["INFO", "WARN", "ERROR"]
+
+# Formats of the time accepted by --since and --until. The date is today if omitted.
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%H:%M:%S", "%H:%M"]
+
+# Units of the relative time accepted by --since and --until, such as 30m.
+TIME_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+# Size of the blocks in which a compressed log file is read.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Interval to check the appended records in --follow.
+FOLLOW_INTERVAL_SECONDS = 0.5
+
+
+# Parse the time of --since and --until as a local datetime. A relative time such as "2h" is
+# before now.
+def parse_time(text):
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", text.strip())
+    if m is not None:
+        seconds = float(m.group(1)) * TIME_UNITS[m.group(2)]
+        return datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+    for format in TIME_FORMATS:
+        try:
+            tm = datetime.datetime.strptime(text, format)
+        except ValueError:
+            continue
+        if "%Y" not in format:
+            today = datetime.date.today()
+            tm = tm.replace(year=today.year, month=today.month, day=today.day)
+        return tm
+    raise ValueError("invalid time: {}".format(text))
+
+
+# Refer to the timestamp of the datetime as in the header of the log records.
+def timestamp(tm):
+    return tm.strftime("%Y-%m-%d %H:%M:%S.%f")[:TIMESTAMP_LENGTH].encode("ascii")
+
+
+# Refer to the log files in the directory whose day overlaps the range, in order of date.
+def log_files(dir, since=None, until=None):
+    files = []
+    for f in os.listdir(dir):
+        m = re.fullmatch(ivr.IVRLOG_FILE_PATTERN, f)
+        if m is None:
+            continue
+        date = datetime.date(*[int(m.group(i)) for i in range(1, 4)])
+        if since is not None and date < since.date():
+            continue
+        if until is not None and until.date() < date:
+            continue
+        files.append((date, f))
+    files.sort()
+    return [os.path.join(dir, f) for _, f in files]
+
+
+# Refer to the position of the first record header at or after the position, or the end.
+def record_start(buffer, position):
+    if position == 0:
+        if HEADER_PATTERN.match(buffer, 0):
+            return 0
+        position = 1
+    while True:
+        i = buffer.find(b"\n", position - 1)
+        if i < 0 or i + 1 >= len(buffer):
+            return len(buffer)
+        if HEADER_PATTERN.match(buffer, i + 1):
+            return i + 1
+        position = i + 2
+
+
+# Refer to the position of the last record header in the buffer, or 0.
+def last_record_start(buffer):
+    i = len(buffer)
+    while True:
+        i = buffer.rfind(b"\n[", 0, i)
+        if i < 0:
+            return 0
+        if HEADER_PATTERN.match(buffer, i + 1):
+            return i + 1
+
+
+# Refer to the position of the first record whose timestamp is equal to or after the key, by a
+# binary search over the records.
+def lower_bound(buffer, key):
+    lo, hi = 0, len(buffer)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = record_start(buffer, mid)
+        if (
+            start < len(buffer)
+            and buffer[start + 1 : start + 1 + TIMESTAMP_LENGTH] < key
+        ):
+            lo = start + 1
+        else:
+            hi = mid
+    return record_start(buffer, lo)
+
+
+# A filter of the records by the programs, the minimum level and the pattern of the message. The
+# programs and the level are matched with the headers by a regular expression, so that the records
+# that don't match aren't handled one by one.
+class RecordFilter:
+    def __init__(self, programs, level, pattern):
+        names = set()
+        for program in programs:
+            names.update([program, "{}.py".format(program)])
+        names = [re.escape(x).encode("utf-8") for x in sorted(names)]
+        levels = [x.encode("ascii") for x in LEVELS[LEVELS.index(level) :]]
+        self.header = re.compile(
+            rb"^\[[^]\n]*\] "
+            + (rb"(?:" + b"|".join(names) + rb")" if len(names) != 0 else rb"\S+")
+            + rb" - "
+            + (rb"(?:" + b"|".join(levels) + rb")" if level != LEVELS[0] else b""),
+            re.MULTILINE,
+        )
+        self.pattern = None if pattern is None else re.compile(pattern)
+
+    # Refer to the records in the buffer between the positions that pass the filter, as text. The
+    # positions must be at the beginning of records.
+    def records(self, buffer, start, end):
+        for match in self.header.finditer(buffer, start, end):
+            if not HEADER_PATTERN.match(buffer, match.start()):
+                continue
+            text = buffer[match.start() : record_start(buffer, match.end())]
+            text = text.decode("utf-8", errors="replace")
+            if self.pattern is None or self.pattern.search(text.split(" - ", 1)[1]):
+                yield text
+
+
+# Read the records in the log file between the timestamps that pass the filter, in constant memory.
+# A log file is memory-mapped and the range is found by a binary search. A compressed one is read
+# block by block, since it can't be mapped.
+def read_records(file, since, until, record_filter):
+    if ivr.file_extension(file) == "." + ivr.COMPRESSED_FILE_EXT:
+        with gzip.open(file, mode="rb") as f:
+            rest = b""
+            while True:
+                block = f.read(GZIP_BLOCK_SIZE)
+                data = rest + block
+                cut = last_record_start(data) if len(block) != 0 else len(data)
+                if cut == 0 and len(block) != 0:
+                    rest = data
+                    continue
+                data, rest = data[:cut], data[cut:]
+                start = 0 if since is None else lower_bound(data, since)
+                end = len(data) if until is None else lower_bound(data, until)
+                yield from record_filter.records(data, start, end)
+                if end < len(data) or len(block) == 0:
+                    return
+    with open(file, mode="rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = 0 if since is None else lower_bound(m, since)
+            end = len(m) if until is None else lower_bound(m, until)
+            yield from record_filter.records(m, start, end)
+
+
+# Print the records between the times that pass the filter. Returns the number of the records.
+def query(dir, since, until, record_filter, out):
+    key_since = None if since is None else timestamp(since)
+    key_until = None if until is None else timestamp(until)
+    count = 0
+    for file in log_files(dir, since, until):
+        for text in read_records(file, key_since, key_until, record_filter):
+            out.write(text)
+            count += 1
+    out.flush()
+    return count
+
+
+# Print the records appended to the log files of today and the following days. The log of today is
+# followed from its current end, and the ones of the following days from their beginning.
+def follow(dir, record_filter, out):
+    file = None
+    position = 0
+    while True:
+        today = os.path.join(dir, "ivr-{}.log".format(time.strftime("%Y%m%d")))
+        if today != file and os.path.isfile(today):
+            position = 0 if file is not None else os.path.getsize(today)
+            file = today
+        if file is not None and os.path.getsize(file) > position:
+            with open(file, mode="rb") as f:
+                f.seek(position)
+                data = f.read()
+            # each record is appended at once, so only the last line may be incomplete
+            data = data[: data.rfind(b"\n") + 1]
+            position += len(data)
+            for text in record_filter.records(data, 0, len(data)):
+                out.write(text)
+            out.flush()
+        time.sleep(FOLLOW_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the log files of iVR")
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory of the log files (default: {})".format(ivr.data_dir()),
+    )
+    parser.add_argument(
+        "-s",
+        "--since",
+        metavar="TIME",
+        help="Beginning of the range, such as '2022-02-01 14:00', '14:00' or 2h (default: all)",
+    )
+    parser.add_argument(
+        "-u",
+        "--until",
+        metavar="TIME",
+        help="End of the range, exclusive, in the same format as --since (default: all)",
+    )
+    parser.add_argument(
+        "-p",
+        "--program",
+        metavar="NAME",
+        action="append",
+        default=[],
+        help="Program that wrote the records, such as record or gpslog.py (default: all)",
+    )
+    parser.add_argument(
+        "-l",
+        "--level",
+        choices=LEVELS,
+        default="INFO",
+        help="Minimum level of the records (default: INFO)",
+    )
+    parser.add_argument(
+        "-g",
+        "--grep",
+        metavar="PATTERN",
+        help="Regular expression to be searched in the messages",
+    )
+    parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="Print the records appended to the log after the query",
+    )
+    args = parser.parse_args()
+
+    try:
+        since = None if args.since is None else parse_time(args.since)
+        until = None if args.until is None else parse_time(args.until)
+    except ValueError as e:
+        parser.error(str(e))
+    record_filter = RecordFilter(args.program, args.level, args.grep)
+
+    try:
+        query(args.dir, since, until, record_filter, sys.stdout)
+        if args.follow:
+            follow(args.dir, record_filter, sys.stdout)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
@@ -0,0 +1,61 @@
+#
+# Motion state of the vehicle determined from GPS speed, shared between processes via a file.
+#
+import os
+import time
+
+import ivr
+
+# Speed below which the vehicle is considered to be stationary, in km/h. GPS reports a few km/h
+# of speed even when the receiver isn't moving.
+STATIONARY_SPEED_KMH = 3.0
+
+# Seconds after which the motion state is considered unknown if it isn't updated.
+EXPIRATION_SECONDS = 30
+
+
+# Refer to the file that contains the motion state.
+def motion_file():
+    return os.path.join(ivr.temp_dir(), "motion.txt")
+
+
+# Update the motion state with the speed in km/h. The speed should be None or NaN if unknown.
+def update(speed):
+    now = time.time()
+    if speed is None or speed != speed:
+        update.since = None
+        text = "unknown"
+    elif speed < STATIONARY_SPEED_KMH:
+        update.since = now if update.since is None else update.since
+        text = "stationary {}".format(update.since)
+    else:
+        update.since = None
+        text = "moving"
+    if text != update.last or now - update.last_write >= EXPIRATION_SECONDS / 3:
+        ivr.write(motion_file(), text)
+        update.last = text
+        update.last_write = now
+
+
+update.since = None
+update.last = None
+update.last_write = 0
+
+
+# Refer to the number of seconds the vehicle has been stationary. Returns 0 if it's moving, or
+# None if it's unknown such as GPS isn't available.
+def stationary_seconds():
+    file = motion_file()
+    try:
+        if time.time() - os.stat(file).st_mtime > EXPIRATION_SECONDS:
+            return None
+        with open(file, mode="r") as f:
+            state = f.read().split()
+    except FileNotFoundError:
+        return None
+    if len(state) == 2 and state[0] == "stationary":
+        return max(0.0, time.time() - float(state[1]))
+    elif len(state) == 1 and state[0] == "moving":
+        return 0.0
+    return None
+
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Notification service that speaks the messages sent by ivr.beep() from the other processes. Each
+# distinct phrase is synthesized only once and cached as WAV in the temporary directory, and the
+# notifications are played one by one through a single long-lived aplay process, so that they
+# don't play over each other and no shell is spawned per notification.
+#
+import argparse
+import collections
+import hashlib
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+import wave
+
+import ivr
+import profiling
+
+# Phrases to be synthesized at startup since they're notified frequently.
+PRERENDERED_PHRASES = ["IVR starts to recording.", "the event has been recorded"]
+
+# Maximum total size of the cached speech.
+CACHE_CAPACITY = 2 * 1024 * 1024
+
+# The same notification within these seconds after it was played is ignored.
+COALESCE_SECONDS = 5
+
+# Maximum number of notifications waiting to be played. The newer ones are dropped when it's full.
+MAX_QUEUED_NOTIFICATIONS = 8
+
+# Seconds of silence after each sound, so that aplay plays the end of the sound without waiting
+# for the next one.
+TRAILING_SILENCE_SECONDS = 0.25
+
+# Sample formats of aplay by the sample width in bytes.
+SAMPLE_FORMATS = {1: "U8", 2: "S16_LE", 4: "S32_LE"}
+
+
+# Refer to the directory where the synthesized speech is cached.
+def cache_dir():
+    return os.path.join(ivr.temp_dir(), "voice")
+
+
+# Synthesize the text into a WAV file, or refer to the cached one.
+def render(text):
+    name = "{}.wav".format(hashlib.sha1(text.encode("utf-8")).hexdigest())
+    file = os.path.join(cache_dir(), name)
+    if os.path.isfile(file):
+        os.utime(file)
+        return file
+    os.makedirs(cache_dir(), exist_ok=True)
+    temp = "{}.tmp".format(file)
+    subprocess.run(
+        ivr.ESPEAK_COMMAND + ["-w", temp, text],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    os.rename(temp, file)
+    evict_cache()
+    return file
+
+
+# Remove the least recently used speech while the cache exceeds its capacity.
+def evict_cache():
+    files = []
+    for f in os.listdir(cache_dir()):
+        file = os.path.join(cache_dir(), f)
+        stat = os.stat(file)
+        files.append((stat.st_mtime, stat.st_size, file))
+    files.sort()
+    total = sum([size for _, size, _ in files])
+    while total > CACHE_CAPACITY and len(files) > 1:
+        _, size, file = files.pop(0)
+        os.remove(file)
+        total -= size
+
+
+# A player that writes the PCM of WAV files to a single aplay process. The process is restarted
+# only when the format of the sound changes.
+class Player:
+    def __init__(self):
+        self.proc = None
+        self.format = None
+
+    def play(self, file):
+        with wave.open(file, mode="rb") as w:
+            format = (w.getframerate(), w.getnchannels(), w.getsampwidth())
+            frames = w.readframes(w.getnframes())
+        rate, channels, width = format
+        if self.proc is None or self.proc.poll() is not None or format != self.format:
+            self.close()
+            command = ["aplay", "-q", "-t", "raw", "-f", SAMPLE_FORMATS[width]]
+            command.extend(["-r", str(rate), "-c", str(channels)])
+            self.proc = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            self.format = format
+        silence = bytes(int(rate * TRAILING_SILENCE_SECONDS) * channels * width)
+        try:
+            self.proc.stdin.write(frames + silence)
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            self.close()
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(5)
+            except (BrokenPipeError, subprocess.TimeoutExpired):
+                self.proc.kill()
+            self.proc = None
+
+
+# Receive the notifications and play them one by one until terminated.
+def start_notification_service():
+    file = ivr.notify_socket_file()
+    if os.path.exists(file):
+        os.remove(file)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(file)
+    ivr.log("start notification service: {}".format(file))
+
+    for phrase in PRERENDERED_PHRASES:
+        try:
+            render(ivr.speech_text(phrase))
+        except (OSError, subprocess.CalledProcessError) as e:
+            ivr.log("WARN: failed to synthesize the speech: {}: {}".format(phrase, e))
+
+    player = Player()
+    queue = collections.deque()
+    played = {}
+    try:
+        while True:
+            timeout = 0 if len(queue) != 0 else 1.0
+            readable, _, _ = select.select([sock], [], [], timeout)
+            if len(readable) != 0:
+                speech = sock.recv(1024).decode("utf-8", errors="replace").strip()
+                elapsed = time.monotonic() - played.get(speech, -COALESCE_SECONDS)
+                if speech in queue or elapsed < COALESCE_SECONDS:
+                    continue
+                if len(queue) < MAX_QUEUED_NOTIFICATIONS:
+                    queue.append(speech)
+                continue
+
+            if len(queue) != 0:
+                speech = queue.popleft()
+                now = time.monotonic()
+                # forget the notifications that can no longer be coalesced
+                for s in [s for s, t in played.items() if now - t >= COALESCE_SECONDS]:
+                    del played[s]
+                played[speech] = now
+                try:
+                    if os.path.isfile(ivr.announce_file()):
+                        player.play(ivr.announce_file())
+                    text = ivr.speech_text(speech)
+                    if len(text) != 0:
+                        player.play(render(text))
+                except (OSError, subprocess.CalledProcessError, wave.Error) as e:
+                    ivr.log(
+                        "WARN: failed to play the notification: {}: {}".format(
+                            speech, e
+                        )
+                    )
+    finally:
+        player.close()
+        sock.close()
+        os.remove(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Speak the notifications from the other processes"
+    )
+    args = parser.parse_args()
+
+    try:
+        ivr.save_pid()
+        profiling.start()
+
+        # register SIGTERM handler
+        signal.signal(signal.SIGTERM, ivr.term_handler)
+        signal.signal(signal.SIGINT, ivr.term_handler)
+
+        start_notification_service()
+
+    except ivr.TermException as e:
+        ivr.log("IVR terminates the notification service")
+    except Exception as e:
+        t = "".join(list(traceback.TracebackException.from_exception(e).format()))
+        ivr.log("ERROR: {}".format(t))
+        ivr.log("IVR terminates the notification service by an error")
+        sys.exit(1)
+    finally:
+        ivr.remove_pid()
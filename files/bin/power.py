@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+#
+# Power-loss handling. The monitor watches the undervoltage alarms of hwmon and the state of the
+# power supplies in sysfs, and when the power is being lost, it flushes the recording to the storage
+# within a time budget, such as the hold-up time of a supercapacitor. The steps of the flush run in
+# parallel, and which of them completed within the budget is reported to data/power-flush.tsv.
+#
+#   $ power.py                 # monitor the power, started by startup.sh
+#   $ power.py --trigger       # let the running monitor flush, such as from a GPIO button
+#   $ power.py --flush         # flush now and stop the recorder, used by shutdown.sh
+#
+import argparse
+import datetime
+import fcntl
+import glob
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import ivr
+import profiling
+import telemetry
+
+# Interval to read the state of the power in sysfs.
+POLL_INTERVAL_SECONDS = 0.1
+
+# Number of consecutive polls in which the power is lost before flushing, to ignore glitches.
+POWER_LOSS_POLLS = 2
+
+# Undervoltage alarms of hwmon, such as rpi_volt of Raspberry Pi.
+UNDERVOLTAGE_ALARMS = "/sys/class/hwmon/hwmon*/in*_lcrit_alarm"
+
+# External power supplies, such as the AC adapter of a UPS HAT.
+POWER_SUPPLIES = "/sys/class/power_supply/*"
+EXTERNAL_SUPPLY_TYPES = ["Mains", "USB"]
+
+# Steps of the flush:
+#   recorder: stop FFmpeg so that it finalizes the footage, and fsync the footage
+#   tracklog: fsync the track log of today after the last track point
+#   logs:     fsync the log of today
+#   control:  fsync the sequence of the footage files and the state of the background jobs
+STEPS = ["recorder", "tracklog", "logs", "control"]
+
+# Files in the data directory that hold the state to be kept across the power loss.
+STATE_FILES = [".control", ".remux", ".retention", ".upload"]
+
+# Command to power off after the flush with --halt.
+HALT_COMMAND = ["sudo", "poweroff"]
+
+
+# Refer to the file to which the result of each flush is appended.
+def report_file(dir):
+    return os.path.join(dir, "power-flush.tsv")
+
+
+# Read a sysfs attribute as text, or None if it's not available.
+def read_attribute(file):
+    try:
+        with open(file, mode="r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# Refer to the online attributes of the external power supplies.
+def external_supplies():
+    supplies = []
+    for dir in glob.glob(POWER_SUPPLIES):
+        if read_attribute(os.path.join(dir, "type")) in EXTERNAL_SUPPLY_TYPES:
+            if read_attribute(os.path.join(dir, "online")) is not None:
+                supplies.append(os.path.join(dir, "online"))
+    return supplies
+
+
+# Refer to the reason if the power is being lost, or None. The external power supplies are only
+# considered if they were online at start, since some of them are never online.
+def power_lost(supplies):
+    for file in glob.glob(UNDERVOLTAGE_ALARMS):
+        if read_attribute(file) == "1":
+            return "undervoltage"
+    if len(supplies) != 0:
+        if all([read_attribute(file) == "0" for file in supplies]):
+            return "power supply offline"
+    return None
+
+
+# Refer to the PIDs of the running FFmpeg processes of the recorder.
+def ffmpeg_pids():
+    pids = []
+    for file in glob.glob(os.path.join(ivr.temp_dir(), "ffmpeg*.pid")):
+        pid = read_attribute(file)
+        if pid is not None and pid.isdigit():
+            pids.append(int(pid))
+    return pids
+
+
+# Returns True if the process is running.
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+# Send the signal to the process. Returns False if it's not running.
+def send_signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+# Write the file to the storage. The file is locked while syncing, so that a writer that locks it,
+# such as the track log, has completed its write.
+def fsync(file, lock=False):
+    try:
+        fd = os.open(file, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        if lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Stop FFmpeg so that it writes the index and the trailer of the footage, and fsync the footage.
+# With stop_recorder, the recorder is stopped as well, otherwise it starts a new footage file, which
+# continues the recording if the power comes back. Returns False if FFmpeg doesn't exit by the
+# deadline.
+def flush_recorder(dir, deadline, stop_recorder):
+    files = telemetry.recording_files()
+    pids = ffmpeg_pids()
+    if stop_recorder:
+        pid = read_attribute(os.path.join(ivr.temp_dir(), "record.py.pid"))
+        if pid is not None and pid.isdigit():
+            send_signal(int(pid), signal.SIGTERM)
+    pids = [pid for pid in pids if send_signal(pid, signal.SIGTERM)]
+    while any([is_running(pid) for pid in pids]):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    for f in files:
+        fsync(os.path.join(dir, f))
+    return True
+
+
+def flush_tracklog(dir):
+    fsync(os.path.join(dir, ivr.tracklog_file_name(datetime.datetime.now(), 0)), True)
+
+
+def flush_logs():
+    now = datetime.datetime.now()
+    fsync(os.path.join(ivr.data_dir(), "ivr-{}.log".format(now.strftime("%Y%m%d"))))
+
+
+def flush_control(dir):
+    for f in STATE_FILES:
+        fsync(os.path.join(dir, f))
+    fsync(dir)
+
+
+# Flush the recording to the storage within the budget in milliseconds. The steps run in parallel
+# threads, and the ones that haven't completed by the deadline are abandoned. Returns the result of
+# each step, which is "ok", "timeout", or an error, with the elapsed milliseconds.
+def flush(dir, budget, stop_recorder=False):
+    t0 = time.monotonic()
+    deadline = t0 + budget / 1000
+    results = {}
+    lock = threading.Lock()
+
+    def run(step, func, *args):
+        try:
+            status = "timeout" if func(*args) is False else "ok"
+        except Exception as e:
+            status = "error: {}".format(e)
+        with lock:
+            results[step] = (status, (time.monotonic() - t0) * 1000)
+
+    funcs = {
+        "recorder": (flush_recorder, dir, deadline, stop_recorder),
+        "tracklog": (flush_tracklog, dir),
+        "logs": (flush_logs,),
+        "control": (flush_control, dir),
+    }
+    threads = []
+    for step in STEPS:
+        thread = threading.Thread(
+            target=run, args=(step,) + funcs[step], name=step, daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+
+    with lock:
+        elapsed = (time.monotonic() - t0) * 1000
+        return {s: results.get(s, ("timeout", elapsed)) for s in STEPS}
+
+
+# Log the result of the flush and append it to the report in the data directory.
+def report(dir, reason, budget, results):
+    summary = ", ".join(
+        ["{}={} {:.0f}ms".format(s, status, ms) for s, (status, ms) in results.items()]
+    )
+    ivr.log("power flush ({}) in budget {}ms: {}".format(reason, budget, summary))
+
+    file = report_file(dir)
+    row = [time.strftime("%F %T"), reason, str(budget)]
+    for step in STEPS:
+        status, ms = results[step]
+        row.append("{:.0f}".format(ms) if status == "ok" else status.split(":")[0])
+    try:
+        with open(file, mode="a") as f:
+            if f.tell() == 0:
+                f.write("\t".join(["date", "reason", "budget"] + STEPS) + "\n")
+            f.write("\t".join(row) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        ivr.log("WARN: failed to write the power flush report: {}: {}".format(file, e))
+
+
+# A handler that requests a flush by SIGUSR2.
+def signal_handler(signum, frame):
+    signal_handler.triggered = True
+
+
+signal_handler.triggered = False
+
+
+# Monitor the power, and flush when it's being lost. The flush is done once until the power comes
+# back. With halt, the system is powered off after the flush.
+def start_power_monitor(dir, budget, halt):
+    supplies = external_supplies()
+    ivr.log(
+        "start power monitor: budget {}ms, supplies: {}".format(
+            budget, ", ".join([os.path.dirname(s) for s in supplies]) or "none"
+        )
+    )
+    polls = 0
+    flushed = False
+    while True:
+        reason = power_lost(supplies)
+        polls = 0 if reason is None else polls + 1
+        if signal_handler.triggered:
+            signal_handler.triggered = False
+            reason = "trigger"
+            polls = POWER_LOSS_POLLS
+            flushed = False
+
+        if polls >= POWER_LOSS_POLLS and not flushed:
+            flushed = True
+            results = flush(dir, budget, halt)
+            report(dir, reason, budget, results)
+            if halt:
+                ivr.log("power off after the power loss: {}".format(reason))
+                ivr.execute(HALT_COMMAND)
+        elif reason is None and flushed:
+            ivr.log("the power has come back")
+            flushed = False
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Flush the recording to the storage when the power is being lost"
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory where the footage and the other files are stored (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--budget",
+        metavar="MSEC",
+        type=int,
+        default=500,
+        help="Time budget of the flush in milliseconds, such as the hold-up time of the power (default: 500)",
+    )
+    parser.add_argument(
+        "-ha",
+        "--halt",
+        action="store_true",
+        help="Power off the system after the flush by the power loss (default: false)",
+    )
+    parser.add_argument(
+        "-f",
+        "--flush",
+        action="store_true",
+        help="Flush now and stop the recorder, and exit",
+    )
+    parser.add_argument(
+        "-t",
+        "--trigger",
+        action="store_true",
+        help="Let the running power monitor flush, and exit",
+    )
+
+    args = parser.parse_args()
+    if args.trigger:
+        pid = read_attribute(os.path.join(ivr.temp_dir(), "power.py.pid"))
+        if (
+            pid is None
+            or not pid.isdigit()
+            or not send_signal(int(pid), signal.SIGUSR2)
+        ):
+            print("ERROR: power monitor is not running")
+            sys.exit(1)
+        sys.exit(0)
+    if args.flush:
+        results = flush(args.dir, args.budget, True)
+        report(args.dir, "shutdown", args.budget, results)
+        sys.exit(0 if all([s == "ok" for s, _ in results.values()]) else 1)
+
+    try:
+        ivr.save_pid()
+        profiling.start()
+
+        # register SIGTERM handler
+        signal.signal(signal.SIGTERM, ivr.term_handler)
+        signal.signal(signal.SIGINT, ivr.term_handler)
+        signal.signal(signal.SIGUSR2, signal_handler)
+
+        start_power_monitor(args.dir, args.budget, args.halt)
+
+    except ivr.TermException as e:
+        ivr.log("IVR terminates the power monitor")
+    except Exception as e:
+        t = "".join(list(traceback.TracebackException.from_exception(e).format()))
+        ivr.log("ERROR: {}".format(t))
+        ivr.log("IVR terminates the power monitor by an error")
+        ivr.beep("power monitor has stopped due to an error")
+        sys.exit(1)
+    finally:
+        ivr.remove_pid()
@@ -0,0 +1,160 @@
+#
+# I/O pressure on the recording, shared between processes via a file. Background jobs that access
+# the same storage check it so that they don't get in the way of the recorder.
+#
+import os
+import signal
+import subprocess
+import tempfile
+import time
+
+import ivr
+import telemetry
+
+# Seconds after which the recorder metrics are considered stale.
+EXPIRATION_SECONDS = 5
+
+# Seconds that the recorder may fall behind the real time before it's considered under pressure.
+DELAY_THRESHOLD_SECONDS = 1.0
+
+# Share of time in which some tasks were stalled on I/O in the last 10 seconds, in percent, above
+# which the system is considered under pressure (see /proc/pressure/io).
+PSI_THRESHOLD = 10.0
+
+# Interval to check the pressure while a background job is running or waiting.
+CHECK_INTERVAL_SECONDS = 2
+
+# Keys of the FFmpeg progress report to be saved as the recorder metrics.
+METRIC_KEYS = ["frame", "fps", "drop_frames", "dup_frames", "speed"]
+
+
+# Refer to the file that contains the latest metrics of the recorder of the specified secondary
+# camera, or of the primary camera if None.
+def recorder_metrics_file(camera=None):
+    if camera is not None:
+        return os.path.join(ivr.temp_dir(), "recorder-{}.txt".format(camera))
+    return os.path.join(ivr.temp_dir(), "recorder.txt")
+
+
+# Read the progress reports of FFmpeg (-progress) from the stream and save the latest one as the
+# recorder metrics until the stream is closed. The delay is how many seconds the output has fallen
+# behind the real time since the recorder was keeping up the best, which grows when FFmpeg can't
+# write the footage fast enough. The on_first_frame is called once when the first frame has been
+# output.
+def save_recorder_metrics(stream, on_first_frame=None, camera=None):
+    file = recorder_metrics_file(camera)
+    start = time.monotonic()
+    lag = None
+    metrics = {}
+    try:
+        for line in stream:
+            key, _, value = line.strip().partition("=")
+            metrics[key] = value
+            if key != "progress":
+                continue
+            try:
+                out_time = int(metrics.get("out_time_us", "")) / 1000 / 1000
+            except ValueError:
+                continue
+            current = time.monotonic() - start - out_time
+            lag = current if lag is None else min(lag, current)
+            values = ["{}={}".format(k, metrics.get(k, "")) for k in METRIC_KEYS]
+            values.append("delay={:.3f}".format(current - lag))
+            ivr.write(file, "\n".join(values))
+            frame = metrics.get("frame", "")
+            if on_first_frame is not None and frame not in ["", "0"]:
+                on_first_frame()
+                on_first_frame = None
+    finally:
+        stream.close()
+        if os.path.isfile(file):
+            os.remove(file)
+
+
+# Refer to the latest metrics of the recorder as a dict. Returns None if the recorder isn't
+# reporting.
+def recorder_metrics():
+    file = recorder_metrics_file()
+    try:
+        if time.time() - os.stat(file).st_mtime > EXPIRATION_SECONDS:
+            return None
+        with open(file, mode="r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    return dict([line.partition("=")[::2] for line in lines])
+
+
+# Refer to the share of time in which some tasks were stalled on I/O in the last 10 seconds, in
+# percent. Returns None if the kernel doesn't support PSI.
+def system_io_pressure():
+    try:
+        with open("/proc/pressure/io", mode="r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 0 and fields[0] == "some":
+                    return float(dict(x.split("=") for x in fields[1:])["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+# Returns the reason if the recording is under I/O pressure, or None if it isn't.
+def under_pressure():
+    metrics = recorder_metrics()
+    if metrics is None:
+        if telemetry.current_segment() is not None:
+            return "recorder isn't reporting"
+    else:
+        try:
+            delay = float(metrics.get("delay", ""))
+            if delay > DELAY_THRESHOLD_SECONDS:
+                return "recorder delay {:.1f} sec".format(delay)
+        except ValueError:
+            pass
+    psi = system_io_pressure()
+    if psi is not None and psi > PSI_THRESHOLD:
+        return "I/O pressure {:.1f}%".format(psi)
+    return None
+
+
+# Run the command at the lowest CPU and idle I/O priority. It waits to start and is paused while
+# the check returns a reason, such as I/O pressure on the recording. The process is passed to
+# on_start so that the caller can terminate it. Returns the exit code and the standard error, which
+# is buffered in a temporary file in tmpfs so that a verbose command doesn't block on a full pipe.
+def run_low_priority(command, label, check=under_pressure, on_start=None):
+    reason = check()
+    if reason is not None:
+        ivr.log("wait for {}: {}".format(label, reason))
+        while check() is not None:
+            time.sleep(CHECK_INTERVAL_SECONDS)
+
+    errors = tempfile.TemporaryFile(dir=ivr.temp_dir())
+    proc = subprocess.Popen(
+        ivr.low_priority_command(command),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=errors,
+    )
+    if on_start is not None:
+        on_start(proc)
+    paused = False
+    while True:
+        try:
+            proc.wait(CHECK_INTERVAL_SECONDS)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        reason = check()
+        if reason is not None and not paused:
+            ivr.log("pause {}: {}".format(label, reason))
+            proc.send_signal(signal.SIGSTOP)
+            paused = True
+        elif reason is None and paused:
+            ivr.log("resume {}".format(label))
+            proc.send_signal(signal.SIGCONT)
+            paused = False
+    with errors:
+        errors.seek(0)
+        stderr = errors.read().decode("utf-8", errors="replace")
+    return (proc.returncode, stderr)
@@ -0,0 +1,254 @@
+#
+# Opt-in profiling of the long-running processes in the field. It's enabled by the environment
+# variable IVR_PROFILE, such as IVR_PROFILE=cpu,memory, and does nothing otherwise:
+#   cpu:    sample the stacks of all threads periodically, which costs about 1% of the CPU
+#   memory: trace the memory allocations by tracemalloc, which slows down the allocations
+# The hot-path timers decorated by @timed are enabled whenever IVR_PROFILE is set. The profile is
+# dumped into the data directory every IVR_PROFILE_INTERVAL seconds (default 600), on SIGUSR1, and
+# at exit.
+#
+# NOTE: This module doesn't import ivr at the top level since ivr uses @timed.
+#
+import atexit
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+# Environment variables to enable the profiling and to specify the interval of dumps.
+PROFILE_ENV = "IVR_PROFILE"
+INTERVAL_ENV = "IVR_PROFILE_INTERVAL"
+
+# Profiles enabled by IVR_PROFILE. "all" enables all of them.
+PROFILES = ["cpu", "memory"]
+
+DEFAULT_INTERVAL_SECONDS = 10 * 60
+
+# Name of the threads of the profiler, which are excluded from the samples.
+THREAD_NAME = "profiling"
+
+# Interval to sample the stacks of the threads.
+SAMPLE_INTERVAL_SECONDS = 0.02
+
+# Maximum depth of the sampled stacks, from the innermost frame.
+MAX_STACK_DEPTH = 32
+
+# Number of stacks, allocation sites and memory growths in each dump.
+TOP_STACKS = 100
+TOP_ALLOCATIONS = 30
+
+# Total size of the profile files in the data directory. The oldest ones are removed beyond this.
+PROFILE_CAPACITY = 8 * 1024 * 1024
+
+# Pattern of the profile file names.
+PROFILE_FILE_PREFIX = "profile-"
+PROFILE_FILE_EXT = "txt"
+
+
+# Refer to the profiles enabled by the environment variable, or an empty list if it's disabled.
+def enabled_profiles():
+    value = os.environ.get(PROFILE_ENV, "").strip()
+    if len(value) == 0:
+        return []
+    names = [x.strip() for x in value.split(",")]
+    if "all" in names or "1" in names:
+        return list(PROFILES)
+    return [x for x in PROFILES if x in names]
+
+
+ENABLED = len(os.environ.get(PROFILE_ENV, "").strip()) != 0
+
+# Count, total seconds and maximum seconds of each timer since the last dump.
+timers = {}
+timers_lock = threading.Lock()
+
+# Number of samples of each stack since the last dump.
+samples = {}
+samples_lock = threading.Lock()
+
+
+# Decorator that measures the time of each call of the function when the profiling is enabled.
+# The function is returned as is otherwise, so that it costs nothing.
+def timed(func):
+    if not ENABLED:
+        return func
+    name = "{}.{}".format(func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t0
+            with timers_lock:
+                count, total, longest = timers.get(name, (0, 0.0, 0.0))
+                timers[name] = (count + 1, total + elapsed, max(longest, elapsed))
+
+    return wrapper
+
+
+# Start the profiling of this process if it's enabled. This must be called from the main thread
+# since it registers the SIGUSR1 handler.
+def start():
+    if not ENABLED:
+        return
+    profiles = enabled_profiles()
+    try:
+        interval = float(os.environ.get(INTERVAL_ENV, DEFAULT_INTERVAL_SECONDS))
+    except ValueError:
+        interval = DEFAULT_INTERVAL_SECONDS
+
+    if "memory" in profiles and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if "cpu" in profiles:
+        threading.Thread(target=sample_stacks, name=THREAD_NAME, daemon=True).start()
+
+    start.requested = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: start.requested.set())
+    threading.Thread(
+        target=dump_periodically, args=(interval,), name=THREAD_NAME, daemon=True
+    ).start()
+    atexit.register(dump)
+
+    import ivr
+
+    ivr.log("profiling enabled: {} every {} sec".format(",".join(profiles), interval))
+
+
+start.requested = None
+
+
+# Dump the profile every interval seconds, or when requested by SIGUSR1.
+def dump_periodically(interval):
+    while True:
+        start.requested.wait(interval)
+        start.requested.clear()
+        dump()
+
+
+# Sample the stacks of all threads except the profiler until the process exits.
+def sample_stacks():
+    while True:
+        time.sleep(SAMPLE_INTERVAL_SECONDS)
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if names.get(ident) == THREAD_NAME:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(
+                    "{}:{}:{}".format(
+                        os.path.basename(code.co_filename), code.co_name, frame.f_lineno
+                    )
+                )
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ";".join(reversed(stack))
+            with samples_lock:
+                samples[key] = samples.get(key, 0) + 1
+
+
+# Dump the profile since the last dump into the data directory, and remove the oldest profiles
+# beyond the capacity.
+def dump():
+    import ivr
+
+    global timers
+    global samples
+    with timers_lock:
+        current_timers, timers = timers, {}
+    with samples_lock:
+        current_samples, samples = samples, {}
+
+    now = time.time()
+    program = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    lines = [
+        "# profile of {}[{}] at {}".format(
+            program, os.getpid(), time.strftime("%F %T", time.localtime(now))
+        ),
+        "",
+        "## timers since the last dump: name, count, total [sec], mean [msec], max [msec]",
+    ]
+    for name, (count, total, longest) in sorted(
+        current_timers.items(), key=lambda x: -x[1][1]
+    ):
+        lines.append(
+            "{}\t{}\t{:.3f}\t{:.3f}\t{:.3f}".format(
+                name, count, total, total / count * 1000, longest * 1000
+            )
+        )
+
+    if len(current_samples) != 0:
+        total = sum(current_samples.values())
+        lines.extend(
+            [
+                "",
+                "## cpu: {} samples every {} sec, in collapsed stacks".format(
+                    total, SAMPLE_INTERVAL_SECONDS
+                ),
+            ]
+        )
+        stacks = sorted(current_samples.items(), key=lambda x: -x[1])
+        lines.extend(["{} {}".format(s, n) for s, n in stacks[:TOP_STACKS]])
+
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        lines.extend(
+            [
+                "",
+                "## memory: {}B traced, {}B at peak".format(
+                    ivr.with_aux_unit(current), ivr.with_aux_unit(peak)
+                ),
+            ]
+        )
+        lines.extend([str(s) for s in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]])
+        if dump.snapshot is not None:
+            lines.extend(["", "## memory growth since the last dump"])
+            diff = snapshot.compare_to(dump.snapshot, "lineno")
+            lines.extend([str(s) for s in diff[:TOP_ALLOCATIONS]])
+        dump.snapshot = snapshot
+
+    name = "{}{}-{}-{}.{}".format(
+        PROFILE_FILE_PREFIX,
+        program,
+        time.strftime("%Y%m%d%H%M%S", time.localtime(now)),
+        os.getpid(),
+        PROFILE_FILE_EXT,
+    )
+    try:
+        ivr.write(os.path.join(ivr.data_dir(), name), "\n".join(lines) + "\n")
+        remove_old_profiles(ivr.data_dir())
+    except OSError as e:
+        ivr.log("WARN: failed to dump the profile: {}: {}".format(name, e))
+
+
+dump.snapshot = None
+
+
+# Remove the oldest profile files while their total size exceeds the capacity.
+def remove_old_profiles(dir):
+    files = []
+    for f in os.listdir(dir):
+        if f.startswith(PROFILE_FILE_PREFIX) and f.endswith("." + PROFILE_FILE_EXT):
+            try:
+                stat = os.stat(os.path.join(dir, f))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+    files.sort()
+    total = sum([size for _, size, _ in files])
+    while total > PROFILE_CAPACITY and len(files) > 1:
+        _, size, f = files.pop(0)
+        try:
+            os.remove(os.path.join(dir, f))
+        except FileNotFoundError:
+            pass
+        total -= size
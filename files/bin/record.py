@@ -2,21 +2,81 @@
 #
 import argparse
 import datetime
+import json
 import os
 import re
+import shutil
 import signal
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
+import audio
+import boot
+import detector
+import event
 import ivr
+import motion
+import pressure
+import profiling
+import subtitle
+import telemetry
 
 # Real-time recording format: mkv, mp4, avi
 FOOTAGE_FILE_EXT = "avi"
 
-# FFmpeg subprocess
-ffmpeg_process = None
+# How to overlay the telop on the footage:
+#   burn:     draw the telop on every frame by FFmpeg (costs CPU before the encoder)
+#   subtitle: write the telop to a WebVTT file alongside the footage, rendered by the players
+TELOP_MODES = ["burn", "subtitle"]
+
+# Recording profiles:
+#   full:   the specified frame rate and bitrate
+#   parked: low frame rate and bitrate while the vehicle is parked
+#   idle:   low frame rate and bitrate while no motion is detected in the video
+PROFILE_FULL = "full"
+PROFILE_PARKED = "parked"
+PROFILE_IDLE = "idle"
+
+# Interval to check whether the recording profile should be switched.
+POLICY_INTERVAL_SECONDS = 0.5
+
+# Playlist of the live streaming in the live directory.
+LIVE_PLAYLIST = "live.m3u8"
+
+# HLS options of the live streaming. Only the latest few segments are kept in the live directory.
+# The live streaming is ignored if it fails, so that it doesn't affect the recording.
+LIVE_HLS_OPTIONS = [
+    "f=hls",
+    "hls_time=2",
+    "hls_list_size=3",
+    "hls_flags=delete_segments+omit_endlist",
+    "onfail=ignore",
+]
+
+# Width and JPEG quality (2-31) of the latest-frame snapshot.
+SNAPSHOT_WIDTH = 640
+SNAPSHOT_QUALITY = 5
+
+# Resolution and frame rate that the hardware encoder can sustain in total for all cameras.
+DEFAULT_ENCODER_BUDGET = "1920x1080@30"
+
+# Frame rate assumed for the budget of the cameras whose frame rate isn't specified.
+DEFAULT_CAMERA_FPS = 30
+
+# Frame rate down to which a camera is degraded before its resolution is lowered.
+MIN_SCHEDULED_FPS = 15
+
+# Height of the resolution below which a camera is no longer degraded.
+MIN_SCHEDULED_HEIGHT = 180
+
+# FFmpeg subprocesses by the camera name, where the primary camera is None.
+ffmpeg_processes = {}
+
+# Set when the recorder is terminated, to stop recording with the secondary cameras.
+stopping = threading.Event()
 
 # Exception raised when FFmpeg doesn't exit the specified time is exceeded.
 class TimeoutException(Exception):
@@ -28,8 +88,46 @@ def timeout_handler(signum, frame):
     raise TimeoutException("")
 
 
+# Refer to the recording profile appropriate for the current state.
+# The motion_post_roll is the seconds to keep the full quality after the last motion in the video,
+# or None if the motion detection is disabled.
+def recording_profile(parking_after, motion_post_roll=None):
+    if motion_post_roll is not None:
+        if detector.seconds_since_last_motion() > motion_post_roll:
+            return PROFILE_IDLE
+        return PROFILE_FULL
+    if parking_after is not None:
+        seconds = motion.stationary_seconds()
+        if seconds is not None and seconds >= parking_after:
+            return PROFILE_PARKED
+    return PROFILE_FULL
+
+
+# FFmpeg output options to overwrite the snapshot with the latest frame every interval seconds. The
+# frames are taken from the camera before the telop, and the other frames are dropped by the fps
+# filter without being encoded, so it costs only a small JPEG per interval.
+def snapshot_output_options(interval, camera=None):
+    vf = "fps=1/{},scale='min({},iw)':-2".format(interval, SNAPSHOT_WIDTH)
+    command = ["-map", "0:v", "-vf", vf, "-q:v", str(SNAPSHOT_QUALITY)]
+    command.extend(["-update", "1", "-f", "image2", ivr.snapshot_file(camera)])
+    return command
+
+
+# Output the error messages of FFmpeg to the log.
+def log_ffmpeg_output(stderr, label="FFmpeg"):
+    line = stderr.readline()
+    while line:
+        ivr.log("{}: {}".format(label, line.decode("utf-8").strip()))
+        line = stderr.readline()
+
+
 # Start recording the footage.
-# Returns the FFmpeg exit-code and the name of the generated footage file.
+# If the policy returns a profile different from the specified one while recording, the recording
+# is terminated so that the caller can restart it with the new profile.
+# Returns the FFmpeg exit-code, the name of the generated footage file, and whether the recording
+# was terminated to switch the profile.
+# The camera is the name of the secondary camera, which is recorded in a thread other than the main
+# thread, or None for the primary camera.
 def start_camera_recording(
     dev_video,
     dev_audio,
@@ -40,11 +138,19 @@ def start_camera_recording(
     video_input_format,
     video_bitrate,
     sampling_rate,
+    telop_mode="burn",
+    timelapse_fps=None,
+    profile=PROFILE_FULL,
+    policy=None,
+    motion_sensitivity=None,
+    live_dir=None,
+    on_start=None,
+    camera=None,
+    snapshot_interval=None,
+    noise_reduction=True,
 ):
-    global ffmpeg_process
-
     # determine unique file name
-    output = new_footage_file(dir, datetime.datetime.now(), FOOTAGE_FILE_EXT)
+    output = new_footage_file(dir, datetime.datetime.now(), FOOTAGE_FILE_EXT, camera)
 
     # calculate the number of seconds remaining in this hour
     delta = datetime.timedelta(hours=1)
@@ -66,14 +172,21 @@ def start_camera_recording(
     font_size = int(text_resolution * 12)
     p16 = int(text_resolution * 16)
     p4 = int(text_resolution * 4)
-    telop = [
-        "format=pix_fmts=yuv420p",
-        "drawbox=y=ih-{0}:w=iw:h={0}:t=fill:color=black@0.4".format(p16),
-        "drawtext=textfile={0}:fontsize={1}:reload=1:fontcolor=#DDDDDD:x={2}:y=h-{3}".format(
-            telop_file, font_size, p4, font_size
-        ),
-    ]
-    if video_fps is not None:
+    telop = []
+    if timelapse_fps is not None:
+        # drop frames before the other filters so that they process only the remaining frames
+        telop.extend(["fps={}".format(timelapse_fps)])
+    if telop_mode == "burn":
+        telop.extend(
+            [
+                "format=pix_fmts=yuv420p",
+                "drawbox=y=ih-{0}:w=iw:h={0}:t=fill:color=black@0.4".format(p16),
+                "drawtext=textfile={0}:fontsize={1}:reload=1:fontcolor=#DDDDDD:x={2}:y=h-{3}".format(
+                    telop_file, font_size, p4, font_size
+                ),
+            ]
+        )
+    if video_fps is not None and timelapse_fps is None:
         telop.extend(["framerate={}".format(video_fps)])
 
     command = ["ffmpeg"]
@@ -82,6 +195,10 @@ def start_camera_recording(
     command.extend(["-loglevel", "warning"])
     command.extend(["-t", str(interval)])
 
+    # progress reports to watch whether FFmpeg keeps up with the real time
+    progress_read, progress_write = os.pipe()
+    command.extend(["-progress", "pipe:{}".format(progress_write)])
+
     # video input options
     # -vsync:   When a frame isn't received from the camera at the specified frame rate, it
     #           deletes or duplicates the frame to achieve the specified frame rate.
@@ -95,19 +212,12 @@ def start_camera_recording(
     command.extend(["-ss", "0:00"])
     command.extend(["-i", dev_video])
 
-    # audio input options
-    # [mono/stereo] The "-ac 1" and "-channel_layout mono" are added to avoid warning message
-    # "Guessed Channel Layout for Input Stream #1.0 : mono", but they cause an error when C922n
-    # uses a stereo microphone, so they aren't fixed to mono but left to auto-recognition.
-    if dev_audio is not None:
-        command.extend(["-f", "alsa"])
-        command.extend(["-thread_queue_size", "8192"])
-        if sampling_rate is not None:
-            command.extend(["-ar", sampling_rate])  # audio sampling rate
-        command.extend(["-i", "hw:{}".format(dev_audio)])
+    # the audio is captured by another FFmpeg (see audio.py), so that an ALSA error doesn't stop
+    # the video
 
     # video filter
-    command.extend(["-vf", ",".join(telop)])
+    if len(telop) != 0:
+        command.extend(["-vf", ",".join(telop)])
 
     # video / audio output options
     if FOOTAGE_FILE_EXT == "mkv":
@@ -132,73 +242,162 @@ def start_camera_recording(
         command.extend(["-bufsize", video_bitrate])
 
     # output file
-    command.extend([output])
+    # For live streaming, the encoded stream is also written to HLS segments by the tee muxer
+    # instead of being encoded twice.
+    if live_dir is None:
+        command.extend([output])
+    else:
+        command.extend(["-map", "0:v"])
+        playlist = os.path.join(live_dir, LIVE_PLAYLIST)
+        live = "[{}]{}".format(":".join(LIVE_HLS_OPTIONS), playlist)
+        outputs = "[f={}]{}|{}".format(FOOTAGE_FILE_EXT, output, live)
+        command.extend(["-f", "tee", outputs])
 
-    proc = subprocess.Popen(
-        command,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
-    )
-    ffmpeg_process = proc
+    # secondary output of small grayscale frames for motion detection
+    analysis = motion_sensitivity is not None and detector.available()
+    if analysis:
+        width, height = detector.analysis_size(video_resolution)
+        command.extend(detector.ffmpeg_output_options(width, height))
+
+    # secondary output of the latest frame for the health checks
+    if snapshot_interval is not None:
+        command.extend(snapshot_output_options(snapshot_interval, camera))
+
+    try:
+        proc = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE if analysis else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=(progress_write,),
+        )
+    except OSError:
+        os.close(progress_read)
+        raise
+    finally:
+        os.close(progress_write)
+    ffmpeg_processes[camera] = proc
+    if stopping.is_set():
+        proc.terminate()
+    on_first_frame = None
+    if camera is None:
+        on_first_frame = lambda: boot.report_first_frame(dir)
+    threading.Thread(
+        target=pressure.save_recorder_metrics,
+        args=(os.fdopen(progress_read, mode="r"), on_first_frame, camera),
+        daemon=True,
+    ).start()
+    label = "FFmpeg" if camera is None else "FFmpeg[{}]".format(camera)
+    pid_name = "ffmpeg" if camera is None else "ffmpeg-{}".format(camera)
+    deadline = time.monotonic() + interval + 15
+    subtitle_writer = None
+    audio_recorder = None
+    switched = False
     try:
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(interval + 15)
+        start = datetime.datetime.now()
+        telemetry.save_segment(output, start, profile, camera)
+        if dev_audio is not None:
+            audio_recorder = audio.AudioRecorder(
+                dev_audio, sampling_rate, noise_reduction, output, start
+            )
+            audio_recorder.start()
+        if telop_mode == "subtitle":
+            subtitle_writer = subtitle.SubtitleWriter(
+                telop_file, output, datetime.datetime.now()
+            )
+            subtitle_writer.start()
 
-        ivr.save_pid("ffmpeg", proc.pid)
+        # the signal handler can be set only in the main thread, so the other threads check the
+        # deadline by themselves
+        if camera is None:
+            signal.signal(signal.SIGALRM, timeout_handler)
+            signal.alarm(interval + 15)
+
+        ivr.save_pid(pid_name, proc.pid)
+        if on_start is not None:
+            on_start(proc)
 
         ivr.log("start recording[{}]: {}".format(proc.pid, " ".join(proc.args)))
         ivr.log("  to {} between {} and {} ({} sec)".format(output, t1, t2, interval))
-        line = proc.stderr.readline()
-        while line:
-            ivr.log("FFmpeg: {}".format(line.decode("utf-8").strip()))
-            line = proc.stderr.readline()
+        stderr_logger = threading.Thread(
+            target=log_ffmpeg_output, args=(proc.stderr, label), daemon=True
+        )
+        stderr_logger.start()
+        if analysis:
+            detector.MotionDetector(proc.stdout, width, height, motion_sensitivity).start()
+        while True:
+            try:
+                proc.wait(POLICY_INTERVAL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if camera is not None and time.monotonic() > deadline:
+                raise TimeoutException("")
+            new_profile = profile if policy is None else policy()
+            if new_profile != profile:
+                ivr.log("switch recording profile: {} -> {}".format(profile, new_profile))
+                switched = True
+                proc.terminate()
+                break
+        stderr_logger.join(10)
 
     except TimeoutException:
         ivr.log("FFmpeg didn't finish after {} sec; sending SIGTERM".format(interval))
     finally:
-        ffmpeg_process = None
-        signal.alarm(0)
+        ffmpeg_processes.pop(camera, None)
+        if camera is None:
+            signal.alarm(0)
         if proc.returncode is None:
             proc.terminate()
-        ivr.remove_pid("ffmpeg")
+        ivr.remove_pid(pid_name)
+        telemetry.remove_segment(camera)
+        if subtitle_writer is not None:
+            subtitle_writer.stop()
+        if audio_recorder is not None:
+            audio_recorder.stop()
 
     try:
         proc.wait(10)
     except subprocess.TimeoutExpired:
         proc.kill()
+    if audio_recorder is not None and not stopping.is_set():
+        audio.mux_in_background([output])
 
-    return (proc.returncode, output)
+    return (proc.returncode, output, switched)
 
 
 # Create a new file name based on the specified datetime that doesn't overlap with any existing
-# footage file.
-def new_footage_file(dir, now, ext):
+# footage file. The sequence is shared by all cameras.
+def new_footage_file(dir, now, ext, camera=None):
+    with new_footage_file.lock:
 
-    # read sequence from control file
-    sequence_file = os.path.join(ivr.data_dir(), ".control")
-    i = 0
-    if os.path.exists(sequence_file):
-        with open(sequence_file, mode="r") as f:
-            i = int(f.read())
+        # read sequence from control file
+        sequence_file = os.path.join(ivr.data_dir(), ".control")
+        i = 0
+        if os.path.exists(sequence_file):
+            with open(sequence_file, mode="r") as f:
+                i = int(f.read())
 
-    while True:
+        while True:
 
-        # test for successful creation of a new file
-        file_name = ivr.footage_file_name(now, i, ext)
-        path = os.path.join(dir, file_name)
-        try:
-            with open(path, mode="x") as f:
-                pass
-        except FileExistsError:
-            i = (i + 1) % 1000000
-            continue
+            # test for successful creation of a new file
+            file_name = ivr.footage_file_name(now, i, ext, camera)
+            path = os.path.join(dir, file_name)
+            try:
+                with open(path, mode="x") as f:
+                    pass
+            except FileExistsError:
+                i = (i + 1) % 1000000
+                continue
 
-        # write sequence to control file
-        with open(sequence_file, mode="w") as f:
-            f.write(str((i + 1) % 1000000))
+            # write sequence to control file
+            with open(sequence_file, mode="w") as f:
+                f.write(str((i + 1) % 1000000))
 
-        return path
+            return path
+
+
+new_footage_file.lock = threading.Lock()
 
 
 SCREEN_SIZE_ALIASES = {
@@ -242,20 +441,16 @@ def screen_resolution(name):
     return None
 
 
-# Returns the device with the lowest number among the USB connected video devices from captured
-# video device list using v4l2-ctl --list-devices.
-# If no such device was detected, returns `None`.
-# This function returns a map with a list of devices, such as /dev/video0, using the title as its
-# key.
-def detect_default_usb_camera():
+# Returns the USB connected video devices from captured video device list using
+# v4l2-ctl --list-devices, as a list of the title and the device with the lowest number such as
+# /dev/video0 for each camera, in order of the device number.
+def detect_usb_cameras():
     cmd = ["v4l2-ctl", "--list-devices"]
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
 
     # Get keys with a title like 'C270 HD WEBCAM (usb-3f980000.usb-1.3):'
     current_title = None
-    min_n = None
-    device = None
-    title = None
+    cameras = {}
     pattern_device = r"/dev/video([0-9]+)"
     pattern_title = r"\(usb-[^\)]*\):"
     while True:
@@ -265,22 +460,27 @@ def detect_default_usb_camera():
         line = line.decode("utf-8")
         if not line.startswith("\t") and line.endswith(":\n"):
             matcher = re.search(pattern_title, line)
-            if matcher is not None and (min_n is None or min_n > int(matcher[1])):
-                current_title = line.strip()
-            else:
-                current_title = None
+            current_title = line.strip() if matcher is not None else None
         elif line.startswith("\t"):
             if current_title is not None:
                 # Get a device with the smallest N for /dev/videoN.
                 matcher = re.search(pattern_device, line)
-                if matcher is not None and (min_n is None or min_n > int(matcher[1])):
-                    title = current_title
-                    device = line.strip()
-                    min_n = int(matcher[1])
+                if matcher is not None:
+                    n = int(matcher[1])
+                    if current_title not in cameras or cameras[current_title][0] > n:
+                        cameras[current_title] = (n, line.strip())
         elif len(line.strip()) != 0:
             ivr.log("WARNING: unknown device: %s" % line)
-    if device is not None:
-        return (title, device)
+    cameras = sorted([(n, title, device) for title, (n, device) in cameras.items()])
+    return [(title, device) for _, title, device in cameras]
+
+
+# Returns the device with the lowest number among the USB connected video devices, with its title.
+# If no such device was detected, returns `(None, None)`.
+def detect_default_usb_camera():
+    cameras = detect_usb_cameras()
+    if len(cameras) != 0:
+        return cameras[0]
     return (None, None)
 
 
@@ -301,11 +501,181 @@ def detect_default_usb_audio():
     return (None, None)
 
 
-# Stop the FFmpeg subprocess if it's running and a TermException will be thrown.
+# Refer to the file that caches the devices detected at the last boot.
+def device_cache_file():
+    return os.path.join(ivr.home_dir(), "cache", "devices.json")
+
+
+# Detect the USB camera and audio device, and cache them for the next boot.
+# This returns a map of the title and the device for "video" and "audio" unless they're excluded.
+def detect_devices(without_video, without_audio):
+    devices = {}
+    if not without_video:
+        devices["video"] = detect_default_usb_camera()
+    if not without_audio:
+        devices["audio"] = detect_default_usb_audio()
+    file = device_cache_file()
+    try:
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        ivr.write(file, json.dumps(devices))
+    except OSError as e:
+        ivr.log("WARN: failed to cache the detected devices: {}: {}".format(file, e))
+    return devices
+
+
+# Refer to the devices cached at the last boot, so that FFmpeg can be launched without waiting for
+# the detection. Returns None if they aren't cached or no longer exist.
+def cached_devices(without_video, without_audio):
+    try:
+        with open(device_cache_file(), mode="r") as f:
+            devices = json.load(f)
+        video = devices["video"][1] if not without_video else None
+        audio = devices["audio"][1] if not without_audio else None
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+    if not without_video and (video is None or not os.path.exists(video)):
+        return None
+    if audio is not None:
+        card = audio.split(",")[0]
+        if not os.path.exists("/proc/asound/card{}".format(card)):
+            return None
+    return devices
+
+
+# Detect the devices again in the background while recording with the cached ones. The result is
+# used from the next recording if the devices have been changed.
+def refresh_devices(without_video, without_audio):
+    refresh_devices.devices = detect_devices(without_video, without_audio)
+
+
+refresh_devices.devices = None
+refresh_devices.thread = None
+
+
+# Called when FFmpeg of the first recording has been launched. The notification and the detection
+# of the devices are deferred until then so that the recording starts as soon as possible.
+def first_recording_started(refresh, without_video, without_audio):
+    boot.mark("ffmpeg")
+    ivr.beep("IVR starts to recording.")
+    if refresh:
+        refresh_devices.thread = threading.Thread(
+            target=refresh_devices, args=(without_video, without_audio), daemon=True
+        )
+        refresh_devices.thread.start()
+
+
+# Parse the secondary camera specified as NAME=DEVICE or NAME=DEVICE@RESOLUTION into the name, the
+# device and the resolution (or None). An error will occur if it's invalid.
+def parse_camera(spec):
+    m = re.fullmatch(r"([a-zA-Z0-9]+)=([^@]+)(?:@(.+))?", spec)
+    if m is None:
+        raise ValueError("invalid camera: {}".format(spec))
+    resolution = m.group(3)
+    if resolution is not None:
+        resolution = screen_resolution(resolution)
+        if resolution is None:
+            raise ValueError("invalid screen resolution: {}".format(spec))
+    return (m.group(1), m.group(2), resolution)
+
+
+# Parse the encoder budget specified as RESOLUTION@FPS, such as 1080p@30, into the pixels per
+# second. An error will occur if it's invalid.
+def parse_encoder_budget(spec):
+    resolution, _, fps = spec.partition("@")
+    res = screen_resolution(resolution)
+    if res is None or len(fps) == 0:
+        raise ValueError("invalid encoder budget: {}".format(spec))
+    return pixel_rate(res, fps)
+
+
+# Refer to the number of pixels per second encoded for the resolution and frame rate.
+def pixel_rate(resolution, fps):
+    width, height = [int(x) for x in resolution.lower().split("x")]
+    return width * height * (DEFAULT_CAMERA_FPS if fps is None else float(fps))
+
+
+# Refer to the lower resolution of the same aspect ratio to degrade to, which is the well-known one
+# down to 3/4 of the height, or 3/4 of the size. Returns None if it'd be too small.
+def lower_resolution(resolution):
+    width, height = [int(x) for x in resolution.lower().split("x")]
+    w, h = (width * 3 // 4) // 2 * 2, (height * 3 // 4) // 2 * 2
+    lower = (h, "{}x{}".format(w, h))
+    for r in SCREEN_SIZE_ALIASES.keys():
+        w, h = [int(x) for x in r.split("x")]
+        if lower[0] <= h < height and abs(w * height - width * h) <= w:
+            lower = max(lower, (h, r))
+    return lower[1] if lower[0] >= MIN_SCHEDULED_HEIGHT else None
+
+
+# Assign the resolution and frame rate to each camera so that the total pixel rate fits in the
+# budget of the hardware encoder shared by all cameras. The cameras are a list of the resolution
+# and the frame rate (or None), in order of priority. The lower priority cameras are degraded
+# first, by lowering the frame rate to MIN_SCHEDULED_FPS, and then by lowering the resolution.
+def schedule_encoder(cameras, budget):
+    scheduled = [list(c) for c in cameras]
+    while sum([pixel_rate(r, fps) for r, fps in scheduled]) > budget:
+        for camera in reversed(scheduled):
+            resolution, fps = camera
+            fps = DEFAULT_CAMERA_FPS if fps is None else float(fps)
+            if fps > MIN_SCHEDULED_FPS:
+                camera[1] = "{:g}".format(max(MIN_SCHEDULED_FPS, fps / 2))
+                break
+            lower = lower_resolution(resolution)
+            if lower is not None:
+                camera[0] = lower
+                break
+        else:
+            ivr.log("WARN: the cameras exceed the encoder budget at the lowest quality")
+            break
+    return [tuple(c) for c in scheduled]
+
+
+# Keep recording with the secondary camera in the same profile as the primary camera, until the
+# recorder is terminated. The settings are the bitrate and the frame rate of each profile.
+def keep_recording(
+    camera,
+    dev_video,
+    telop,
+    dir,
+    video_resolution,
+    video_fps,
+    video_input_format,
+    telop_mode,
+    settings,
+    policy,
+    snapshot_interval,
+):
+    while not stopping.is_set():
+        start = time.monotonic()
+        profile = policy()
+        bitrate, timelapse_fps = settings[profile]
+        ret, file, switched = start_camera_recording(
+            dev_video,
+            None,
+            telop,
+            dir,
+            video_resolution,
+            video_fps,
+            video_input_format,
+            bitrate,
+            None,
+            telop_mode,
+            timelapse_fps,
+            profile,
+            policy,
+            camera=camera,
+            snapshot_interval=snapshot_interval,
+        )
+        ivr.log("the recording of {} has been terminated with: {}".format(file, ret))
+        if ret != 0 and not switched:
+            stopping.wait(max(0, 3 - (time.monotonic() - start)))
+
+
+# Stop the FFmpeg subprocesses if they're running and a TermException will be thrown.
 def term_handler(signum, frame):
-    global ffmpeg_process
-    if ffmpeg_process is not None:
-        ffmpeg_process.terminate()
+    stopping.set()
+    for proc in list(ffmpeg_processes.values()):
+        proc.terminate()
     raise ivr.TermException("")
 
 
@@ -329,6 +699,14 @@ if __name__ == "__main__":
             ivr.telop_file()
         ),
     )
+    parser.add_argument(
+        "-tm",
+        "--telop-mode",
+        metavar="MODE",
+        choices=TELOP_MODES,
+        default="burn",
+        help="How to overlay the telop: burn into the video, or write as subtitle file (default: burn)",
+    )
     parser.add_argument(
         "-v",
         "--video",
@@ -361,6 +739,111 @@ if __name__ == "__main__":
         default="2M",
         help="Bitrate for video recording (default: 2M)",
     )
+    parser.add_argument(
+        "-pa",
+        "--parking-after",
+        metavar="SECONDS",
+        type=int,
+        help="Switch to the parking profile after the vehicle has been stationary for these seconds (default: disabled)",
+    )
+    parser.add_argument(
+        "-pf",
+        "--parking-fps",
+        metavar="FPS",
+        default="1",
+        help="Frames per second for video recording while parked (default: 1)",
+    )
+    parser.add_argument(
+        "-pbr",
+        "--parking-bitrate",
+        metavar="BITRATE",
+        default="250k",
+        help="Bitrate for video recording while parked (default: 250k)",
+    )
+    parser.add_argument(
+        "-md",
+        "--motion-detection",
+        action="store_true",
+        help="Record in full quality only while motion is detected in the video, requires NumPy (default: disabled)",
+    )
+    parser.add_argument(
+        "-ms",
+        "--motion-sensitivity",
+        metavar="RATIO",
+        type=float,
+        default=0.02,
+        help="Ratio of changed pixels to be detected as motion (default: 0.02)",
+    )
+    parser.add_argument(
+        "-mpre",
+        "--motion-pre-roll",
+        metavar="SECONDS",
+        type=int,
+        default=10,
+        help="Seconds of footage before the motion to be saved as event clip, 0 to disable (default: 10)",
+    )
+    parser.add_argument(
+        "-mpost",
+        "--motion-post-roll",
+        metavar="SECONDS",
+        type=int,
+        default=30,
+        help="Seconds to keep the full quality after the last motion (default: 30)",
+    )
+    parser.add_argument(
+        "-if",
+        "--idle-fps",
+        metavar="FPS",
+        default="1",
+        help="Frames per second for video recording while no motion is detected (default: 1)",
+    )
+    parser.add_argument(
+        "-ibr",
+        "--idle-bitrate",
+        metavar="BITRATE",
+        default="250k",
+        help="Bitrate for video recording while no motion is detected (default: 250k)",
+    )
+    parser.add_argument(
+        "-l",
+        "--live",
+        action="store_true",
+        help="Write the footage also as HLS live streaming to {} (default: disabled)".format(
+            ivr.live_dir()
+        ),
+    )
+    parser.add_argument(
+        "-sn",
+        "--snapshot-interval",
+        metavar="SECONDS",
+        type=float,
+        help="Overwrite the latest frame of each camera to {} every interval (default: disabled)".format(
+            ivr.snapshot_file()
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--camera",
+        metavar="NAME=DEVICE[@RESOLUTION]",
+        action="append",
+        default=[],
+        help="Secondary camera to be recorded at the same time, such as rear=/dev/video2@720p (default: none)",
+    )
+    parser.add_argument(
+        "-ac",
+        "--all-cameras",
+        action="store_true",
+        help="Record all the other USB cameras detected as the secondary cameras (default: disabled)",
+    )
+    parser.add_argument(
+        "-eb",
+        "--encoder-budget",
+        metavar="RESOLUTION@FPS",
+        default=DEFAULT_ENCODER_BUDGET,
+        help="Total load that the hardware encoder can sustain for all cameras (default: {})".format(
+            DEFAULT_ENCODER_BUDGET
+        ),
+    )
     parser.add_argument(
         "-a",
         "--without-audio",
@@ -373,9 +856,20 @@ if __name__ == "__main__":
         metavar="SAMPLING_RATE",
         help="Sampling rate for audio recording (default: depends on runtime)",
     )
+    parser.add_argument(
+        "-anr",
+        "--without-audio-noise-reduction",
+        action="store_true",
+        help="Don't cut the low and high frequency noise of audio (default: with noise reduction)",
+    )
 
+    secondary_threads = []
+    cameras = []
     try:
+        boot.mark("exec", boot.process_start())
+        boot.mark("imported")
         ivr.save_pid()
+        profiling.start()
 
         # register SIGTERM handler
         signal.signal(signal.SIGTERM, term_handler)
@@ -384,6 +878,7 @@ if __name__ == "__main__":
         args = parser.parse_args()
         dir = args.dir
         telop = args.telop
+        telop_mode = args.telop_mode
         dev_video = args.video
         video_resolution = args.video_resolution
         video_fps = args.video_fps
@@ -391,6 +886,30 @@ if __name__ == "__main__":
         video_bitrate = args.video_bitrate
         without_audio = args.without_audio
         sampling_rate = args.audio_sampling_rate
+        noise_reduction = not args.without_audio_noise_reduction
+        parking_after = args.parking_after
+        parking_fps = args.parking_fps
+        parking_bitrate = args.parking_bitrate
+        motion_sensitivity = None
+        motion_post_roll = None
+        if args.motion_detection:
+            if detector.available():
+                motion_sensitivity = args.motion_sensitivity
+                motion_post_roll = args.motion_post_roll
+            else:
+                ivr.log("WARN: motion detection is disabled since NumPy is not available")
+        motion_pre_roll = args.motion_pre_roll
+        idle_fps = args.idle_fps
+        idle_bitrate = args.idle_bitrate
+        snapshot_interval = args.snapshot_interval
+        if snapshot_interval is not None and snapshot_interval <= 0:
+            snapshot_interval = None
+        live_dir = None
+        if args.live:
+            live_dir = ivr.live_dir()
+            if os.path.isdir(live_dir):
+                shutil.rmtree(live_dir)
+            os.makedirs(live_dir)
 
         # resolve screen resolution name
         res = screen_resolution(video_resolution)
@@ -402,23 +921,121 @@ if __name__ == "__main__":
         if len(video_bitrate) == 0:
             video_bitrate = None
 
-        # auto-detect video and audio devices
-        if dev_video is None:
-            dev_video_title, dev_video = detect_default_usb_camera()
+        # auto-detect video and audio devices, or use the ones detected at the last boot and
+        # detect them again after FFmpeg is launched; the camera specified explicitly isn't detected
+        without_video = dev_video is not None
+        refresh = False
+        if not without_video or not without_audio:
+            devices = cached_devices(without_video, without_audio)
+            refresh = devices is not None
+            if devices is None:
+                devices = detect_devices(without_video, without_audio)
+        if not without_video:
+            dev_video_title, dev_video = devices["video"]
             ivr.log("detected USB camera: {} = {}".format(dev_video, dev_video_title))
         dev_audio = None
         if not without_audio:
-            dev_autio_title, dev_audio = detect_default_usb_audio()
-            ivr.log("detected Audio: {} = {}".format(dev_audio, dev_autio_title))
+            dev_audio_title, dev_audio = devices["audio"]
+            ivr.log("detected Audio: {} = {}".format(dev_audio, dev_audio_title))
+        if refresh:
+            ivr.log("the devices detected at the last boot are used")
+        boot.mark("detected")
+
+        # secondary cameras
+        cameras = [parse_camera(c) for c in args.camera]
+        if args.all_cameras:
+            used = [dev_video] + [device for _, device, _ in cameras]
+            for title, device in detect_usb_cameras():
+                if device not in used:
+                    name = "cam{}".format(re.search(r"(\d+)$", device)[1])
+                    ivr.log("detected USB camera: {} = {} ({})".format(device, title, name))
+                    cameras.append((name, device, None))
+
+        # share the hardware encoder between the cameras, the primary camera comes first
+        requested = [(video_resolution, video_fps)]
+        requested.extend([(r or video_resolution, video_fps) for _, _, r in cameras])
+        budget = parse_encoder_budget(args.encoder_budget)
+        scheduled = schedule_encoder(requested, budget)
+        settings = []
+        for name, (resolution, fps), (res, sfps) in zip(
+            [None] + [c[0] for c in cameras], requested, scheduled
+        ):
+            if (resolution, fps) != (res, sfps):
+                ivr.log(
+                    "camera {} is degraded to fit in the encoder budget: {}@{}".format(
+                        name or "primary", res, sfps
+                    )
+                )
+            full_fps = sfps if sfps != fps else None
+            settings.append(
+                {
+                    PROFILE_FULL: (video_bitrate, full_fps),
+                    PROFILE_PARKED: (parking_bitrate, parking_fps),
+                    PROFILE_IDLE: (idle_bitrate, idle_fps),
+                }
+            )
+        video_resolution = scheduled[0][0]
+
+        # mux the audio left by the last shutdown or power cut into the footage
+        unmuxed = audio.unmuxed_footage_files(dir)
+        if len(unmuxed) != 0:
+            ivr.log("mux the audio of {} footage files".format(len(unmuxed)))
+            audio.mux_in_background(unmuxed)
 
         # create an empty telop file assuming that it's before the GPS logger is started
         if not os.path.isfile(telop):
             ivr.write(telop, ivr.DEFAULT_TELOP)
 
-        ivr.beep("IVR starts to recording.")
+        policy = lambda: recording_profile(parking_after, motion_post_roll)
+        for (name, device, _), (res, _), s in zip(cameras, scheduled[1:], settings[1:]):
+            thread = threading.Thread(
+                target=keep_recording,
+                args=(
+                    name,
+                    device,
+                    telop,
+                    dir,
+                    res,
+                    video_fps,
+                    video_input_format,
+                    telop_mode,
+                    s,
+                    policy,
+                    snapshot_interval,
+                ),
+                daemon=True,
+            )
+            thread.start()
+            secondary_threads.append(thread)
+        profile = None
+        on_start = lambda proc: first_recording_started(
+            refresh, without_video, without_audio
+        )
         while True:
             start = datetime.datetime.now()
-            ret, file = start_camera_recording(
+            if refresh_devices.devices is not None:
+                devices = refresh_devices.devices
+                refresh_devices.devices = None
+                video_device = dev_video if without_video else devices["video"][1]
+                audio_device = None if without_audio else devices["audio"][1]
+                if (video_device, audio_device) != (dev_video, dev_audio):
+                    ivr.log(
+                        "the devices have been changed since the last boot: {}, {}".format(
+                            video_device, audio_device
+                        )
+                    )
+                    dev_video, dev_audio = video_device, audio_device
+            last_profile = profile
+            profile = policy()
+            bitrate, timelapse_fps = settings[0][profile]
+
+            # save the footage before the motion as an event clip since it was recorded in low
+            # quality and the switching to full quality is only from now on
+            if last_profile == PROFILE_IDLE and profile == PROFILE_FULL:
+                if motion_pre_roll > 0:
+                    event.notify("motion", motion_pre_roll, motion_post_roll)
+
+            ret, file, switched = start_camera_recording(
                 dev_video,
                 dev_audio,
                 telop,
@@ -426,13 +1043,31 @@ if __name__ == "__main__":
                 video_resolution,
                 video_fps,
                 video_input_format,
-                video_bitrate,
+                bitrate,
                 sampling_rate,
+                telop_mode,
+                timelapse_fps,
+                profile,
+                policy,
+                motion_sensitivity,
+                live_dir,
+                on_start,
+                None,
+                snapshot_interval,
+                noise_reduction,
             )
-            ivr.beep("")
+            on_start = None
             ivr.log(
                 "the recording of {} has been terminated with: {}".format(file, ret)
             )
+            if switched:
+                # restart immediately to minimize the gap in the footage
+                continue
+            ivr.beep("")
+
+            # the cached devices may be wrong, so wait for them to be detected again
+            if ret != 0 and refresh_devices.thread is not None:
+                refresh_devices.thread.join()
 
             # to avoid reporting error consecutively in a short period of time
             if ret != 0:
@@ -450,4 +1085,16 @@ if __name__ == "__main__":
         ivr.beep("footage recording has stopped due to an error")
         sys.exit(1)
     finally:
+        # wait for the secondary cameras to finish their footage
+        stopping.set()
+        for proc in list(ffmpeg_processes.values()):
+            proc.terminate()
+        for thread in secondary_threads:
+            thread.join(15)
+        audio.stop_muxing()
+
+        # the snapshots are no longer the latest frames
+        for name in [None] + [c[0] for c in cameras]:
+            if os.path.isfile(ivr.snapshot_file(name)):
+                os.remove(ivr.snapshot_file(name))
         ivr.remove_pid()
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+#
+# Rebuild the catalog of the data directory from the raw footage, track-log and log files, such as
+# when the USB storage has been moved to a new unit or a laptop. The directory is listed once, and
+# the files are indexed in parallel processes: the names are parsed, the durations of the footage
+# are probed, the time ranges of the track logs and the logs are read, and their integrity is
+# checked. The results are written to data/catalog.json.
+#
+# The catalog is saved every few seconds while indexing, and the files whose size and modification
+# time haven't changed since they were catalogued are skipped, so an interrupted run is resumed by
+# running it again.
+#
+#   $ reindex.py                        # index the new and modified files
+#   $ reindex.py --dir /media/usb/data  # index the storage moved to another machine
+#   $ reindex.py --rebuild              # index all the files again
+#
+import argparse
+import concurrent.futures
+import datetime
+import gzip
+import json
+import mmap
+import os
+import re
+import signal
+import struct
+import sys
+import time
+import zlib
+
+import avi
+import ivr
+import logq
+import retention
+import telemetry
+import verify
+
+# Version of the catalog format. The catalog of another version is rebuilt.
+CATALOG_VERSION = 1
+
+# Extensions of the footage files. The files that share the base name with them, such as the
+# telemetry and the subtitle, are listed as their sidecars.
+FOOTAGE_EXTENSIONS = [".avi", ".mp4", ".mkv"]
+
+# Kinds of the files to be indexed, with the pattern of the file name and the function to get the
+# time from the match.
+FILE_KINDS = [
+    (
+        "footage",
+        ivr.FOOTAGE_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[1:5]]),
+    ),
+    (
+        "event",
+        ivr.EVENT_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[0:6]]),
+    ),
+    (
+        "tracklog",
+        ivr.TRACKLOG_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[0:3]]),
+    ),
+    (
+        "log",
+        ivr.IVRLOG_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[0:3]]),
+    ),
+]
+
+# Results of the integrity check:
+#   ok:        the structure is complete
+#   damaged:   the structure is incomplete but the data is readable, such as an AVI after a power
+#              cut, which verify.py can repair
+#   broken:    the file can't be read
+#   unchecked: the format has no integrity check
+STATUS_OK = "ok"
+STATUS_DAMAGED = "damaged"
+STATUS_BROKEN = "broken"
+STATUS_UNCHECKED = "unchecked"
+
+# Size of the blocks in which a file is read.
+BLOCK_SIZE = 1024 * 1024
+
+# Track point and its time in the GPX files written by gpx.py.
+TRKPT_TAG = b"<trkpt "
+TIME_PATTERN = re.compile(rb"<time>([^<]*)</time>")
+
+# Intervals to save the catalog and to report the progress while indexing.
+CHECKPOINT_SECONDS = 10
+PROGRESS_SECONDS = 1
+
+
+# Refer to the catalog file in the directory.
+def catalog_file(dir):
+    return os.path.join(dir, "catalog.json")
+
+
+def load_catalog(dir):
+    try:
+        with open(catalog_file(dir), mode="r") as f:
+            catalog = json.load(f)
+        if catalog.get("version") == CATALOG_VERSION:
+            return dict(catalog.get("files", {}))
+    except FileNotFoundError:
+        pass
+    except (ValueError, TypeError, AttributeError) as e:
+        print("WARN: the catalog is broken and rebuilt: {}".format(e), file=sys.stderr)
+    return {}
+
+
+def save_catalog(dir, files):
+    catalog = {
+        "version": CATALOG_VERSION,
+        "updated": datetime.datetime.now().astimezone().isoformat(),
+        "files": dict(sorted(files.items())),
+    }
+    ivr.write(catalog_file(dir), json.dumps(catalog, indent=1))
+
+
+# Refer to the kind and the time of the file name. Returns None if it isn't indexed.
+def file_kind(name):
+    for kind, pattern, to_time in FILE_KINDS:
+        m = re.fullmatch(pattern, name)
+        if m is None:
+            continue
+        if kind == "footage" and ivr.file_extension(name) not in FOOTAGE_EXTENSIONS:
+            return None
+        try:
+            return (kind, to_time(m))
+        except ValueError:
+            return None
+    return None
+
+
+# Returns True if the top-level boxes of the MP4 file cover the whole file.
+def is_complete_mp4(f, size):
+    position = 0
+    while position + 8 <= size:
+        f.seek(position)
+        head = f.read(16)
+        length = struct.unpack(">I", head[:4])[0]
+        if length == 1 and len(head) == 16:
+            length = struct.unpack(">Q", head[8:16])[0]
+        elif length == 0:
+            return True  # the last box extends to the end of the file
+        if length < 8:
+            return False
+        position += length
+    return position == size
+
+
+# Probe the duration of the footage file and check its integrity. The AVI index is read from the
+# chunk headers. The duration of the other containers is estimated from the name and the last
+# modified time.
+def index_footage(file, stat, entry):
+    ext = ivr.file_extension(file)
+    entry["camera"] = ivr.footage_camera(os.path.basename(file))
+    if ext == ".avi":
+        with open(file, mode="rb") as f:
+            riffs = verify.read_riffs(f, stat.st_size)
+        complete = verify.is_complete(riffs, stat.st_size)
+        index = avi.Index(file)
+        if not index.update():
+            entry["status"] = STATUS_BROKEN
+            return
+        entry["status"] = STATUS_OK if complete else STATUS_DAMAGED
+        entry["duration"] = round(index.duration(), 3)
+        entry["frames"] = index.frames
+        entry["keyframes"] = len(index.keyframes)
+    else:
+        if ext == ".mp4":
+            with open(file, mode="rb") as f:
+                complete = is_complete_mp4(f, stat.st_size)
+            entry["status"] = STATUS_OK if complete else STATUS_DAMAGED
+        else:
+            entry["status"] = STATUS_UNCHECKED
+        entry["duration"] = round(retention.footage_duration(file, stat.st_mtime), 3)
+        entry["estimated"] = True
+    entry["begin"] = round(stat.st_mtime - entry["duration"], 3)
+    entry["end"] = stat.st_mtime
+
+
+# Returns True if the file is compressed.
+def is_compressed(file):
+    return ivr.file_extension(file) == "." + ivr.COMPRESSED_FILE_EXT
+
+
+# Read the data of the file in blocks, decompressing it if it's compressed. A corrupted compressed
+# file raises an error at the block where it's broken.
+def read_blocks(file):
+    with (gzip.open if is_compressed(file) else open)(file, mode="rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if len(block) == 0:
+                return
+            yield block
+
+
+# Read the time range and the number of the track points, and check that the GPX is closed.
+def index_tracklog(file, entry):
+    points = 0
+    first = None
+    last = None
+    tail = b""
+    for block in read_blocks(file):
+        data = tail + block
+        # the time in the metadata before the first track point is skipped
+        start = 0 if points != 0 else data.find(TRKPT_TAG)
+        if start >= 0:
+            if first is None:
+                m = TIME_PATTERN.search(data, start)
+                first = None if m is None else m.group(1).decode("utf-8")
+            # the last time may be truncated in a damaged file
+            i = len(data)
+            while True:
+                i = data.rfind(b"<time>", start, i)
+                m = None if i < 0 else TIME_PATTERN.match(data, i)
+                if m is not None:
+                    last = m.group(1).decode("utf-8")
+                if i < 0 or m is not None:
+                    break
+        # the track point in the tail has been counted in the last block
+        points += data.count(TRKPT_TAG, 1 if tail.startswith(TRKPT_TAG) else 0)
+        # keep the last track point, which may continue to the next block
+        i = data.rfind(TRKPT_TAG)
+        tail = data[i:] if i >= 0 else data[-len(TRKPT_TAG) + 1 :]
+    entry["points"] = points
+    entry["begin"] = first
+    entry["end"] = last
+    closed = tail.rstrip().endswith(b"</gpx>")
+    entry["status"] = STATUS_OK if closed or points == 0 else STATUS_DAMAGED
+
+
+# Refer to the timestamp of the record at the position, or None.
+def record_time(data, position):
+    m = logq.HEADER_PATTERN.match(data, position)
+    return None if m is None else m.group(1).decode("ascii")
+
+
+# Read the timestamps of the first and the last records of the log. A log is memory-mapped and only
+# both ends are read. A compressed one is decompressed to the end, which also checks its CRC.
+def index_log(file, entry):
+    first = None
+    last = None
+    if is_compressed(file):
+        tail = b""
+        for block in read_blocks(file):
+            data = tail + block
+            if first is None:
+                first = record_time(data, 0)
+            start = logq.last_record_start(data)
+            last = record_time(data, start) or last
+            tail = data[start:]
+    elif os.path.getsize(file) != 0:
+        with open(file, mode="rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                first = record_time(m, 0)
+                last = record_time(m, logq.last_record_start(m))
+    entry["begin"] = first
+    entry["end"] = last
+    entry["status"] = STATUS_OK
+
+
+# Index the file in a worker process. Returns the name and the entry of the catalog.
+def index_file(file):
+    stat = os.stat(file)
+    name = os.path.basename(file)
+    kind, tm = file_kind(name)
+    entry = {
+        "kind": kind,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "time": tm.isoformat(),
+    }
+    try:
+        if kind == "footage":
+            index_footage(file, stat, entry)
+        elif kind == "event" and ivr.file_extension(name) == ".avi":
+            index_footage(file, stat, entry)
+            del entry["camera"]
+        elif kind == "tracklog":
+            index_tracklog(file, entry)
+        elif kind == "log":
+            index_log(file, entry)
+        else:
+            entry["status"] = STATUS_UNCHECKED
+    except (OSError, EOFError, zlib.error, struct.error) as e:
+        entry["status"] = STATUS_BROKEN
+        entry["error"] = str(e)
+    return (name, entry)
+
+
+# The worker processes leave the interruption to the parent, which saves the catalog.
+def ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Report the progress to the standard error, overwriting the line on a terminal.
+def report_progress(done, total, done_bytes, total_bytes, t0):
+    elapsed = max(time.monotonic() - t0, 0.001)
+    rate = done_bytes / elapsed
+    eta = (total_bytes - done_bytes) / rate if rate > 0 else 0
+    line = "indexed {}/{} files ({}B/{}B) at {}B/s, {:.0f} sec left".format(
+        done,
+        total,
+        ivr.with_aux_unit(done_bytes),
+        ivr.with_aux_unit(total_bytes),
+        ivr.with_aux_unit(rate),
+        eta,
+    )
+    if sys.stderr.isatty():
+        print("\r" + line + "\033[K", end="", file=sys.stderr, flush=True)
+    else:
+        print(line, file=sys.stderr, flush=True)
+
+
+# Index the files in the directory in parallel, except for the ones being recorded and the ones
+# unchanged since they were catalogued. Returns the catalog and the number of indexed files.
+def reindex(dir, workers, rebuild=False):
+    catalog = {} if rebuild else load_catalog(dir)
+    try:
+        recording = telemetry.recording_files()
+    except FileNotFoundError:
+        # the storage has been moved to a machine where iVR isn't running
+        recording = set()
+    names = os.listdir(dir)
+    stems = {}
+    for f in names:
+        stems.setdefault(os.path.splitext(f)[0], []).append(ivr.file_extension(f)[1:])
+
+    files = []
+    present = set()
+    for f in names:
+        if file_kind(f) is None or f in recording:
+            continue
+        try:
+            stat = os.stat(os.path.join(dir, f))
+        except FileNotFoundError:
+            continue
+        present.add(f)
+        cached = catalog.get(f)
+        if cached is not None and [cached.get("size"), cached.get("mtime")] == [
+            stat.st_size,
+            stat.st_mtime,
+        ]:
+            continue
+        files.append((stat.st_size, os.path.join(dir, f)))
+    catalog = {name: entry for name, entry in catalog.items() if name in present}
+
+    # the largest files first, so that the workers don't wait for one of them at the end
+    files.sort(reverse=True)
+    total = len(files)
+    total_bytes = sum([size for size, _ in files])
+    done = 0
+    done_bytes = 0
+    t0 = time.monotonic()
+    last_checkpoint = last_progress = t0
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=ignore_interrupt
+    )
+    try:
+        futures = {
+            executor.submit(index_file, file): (size, file) for size, file in files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            size, file = futures[future]
+            try:
+                name, entry = future.result()
+                catalog[name] = entry
+            except Exception as e:
+                print("ERROR: failed to index {}: {}".format(file, e), file=sys.stderr)
+            done += 1
+            done_bytes += size
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_SECONDS:
+                report_progress(done, total, done_bytes, total_bytes, t0)
+                last_progress = now
+            if now - last_checkpoint >= CHECKPOINT_SECONDS:
+                save_catalog(dir, catalog)
+                last_checkpoint = now
+        executor.shutdown()
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        for name, entry in catalog.items():
+            if entry["kind"] == "footage":
+                stem = os.path.splitext(name)[0]
+                sidecars = [
+                    x
+                    for x in stems.get(stem, [])
+                    if "." + x != ivr.file_extension(name)
+                ]
+                entry["sidecars"] = sorted(sidecars)
+        save_catalog(dir, catalog)
+        if total != 0:
+            report_progress(done, total, done_bytes, total_bytes, t0)
+            if sys.stderr.isatty():
+                print(file=sys.stderr)
+    return (catalog, done)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the catalog of the footage, track-log and log files"
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory where the footage and the other files are stored (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="NUM",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes to index the files (default: {})".format(
+            os.cpu_count()
+        ),
+    )
+    parser.add_argument(
+        "-r",
+        "--rebuild",
+        action="store_true",
+        help="Index all the files again, ignoring the existing catalog",
+    )
+    args = parser.parse_args()
+
+    # the worker processes inherit the priorities
+    ivr.lower_priority()
+    t0 = time.monotonic()
+    try:
+        catalog, indexed = reindex(args.dir, args.workers, args.rebuild)
+    except KeyboardInterrupt:
+        print("interrupted; run again to resume", file=sys.stderr)
+        sys.exit(130)
+    counts = {}
+    for entry in catalog.values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    summary = ", ".join(["{} {}".format(n, s) for s, n in sorted(counts.items())])
+    print(
+        "{}: {} files indexed in {:.1f} sec, {} files catalogued: {}".format(
+            catalog_file(args.dir),
+            indexed,
+            time.monotonic() - t0,
+            len(catalog),
+            summary or "none",
+        )
+    )
+    sys.exit(1 if counts.get(STATUS_BROKEN, 0) + counts.get(STATUS_DAMAGED, 0) else 0)
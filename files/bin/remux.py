@@ -0,0 +1,228 @@
+#
+# Remux the closed footage files from AVI into MP4 by stream copy in the background, so that they
+# can be played and seeked on phones. The queue of jobs is saved in the data directory to survive
+# restarts, and the jobs are paused while the recording is under I/O pressure.
+#
+import json
+import os
+import re
+import signal
+import subprocess
+import threading
+
+import ivr
+import pressure
+import telemetry
+
+# Extension of the remuxed footage file.
+REMUX_FILE_EXT = "mp4"
+
+# Extension of the footage file being converted. It shares the base name with the original so that
+# ensure_storage_space() counts it together with the original.
+PARTIAL_FILE_EXT = "part"
+
+# Number of the latest footage files of each camera not to be remuxed, since they may still be
+# written or used to cut out event clips.
+LATEST_FILES_TO_SKIP = 2
+
+# Number of failures after which the footage file is no longer queued.
+MAX_FAILURES = 3
+
+# Options to write MP4 as fragmented. It's written in a single pass, whereas faststart rewrites the
+# whole file after it has been written.
+MP4_MOVFLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+
+
+# Refer to the file that contains the queue of the remux jobs.
+def queue_file(dir):
+    return os.path.join(dir, ".remux")
+
+
+# Refer to the closed footage files with the specified extensions in the directory, in order of
+# newest to oldest. The latest files are counted for each camera, since the cameras roll over their
+# segments at the same time.
+def closed_footage_files(dir, extensions=(".avi",)):
+    recording = telemetry.recording_files()
+    files = []
+    for f in os.listdir(dir):
+        if (
+            re.fullmatch(ivr.FOOTAGE_FILE_PATTERN, f)
+            and ivr.file_extension(f) in extensions
+        ):
+            try:
+                files.append((os.stat(os.path.join(dir, f)).st_mtime, f))
+            except FileNotFoundError:
+                continue
+    files.sort(reverse=True)
+    latest = {}
+    closed = []
+    for _, f in files:
+        camera = ivr.footage_camera(f)
+        latest[camera] = latest.get(camera, 0) + 1
+        if latest[camera] > LATEST_FILES_TO_SKIP and f not in recording:
+            closed.append(f)
+    return closed
+
+
+# Refer to the duration of the footage file in seconds by ffprobe, or None if it can't be read.
+def media_duration(file):
+    command = ["ffprobe", "-v", "error", "-show_entries", "format=duration"]
+    command.extend(["-of", "default=noprint_wrappers=1:nokey=1", file])
+    ret = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+    try:
+        return float(ret.stdout.decode("utf-8").strip())
+    except ValueError:
+        return None
+
+
+# Create the partial file of the footage file exclusively, so that the footage file isn't
+# converted by two jobs at the same time. Returns False if another job is converting it.
+def lock_partial_file(part):
+    try:
+        with open(part, mode="x"):
+            pass
+        return True
+    except FileExistsError:
+        return False
+
+
+# A queue of remux jobs processed by a bounded pool of worker threads. Each job runs FFmpeg at the
+# lowest CPU and idle I/O priority.
+class RemuxQueue:
+    def __init__(self, dir):
+        self.dir = dir
+        self.file = queue_file(dir)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.failures = {}
+        self.processes = {}
+        self.stopped = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.file, mode="r") as f:
+                state = json.load(f)
+            self.pending = list(state.get("pending", []))
+            self.failures = dict(state.get("failures", {}))
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError) as e:
+            ivr.log("WARN: the remux queue is broken and discarded: {}".format(e))
+
+    def save(self):
+        state = {"pending": self.pending, "failures": self.failures}
+        ivr.write(self.file, json.dumps(state))
+
+    # Add the closed footage files that haven't been remuxed yet to the queue, and discard the jobs
+    # of the files that have been removed.
+    def enqueue_closed_footage(self):
+        files = closed_footage_files(self.dir)
+        with self.condition:
+            pending = [f for f in self.pending if f in self.processes or f in files]
+            for f in files:
+                if f not in pending and self.failures.get(f, 0) < MAX_FAILURES:
+                    pending.append(f)
+            if pending != self.pending:
+                self.pending = pending
+                self.save()
+                self.condition.notify_all()
+
+    # Start the worker threads.
+    def start(self, workers):
+        for _ in range(workers):
+            threading.Thread(target=self.run_worker, daemon=True).start()
+
+    # Terminate the running jobs. They remain in the queue without being counted as failures.
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            for proc in self.processes.values():
+                if proc is None:
+                    continue
+                proc.send_signal(signal.SIGCONT)
+                proc.terminate()
+            self.condition.notify_all()
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                # the newest file first, since it's the most likely to be watched
+                while (
+                    not self.stopped
+                    and len([f for f in self.pending if f not in self.processes]) == 0
+                ):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                name = [f for f in self.pending if f not in self.processes][0]
+                self.processes[name] = None
+            try:
+                ok = self.remux(name)
+            except Exception as e:
+                ivr.log("ERROR: failed to remux {}: {}".format(name, e))
+                ok = False
+            with self.condition:
+                del self.processes[name]
+                if not ok and self.stopped:
+                    # terminated by stop(), such as when the ignition is turned off
+                    return
+                self.pending.remove(name)
+                if not ok:
+                    self.failures[name] = self.failures.get(name, 0) + 1
+                    if self.failures[name] < MAX_FAILURES:
+                        self.pending.append(name)
+                self.save()
+
+    # Remux the footage file into MP4, and replace the original with it. The modification time is
+    # kept so that the order of deletion in ensure_storage_space() doesn't change.
+    def remux(self, name):
+        src = os.path.join(self.dir, name)
+        part = ivr.footage_sidecar_file(src, PARTIAL_FILE_EXT)
+        dst = ivr.footage_sidecar_file(src, REMUX_FILE_EXT)
+        if not os.path.isfile(src) or not lock_partial_file(part):
+            # it'll be queued again if it's still AVI
+            return True
+
+        command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+        command.extend(["-i", src, "-map", "0", "-c", "copy"])
+        command.extend(["-movflags", MP4_MOVFLAGS])
+        command.extend(["-f", REMUX_FILE_EXT, part])
+        returncode, stderr = pressure.run_low_priority(
+            command,
+            "remuxing {}".format(name),
+            on_start=lambda proc: self.set_process(name, proc),
+        )
+
+        if returncode != 0:
+            if not self.stopped:
+                ivr.log("ERROR: failed to remux {}: {}".format(name, stderr.strip()))
+            if os.path.isfile(part):
+                os.remove(part)
+            return False
+        try:
+            stat = os.stat(src)
+        except FileNotFoundError:
+            # the original has been removed by ensure_storage_space() while remuxing
+            if os.path.isfile(part):
+                os.remove(part)
+            return True
+        os.utime(part, (stat.st_atime, stat.st_mtime))
+        os.rename(part, dst)
+        if os.path.isfile(src):
+            os.remove(src)
+        ivr.log(
+            "file remuxed: {} ({}B) -> {} ({}B)".format(
+                src,
+                ivr.with_aux_unit(stat.st_size),
+                dst,
+                ivr.with_aux_unit(os.path.getsize(dst)),
+            )
+        )
+        return True
+
+    def set_process(self, name, proc):
+        with self.condition:
+            self.processes[name] = proc
+            if self.stopped:
+                proc.terminate()
@@ -0,0 +1,321 @@
+#
+# Tiered retention of footage files. Instead of keeping the footage in full quality until it's
+# deleted, aging footage is converted to lower quality to keep more days of history, such as
+# "48h:full,7d:500k,30d:key": full quality for 48 hours, 500k bitrate until 7 days, only keyframes
+# until 30 days, and then deleted.
+#
+import datetime
+import json
+import math
+import os
+import re
+import signal
+import threading
+import time
+
+import ivr
+import pressure
+import remux
+import telemetry
+
+# Quality of the tier that keeps the footage as recorded.
+QUALITY_FULL = "full"
+
+# Quality of the tier that keeps only the keyframes of the video, without re-encoding.
+QUALITY_KEYFRAMES = "key"
+
+# Units of the ages in the tier specification.
+AGE_UNITS = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+# Recording profiles in which the camera and the encoder have room for the conversion, since the
+# recorder runs at low frame rate (see record.py).
+IDLE_PROFILES = ["parked", "idle"]
+
+# Load average per CPU core below which a conversion may be started.
+MAX_LOAD_PER_CPU = 0.5
+
+# Ratio of the size of the keyframes-only footage to the full quality, used for the estimate
+# until such footage exists.
+KEYFRAMES_SIZE_RATIO = 0.1
+
+# Number of failures after which the footage file is no longer converted.
+MAX_FAILURES = 3
+
+# Interval to report the estimate of the days covered by each tier.
+ESTIMATE_INTERVAL_SECONDS = 60 * 60
+
+
+# Parse the tier specification such as "48h:full,7d:500k,30d:key" into a list of the maximum age
+# in seconds and the quality. An error will occur if the specification is invalid.
+def parse_tiers(spec):
+    tiers = []
+    for tier in spec.split(","):
+        m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)([mhd])\s*:\s*(\S+)\s*", tier)
+        if m is None:
+            raise ValueError("invalid retention tier: {}".format(tier))
+        age = float(m.group(1)) * AGE_UNITS[m.group(2)]
+        quality = m.group(3)
+        if len(tiers) != 0 and age <= tiers[-1][0]:
+            raise ValueError("retention tiers must be in order of age: {}".format(spec))
+        if len(tiers) != 0 and quality_rank(quality) > quality_rank(tiers[-1][1]):
+            raise ValueError("retention tiers must lower the quality: {}".format(spec))
+        tiers.append((age, quality))
+    return tiers
+
+
+# Rank of the quality for comparison, which is the bitrate except for full quality and keyframes.
+def quality_rank(quality):
+    if quality == QUALITY_FULL:
+        return math.inf
+    elif quality == QUALITY_KEYFRAMES:
+        return 0
+    return ivr.without_aux_unit(quality)
+
+
+# Refer to the quality of the tier to which the footage of the specified age belongs. Returns None
+# if the footage should be deleted.
+def tier_quality(tiers, age):
+    for limit, quality in tiers:
+        if age < limit:
+            return quality
+    return None
+
+
+# Refer to the file that contains the quality to which each footage file has been converted.
+def state_file(dir):
+    return os.path.join(dir, ".retention")
+
+
+# Estimate the number of seconds recorded in the footage file from the hour in its name and the
+# last modified time. Each footage file covers an hour at most.
+def footage_duration(file, mtime):
+    m = re.fullmatch(ivr.FOOTAGE_FILE_PATTERN, os.path.basename(file))
+    begin = datetime.datetime(*[int(x) for x in m.groups()[1:5]]).timestamp()
+    return min(60 * 60, max(0, mtime - begin))
+
+
+# Remove the footage file and the other files that share the base name with it.
+def remove_footage(file, reason):
+    dir = os.path.dirname(file)
+    stem = os.path.splitext(os.path.basename(file))[0]
+    for f in os.listdir(dir):
+        if os.path.splitext(f)[0] == stem:
+            try:
+                os.remove(os.path.join(dir, f))
+            except FileNotFoundError:
+                continue
+            ivr.log("file removed: {} ({})".format(os.path.join(dir, f), reason))
+
+
+# An engine that converts each footage file according to the tier of its age, one file at a time
+# in the background. The conversion is started only while the device is idle or parked, and paused
+# when the recording gets busy.
+class RetentionEngine:
+    def __init__(self, dir, tiers, capacity):
+        self.dir = dir
+        self.tiers = tiers
+        self.capacity = capacity
+        self.file = state_file(dir)
+        self.qualities = {}
+        self.failures = {}
+        self.thread = None
+        self.process = None
+        self.stopped = False
+        self.last_estimate = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.file, mode="r") as f:
+                state = json.load(f)
+            self.qualities = dict(state.get("qualities", {}))
+            self.failures = dict(state.get("failures", {}))
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError) as e:
+            ivr.log("WARN: the retention state is broken and discarded: {}".format(e))
+
+    def save(self):
+        state = {"qualities": self.qualities, "failures": self.failures}
+        ivr.write(self.file, json.dumps(state))
+
+    # Remove the footage files older than the last tier, and start to convert the oldest footage
+    # file whose tier has been lowered.
+    def update(self):
+        now = time.time()
+        files = remux.closed_footage_files(self.dir, (".avi", ".mp4"))
+        stems = [os.path.splitext(f)[0] for f in files]
+        if self.thread is None or not self.thread.is_alive():
+            known = set(self.qualities.keys()) | set(self.failures.keys())
+            if not known.issubset(stems):
+                self.qualities = {k: v for k, v in self.qualities.items() if k in stems}
+                self.failures = {k: v for k, v in self.failures.items() if k in stems}
+                self.save()
+
+        jobs = []
+        for f in files:
+            file = os.path.join(self.dir, f)
+            stem = os.path.splitext(f)[0]
+            try:
+                age = now - os.stat(file).st_mtime
+            except FileNotFoundError:
+                continue
+            quality = tier_quality(self.tiers, age)
+            current = self.qualities.get(stem, QUALITY_FULL)
+            if quality is None:
+                remove_footage(file, "exceeding the retention period")
+            elif quality_rank(quality) < quality_rank(current):
+                if self.failures.get(stem, 0) < MAX_FAILURES:
+                    jobs.append((f, quality))
+
+        if now - self.last_estimate >= ESTIMATE_INTERVAL_SECONDS:
+            self.last_estimate = now
+            self.report_estimate()
+
+        if self.stopped:
+            return
+        if len(jobs) != 0 and (self.thread is None or not self.thread.is_alive()):
+            reason = self.busy()
+            if reason is None:
+                name, quality = jobs[-1]
+                self.thread = threading.Thread(
+                    target=self.convert, args=(name, quality), daemon=True
+                )
+                self.thread.start()
+
+    # Returns the reason if a conversion shouldn't be started now, or None if it can.
+    def busy(self):
+        load = os.getloadavg()[0]
+        if load > MAX_LOAD_PER_CPU * os.cpu_count():
+            return "load average {:.2f}".format(load)
+        return self.blocked()
+
+    # Returns the reason if the conversion should be paused, or None if it can continue.
+    def blocked(self):
+        if telemetry.current_segment() is not None:
+            profile = telemetry.current_profile()
+            if profile not in IDLE_PROFILES:
+                return "recording in {} profile".format(profile)
+        return pressure.under_pressure()
+
+    # Terminate the running conversion. It isn't counted as a failure, and is executed again on the
+    # next start.
+    def stop(self):
+        self.stopped = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGCONT)
+            self.process.terminate()
+
+    def set_process(self, proc):
+        self.process = proc
+        if self.stopped:
+            proc.terminate()
+
+    # Convert the footage file to the specified quality, and replace the original with it. The
+    # modification time is kept so that the order of deletion doesn't change.
+    def convert(self, name, quality):
+        src = os.path.join(self.dir, name)
+        part = ivr.footage_sidecar_file(src, remux.PARTIAL_FILE_EXT)
+        stem = os.path.splitext(name)[0]
+        if not os.path.isfile(src) or not remux.lock_partial_file(part):
+            return
+        ext = ivr.file_extension(name)[1:]
+
+        command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+        if quality == QUALITY_KEYFRAMES:
+            # the other frames are dropped by stream copy, and the audio is dropped as well
+            command.extend(["-i", src, "-map", "0:v", "-c", "copy"])
+            command.extend(["-bsf:v", "noise=drop=not(key)"])
+        else:
+            # the hardware codec is shared with the recorder, which runs at low frame rate
+            command.extend(["-c:v", "h264_v4l2m2m", "-i", src, "-map", "0"])
+            command.extend(["-c:v", "h264_v4l2m2m", "-pix_fmt", "yuv420p"])
+            command.extend(["-b:v", quality, "-bufsize", quality, "-c:a", "copy"])
+        if ext == remux.REMUX_FILE_EXT:
+            command.extend(["-movflags", remux.MP4_MOVFLAGS])
+        command.extend(["-f", ext, part])
+        returncode, stderr = pressure.run_low_priority(
+            command,
+            "converting {} to {}".format(name, quality),
+            check=self.blocked,
+            on_start=self.set_process,
+        )
+        self.process = None
+
+        try:
+            if returncode != 0 and self.stopped:
+                # terminated by stop()
+                return
+            if returncode != 0:
+                ivr.log("ERROR: failed to convert {}: {}".format(name, stderr.strip()))
+                self.failures[stem] = self.failures.get(stem, 0) + 1
+                return
+            stat = os.stat(src)
+            size = os.path.getsize(part)
+            if size < stat.st_size:
+                os.utime(part, (stat.st_atime, stat.st_mtime))
+                os.rename(part, src)
+            self.qualities[stem] = quality
+            ivr.log(
+                "file converted to {}: {} ({}B -> {}B)".format(
+                    quality,
+                    src,
+                    ivr.with_aux_unit(stat.st_size),
+                    ivr.with_aux_unit(min(size, stat.st_size)),
+                )
+            )
+        except FileNotFoundError:
+            # the original has been removed by ensure_storage_space() while converting
+            pass
+        finally:
+            if os.path.isfile(part):
+                os.remove(part)
+            self.save()
+
+    # Estimate how many days of footage each tier covers within the capacity at the current write
+    # rates, and report it.
+    def report_estimate(self):
+        rates = self.write_rates()
+        full = rates.get(QUALITY_FULL)
+        if full is None:
+            return
+        remaining = self.capacity
+        begin = 0
+        estimates = []
+        for limit, quality in self.tiers:
+            rate = rates.get(quality)
+            if rate is None:
+                if quality == QUALITY_KEYFRAMES:
+                    rate = full * KEYFRAMES_SIZE_RATIO
+                else:
+                    rate = min(full, quality_rank(quality) / 8)
+            span = limit - begin
+            covered = span if rate <= 0 else max(0, min(span, remaining / rate))
+            remaining -= covered * rate
+            estimates.append(
+                "{} {:.1f}/{:.1f} days".format(
+                    quality, covered / 24 / 60 / 60, span / 24 / 60 / 60
+                )
+            )
+            begin = limit
+        ivr.log("retention estimate: {}".format(", ".join(estimates)))
+
+    # Measure the bytes written per second of footage for each quality.
+    def write_rates(self):
+        sizes = {}
+        durations = {}
+        for f in os.listdir(self.dir):
+            if not re.fullmatch(ivr.FOOTAGE_FILE_PATTERN, f):
+                continue
+            if ivr.file_extension(f) not in [".avi", ".mp4"]:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.dir, f))
+            except FileNotFoundError:
+                continue
+            quality = self.qualities.get(os.path.splitext(f)[0], QUALITY_FULL)
+            sizes[quality] = sizes.get(quality, 0) + stat.st_size
+            durations[quality] = durations.get(quality, 0) + footage_duration(
+                f, stat.st_mtime
+            )
+        return {q: sizes[q] / durations[q] for q in sizes if durations[q] > 0}
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+#
+# Local HTTP server to view the live streaming written by `record.py --live`, the latest frame
+# written by `record.py --snapshot-interval`, and to browse and download the files in the data
+# directory. The live segments are read from tmpfs, so viewers
+# connecting or disconnecting never touch the recording process. The files in the data directory
+# are served by sendfile(2) at low I/O priority with a limited number of concurrent downloads, so
+# that downloads don't starve the recording on the same storage.
+#
+import argparse
+import datetime
+import email.utils
+import http.server
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import ivr
+import profiling
+import telemetry
+
+# Page to play the live streaming. Browsers without native HLS support need a player such as VLC
+# to open /live/live.m3u8 directly.
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>iVR Live</title></head>
+<body style="margin:0;background:#000">
+<video src="/live/live.m3u8" style="width:100%;height:100vh" autoplay muted controls></video>
+</body>
+</html>
+"""
+
+# Content types of the files in the live directory.
+LIVE_CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+}
+
+# Content types of the files in the data directory.
+DATA_CONTENT_TYPES = {
+    ".avi": "video/x-msvideo",
+    ".mp4": "video/mp4",
+    ".mkv": "video/x-matroska",
+    ".mp3": "audio/mpeg",
+    ".vtt": "text/vtt; charset=utf-8",
+    ".gpx": "application/gpx+xml",
+    ".log": "text/plain; charset=utf-8",
+    ".gz": "application/gzip",
+    ".jpg": "image/jpeg",
+    ".thm": "application/json",
+}
+
+# Kinds of the files in the data directory, with the pattern of the file name and the function to
+# get the time from the match.
+DATA_FILE_KINDS = [
+    (
+        "footage",
+        ivr.FOOTAGE_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[1:5]]),
+    ),
+    (
+        "event",
+        ivr.EVENT_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[0:6]]),
+    ),
+    (
+        "tracklog",
+        ivr.TRACKLOG_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[0:3]]),
+    ),
+    (
+        "log",
+        ivr.IVRLOG_FILE_PATTERN,
+        lambda m: datetime.datetime(*[int(x) for x in m.groups()[0:3]]),
+    ),
+]
+
+# Path of the latest-frame snapshot of the primary camera, or of a secondary camera by its name.
+SNAPSHOT_PATH_PATTERN = r"/snapshot(?:-([a-zA-Z0-9]+))?\.jpg"
+
+# FFmpeg overwrites the snapshot in place, so one read while it's being written is retried.
+SNAPSHOT_READ_RETRIES = 5
+SNAPSHOT_RETRY_SECONDS = 0.01
+
+# Size of data to be sent by a single sendfile(2) call.
+SENDFILE_BLOCK_SIZE = 1024 * 1024
+
+
+# Refer to the kind and time of the specified file name in the data directory. Returns None if the
+# file isn't one that iVR writes.
+def data_file_kind(name):
+    for kind, pattern, to_time in DATA_FILE_KINDS:
+        m = re.fullmatch(pattern, name)
+        if m is not None:
+            try:
+                return (kind, to_time(m))
+            except ValueError:
+                return None
+    return None
+
+
+# List the metadata of the files in the data directory, in order of newest to oldest.
+def list_data_files(dir):
+    recording = telemetry.recording_files()
+    files = []
+    for name in os.listdir(dir):
+        kind = data_file_kind(name)
+        if kind is None:
+            continue
+        try:
+            stat = os.stat(os.path.join(dir, name))
+        except FileNotFoundError:
+            continue
+        files.append(
+            {
+                "name": name,
+                "kind": kind[0],
+                "extension": ivr.file_extension(name)[1:],
+                "time": kind[1].isoformat(),
+                "size": stat.st_size,
+                "mtime": datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                "camera": ivr.footage_camera(name),
+                "recording": name in recording,
+            }
+        )
+    files.sort(key=lambda f: f["mtime"], reverse=True)
+    return files
+
+
+# Parse the Range header into the first and last byte positions for the file of the specified
+# size. Returns None if the whole file should be sent, or False if the range isn't satisfiable.
+def parse_range(header, size):
+    if header is None:
+        return None
+    m = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header)
+    if m is None or (len(m.group(1)) == 0 and len(m.group(2)) == 0):
+        # multiple ranges and other units aren't supported
+        return None
+    if len(m.group(1)) == 0:
+        length = int(m.group(2))
+        if length == 0:
+            return False
+        return (max(0, size - length), size - 1)
+    first = int(m.group(1))
+    last = size - 1 if len(m.group(2)) == 0 else min(int(m.group(2)), size - 1)
+    if first >= size or first > last:
+        return False
+    return (first, last)
+
+
+# Read the snapshot, or return None if it doesn't exist. A JPEG that doesn't end with the EOI
+# marker is being written by FFmpeg, so it's read again.
+def read_snapshot(camera=None):
+    for _ in range(SNAPSHOT_READ_RETRIES):
+        try:
+            with open(ivr.snapshot_file(camera), mode="rb") as f:
+                body = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+        if body.startswith(b"\xff\xd8") and body.endswith(b"\xff\xd9"):
+            break
+        time.sleep(SNAPSHOT_RETRY_SECONDS)
+    return (body, mtime)
+
+
+# A request handler that serves the live streaming and the files in the data directory. The
+# directory and the semaphore to limit concurrent downloads are set by start_server().
+class RequestHandler(http.server.SimpleHTTPRequestHandler):
+    data_dir = None
+    downloads = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=ivr.live_dir(), **kwargs)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/":
+            self.send_html(INDEX_HTML)
+        elif path.startswith("/live/"):
+            self.send_live_file(path[len("/live/") :])
+        elif re.fullmatch(SNAPSHOT_PATH_PATTERN, path):
+            self.send_snapshot(re.fullmatch(SNAPSHOT_PATH_PATTERN, path).group(1))
+        elif path == "/api/files":
+            self.send_json({"files": list_data_files(self.data_dir)})
+        elif path.startswith("/files/"):
+            self.send_data_file(path[len("/files/") :])
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def send_html(self, html):
+        body = html.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    # The segment may be deleted by FFmpeg at any time, so it's read at once after opening.
+    def send_live_file(self, name):
+        ext = ivr.file_extension(name)
+        if "/" in name or name.startswith(".") or ext not in LIVE_CONTENT_TYPES:
+            self.send_error(404)
+            return
+        try:
+            with open(os.path.join(ivr.live_dir(), name), mode="rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", LIVE_CONTENT_TYPES[ext])
+        self.send_header("Content-Length", str(len(body)))
+        if ext == ".m3u8":
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    # The snapshot is in tmpfs, so it's returned without touching the camera or the storage. The
+    # Last-Modified header tells how old the frame is.
+    def send_snapshot(self, camera):
+        snapshot = read_snapshot(camera)
+        if snapshot is None:
+            self.send_error(404)
+            return
+        body, mtime = snapshot
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    # Send the file in the data directory. Only the file names that iVR writes are accepted, so
+    # the path can't point outside the directory.
+    def send_data_file(self, name):
+        if data_file_kind(name) is None:
+            self.send_error(404)
+            return
+        if not self.downloads.acquire(blocking=False):
+            self.send_response(503)
+            self.send_header("Retry-After", "10")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            with open(os.path.join(self.data_dir, name), mode="rb") as f:
+                self.send_file_range(f, name)
+        except FileNotFoundError:
+            self.send_error(404)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped the download, such as seeking the video
+            self.close_connection = True
+        finally:
+            self.downloads.release()
+
+    # Send the whole or the requested range of the file. The file being recorded is served up to
+    # the size at the time of the request.
+    def send_file_range(self, f, name):
+        size = os.fstat(f.fileno()).st_size
+        ext = ivr.file_extension(name)
+        content_type = DATA_CONTENT_TYPES.get(ext, "application/octet-stream")
+        range = parse_range(self.headers.get("Range"), size)
+        if range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if range is None:
+            first, last = (0, size - 1)
+            self.send_response(200)
+        else:
+            first, last = range
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(first, last, size)
+            )
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        # the file is copied to the socket in the kernel without passing through Python
+        self.wfile.flush()
+        offset = first
+        while offset <= last:
+            count = min(SENDFILE_BLOCK_SIZE, last - offset + 1)
+            sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, count)
+            if sent == 0:
+                # the file has been truncated or removed
+                self.close_connection = True
+                break
+            offset += sent
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the live streaming and the files in the data directory until terminated.
+def start_server(bind, port, dir, max_downloads):
+    RequestHandler.data_dir = dir
+    RequestHandler.downloads = threading.BoundedSemaphore(max_downloads)
+    ivr.lower_priority()
+    server = http.server.ThreadingHTTPServer((bind, port), RequestHandler)
+    server.daemon_threads = True
+    ivr.log("start http server: http://{}:{}/".format(bind, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="HTTP server to view the live streaming and download the recorded files"
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory where the footage and log files are stored (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--bind",
+        metavar="ADDRESS",
+        default="127.0.0.1",
+        help="Address to listen on, such as 0.0.0.0 to be exposed to the network (default: 127.0.0.1)",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        metavar="PORT",
+        type=int,
+        default=8080,
+        help="Port to listen on (default: 8080)",
+    )
+    parser.add_argument(
+        "-md",
+        "--max-downloads",
+        metavar="NUM",
+        type=int,
+        default=2,
+        help="Maximum number of files to be downloaded at the same time (default: 2)",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        ivr.save_pid()
+        profiling.start()
+
+        # register SIGTERM handler
+        signal.signal(signal.SIGTERM, ivr.term_handler)
+        signal.signal(signal.SIGINT, ivr.term_handler)
+
+        start_server(args.bind, args.port, args.dir, args.max_downloads)
+
+    except ivr.TermException as e:
+        ivr.log("IVR terminates the http server")
+    except Exception as e:
+        t = "".join(list(traceback.TracebackException.from_exception(e).format()))
+        ivr.log("ERROR: {}".format(t))
+        ivr.log("IVR terminates the http server by an error")
+        ivr.beep("http server has stopped due to an error")
+        sys.exit(1)
+    finally:
+        ivr.remove_pid()
@@ -18,12 +18,27 @@ function shutdown(){
   fi
 }
 
+# Flush the footage, the track log, the logs and the control files in parallel within the budget
+# first, since the power may be lost at any moment. This also stops the recorder. The budget is the
+# one of the POWER OPTIONS in startup.sh, or the default of power.py if it hasn't been started.
+declare -a pwr_options=()
+if [ -f "$(dirname $0)/../tmp/power-options.txt" ]
+then
+  pwr_options=(`cat "$(dirname $0)/../tmp/power-options.txt"`)
+fi
+python3 "$(dirname $0)/power.py" --flush ${pwr_options[@]}
+
+# Then the other processes are stopped at once.
+shutdown record.py
 shutdown gpslog.py
-sleep 0.6
+shutdown event.py
+shutdown server.py
+shutdown upload.py
 shutdown coordinate.py
-sleep 0.6
-shutdown record.py
+shutdown power.py
 if [ `ps -ef | grep ffmpeg | grep -v grep | wc -l` -ne 0 ]
 then
   killall ffmpeg > /dev/null 2>&1
 fi
+sleep 0.6
+shutdown notify.py
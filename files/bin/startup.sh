@@ -4,6 +4,10 @@
 declare -a rec_options=()
 declare -a crd_options=()
 declare -a gps_options=()
+declare -a evt_options=()
+declare -a srv_options=()
+declare -a upl_options=()
+declare -a pwr_options=()
 
 # ---
 # [STORAGE OPTIONS]
@@ -22,6 +26,27 @@ declare -a gps_options=()
 # will be deleted.
 #crd_options+=("--limit-tracklog" "5G")
 
+# Total size limit for event clip files. Event clips are not counted as footage.
+#crd_options+=("--limit-event" "2G")
+
+# Total size limit for the footage files of a secondary camera (see --camera below), within the
+# limit for all footage files.
+#crd_options+=("--limit-camera" "rear=20G")
+
+# Convert the footage files that are no longer being recorded from AVI to MP4 in the background, so
+# that they can be seeked in phone players. The conversion pauses while the recording is busy.
+#crd_options+=("--remux")
+#crd_options+=("--remux-workers" "1")
+
+# Tiered retention. Instead of deleting the oldest footage, keep it in full quality for the first
+# period, then convert it to the lower bitrate, then keep only the keyframes ("key"), and delete it
+# after the last period. The conversion runs only while parked or idle.
+#crd_options+=("--retention" "48h:full,7d:500k,30d:key")
+
+# Make a contact sheet of the keyframes every specified seconds for each closed footage file, to
+# browse the footage without decoding the video.
+#crd_options+=("--thumbnails" "60")
+
 # ---
 # [VIDEO OPTIONS]
 # 
@@ -42,6 +67,48 @@ rec_options+=("--video-resolution" "864x480")
 # camera quality.
 #rec_options+=("--video-bitrate" "4M")
 
+# How to overlay the time and location on the footage. "burn" draws the text on every frame, which
+# takes a large share of CPU on single-core models. "subtitle" writes it to a WebVTT file alongside
+# the footage instead, and players such as VLC display it on demand.
+#rec_options+=("--telop-mode" "subtitle")
+
+# Parking mode. When the GPS speed has been about zero for the specified seconds, the footage is
+# recorded at low frame rate and bitrate until the vehicle starts moving again. This extends how
+# many days of footage fit in the storage. GPS receiver is required.
+#rec_options+=("--parking-after" "300")
+#rec_options+=("--parking-fps" "1")
+#rec_options+=("--parking-bitrate" "250k")
+
+# Motion detection for security cameras. The footage is recorded in full quality only while motion
+# is detected in the video, and at low frame rate and bitrate otherwise. The footage before the
+# motion is saved as an event clip. NumPy is required (`pip3 install numpy`).
+#rec_options+=("--motion-detection")
+#rec_options+=("--motion-sensitivity" "0.02")
+#rec_options+=("--motion-pre-roll" "10")
+#rec_options+=("--motion-post-roll" "30")
+#rec_options+=("--idle-fps" "1")
+#rec_options+=("--idle-bitrate" "250k")
+
+# Live view. The encoded video is also written as HLS segments to the tmpfs without encoding it
+# again, and can be viewed at http://<raspberrypi>:8080/ (see SERVER OPTIONS). The tmpfs needs a
+# few MB for the segments. The live view never stops the recording even if it fails.
+#rec_options+=("--live")
+
+# Latest-frame snapshot for health checks, such as whether the lens is fogged. The same FFmpeg
+# writes the latest frame of each camera to the tmpfs every interval seconds, and it can be
+# retrieved at http://<raspberrypi>:8080/snapshot.jpg (snapshot-<camera>.jpg for the secondary
+# cameras).
+#rec_options+=("--snapshot-interval" "5")
+
+# Secondary cameras recorded at the same time as the primary one, such as a rear camera. The
+# footage file names end with the camera name, e.g. footage-000123-2022020112-rear.avi. With
+# "--all-cameras", all the other USB cameras are recorded as "camN" by their device number. The
+# cameras share the hardware encoder, so if the total resolution and frame rate exceed the budget,
+# the secondary cameras are degraded first, by lowering the frame rate and then the resolution.
+#rec_options+=("--camera" "rear=/dev/video2@640x360")
+#rec_options+=("--all-cameras")
+#rec_options+=("--encoder-budget" "1920x1080@30")
+
 # Input format from camera.
 # Note that the specific resolution and FPS depend on the input format.
 # See `v4l2-ctl --list-formats-ext` for the relationship between resolution, FPS and input format.
@@ -53,6 +120,8 @@ rec_options+=("--video-resolution" "864x480")
 # [AUDIO OPTIONS]
 #
 # Audio recording is turned off by default, and the state is still in an unstable beta version.
+# The audio is captured by another FFmpeg into an MP3 file beside the footage and muxed into the
+# footage when it's closed, so an error of the audio device doesn't stop the video.
 
 # Enable this option if you don't want to record audio.
 #rec_options+=("--without-audio")
@@ -72,10 +141,80 @@ rec_options+=("--video-resolution" "864x480")
 # Set the GPS time as the exact one if local system clock hasn't synchronized with the NTP server.
 gps_options+=("--clock-adjust")
 
+# Trigger an event when the speed drops by the specified km/h between two GPS fixes, such as a
+# collision.
+#gps_options+=("--event-speed-drop" "40")
+
+# Show the nearest place name in the telop by the index built from a gazetteer such as the
+# cities500.txt of GeoNames: geocode.py --build cities500.txt --output /opt/ivr/gazetteer.idx
+#gps_options+=("--gazetteer-index" "/opt/ivr/gazetteer.idx")
+
+# ---
+# [EVENT OPTIONS]
+#
+# The footage before and after an event is saved as an event clip, which is protected from the
+# deletion of footage. An event can be triggered by `bin/event.py --trigger` or SIGUSR2 to event.py.
+
+# Seconds of footage to be saved before and after the event.
+#evt_options+=("--pre-roll" "30")
+#evt_options+=("--post-roll" "30")
+
+# ---
+# [UPLOAD OPTIONS]
+#
+# Upload the recorded files to a collection server when it's reachable, such as over the Wi-Fi of a
+# depot. The uploader starts only if the URL is specified. Uploaded files are deleted first when
+# the storage is full. `bin/upload.py --receive DIR` runs a minimal collection server.
+#upl_options+=("--url" "http://depot.local:8000/ivr")
+
+# Maximum bytes per second to upload, so that the upload doesn't disturb the recording.
+#upl_options+=("--bandwidth" "1M")
+
+# ---
+# [SERVER OPTIONS]
+#
+# HTTP server for the live view, the snapshots and the downloads of the footage, track-log and log
+# files. It has no authentication, so it isn't started unless enabled, and it listens only on
+# localhost unless an address to be exposed is specified, such as 0.0.0.0 for the Wi-Fi.
+#srv_enabled=1
+#srv_options+=("--bind" "0.0.0.0")
+#srv_options+=("--port" "8080")
+
+# Maximum number of files downloaded at the same time from http://<raspberrypi>:8080/files/.
+#srv_options+=("--max-downloads" "2")
+
+# ---
+# [POWER OPTIONS]
+#
+# When the undervoltage alarm of hwmon is raised or the external power supply goes offline, the
+# footage, the track log, the logs and the control files are flushed within the time budget in
+# milliseconds. Set it to the hold-up time of your power supply, such as a supercapacitor. The
+# result of each flush is appended to data/power-flush.tsv. The same options are used by the flush
+# of shutdown.sh.
+pwr_options+=("--budget" "500")
+
+# Power off the system after the flush by the power loss.
+#pwr_options+=("--halt")
+
+# ---
+# [PROFILING OPTIONS]
+#
+# Profile the processes to find out why they're using CPU or memory in the field. "cpu" samples
+# the stacks of the threads and "memory" traces the allocations. The profiles are written to
+# data/profile-*.txt every interval seconds and when SIGUSR1 is sent to the process.
+#export IVR_PROFILE="cpu,memory"
+#export IVR_PROFILE_INTERVAL="600"
+
 # ---
 
 IVR_HOME=$(cd $(dirname $0)/.. && pwd)
 
+# Mark the uptime at which the boot phase is reached, to be reported by the recorder (see boot.py).
+boot_mark() {
+  echo "$(cat /proc/sys/kernel/random/boot_id) $1 $(cut -d ' ' -f 1 /proc/uptime)" >> "$IVR_HOME/tmp/boot.txt"
+}
+boot_mark startup
+
 # Mount the data directory if it's not already mounted.
 DIR_MOUNTPOINT=`readlink $IVR_HOME/data`
 if [ ! -z "$DIR_MOUNTPOINT" ]
@@ -116,6 +255,34 @@ then
   fi
 fi
 
+boot_mark mounted
+
+# Remove the partial files left by the conversions interrupted by the last shutdown. They are also
+# the locks of the conversions, so they are removed only here, before any process starts. The jobs
+# remain in their queues and are executed again.
+rm -f "$IVR_HOME"/data/footage-*.part
+
+# List the files left by the last shutdown before the recorder starts, so that verify.py tells them
+# from the footage recorded in this boot regardless of the system clock.
+{ cat /proc/sys/kernel/random/boot_id; ls "$IVR_HOME/data"; } > "$IVR_HOME/tmp/boot-files.txt"
+
+# The recorder is started first so that the other processes don't delay the first frame.
+python3 $IVR_HOME/bin/record.py ${rec_options[@]} &
+python3 $IVR_HOME/bin/notify.py &
 python3 $IVR_HOME/bin/gpslog.py ${gps_options[@]} > /dev/null 2>&1 &
 python3 $IVR_HOME/bin/coordinate.py ${crd_options[@]} &
-python3 $IVR_HOME/bin/record.py ${rec_options[@]} &
+python3 $IVR_HOME/bin/event.py ${evt_options[@]} &
+if [ "$srv_enabled" = "1" ]
+then
+  python3 $IVR_HOME/bin/server.py ${srv_options[@]} &
+fi
+echo "${pwr_options[@]}" > "$IVR_HOME/tmp/power-options.txt"
+python3 $IVR_HOME/bin/power.py ${pwr_options[@]} &
+
+# Repair the footage broken by the last power cut, at low priority not to disturb the recording.
+# The footage recorded since the boot is skipped, since the recorder may be writing it.
+python3 $IVR_HOME/bin/verify.py &
+if [ ${#upl_options[@]} -ne 0 ]
+then
+  python3 $IVR_HOME/bin/upload.py ${upl_options[@]} &
+fi
@@ -0,0 +1,78 @@
+import datetime
+import threading
+
+import ivr
+
+# Extension of the subtitle file that accompanies the footage file.
+SUBTITLE_FILE_EXT = "vtt"
+
+# Interval at which the telop file is sampled.
+SAMPLING_INTERVAL_SECONDS = 1
+
+
+# Format the specified number of seconds from the beginning of the footage as WebVTT timestamp.
+def vtt_timestamp(seconds):
+    ms = int(round(max(0.0, seconds) * 1000))
+    h, ms = divmod(ms, 60 * 60 * 1000)
+    m, ms = divmod(ms, 60 * 1000)
+    s, ms = divmod(ms, 1000)
+    return "{:02d}:{:02d}:{:02d}.{:03d}".format(h, m, s, ms)
+
+
+# Read the current text of the telop. Returns None if it cannot be read.
+def read_telop(file):
+    try:
+        with open(file, mode="r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+# A thread that writes the telop as WebVTT cues to the sidecar file of the footage being recorded.
+# The players render the telop on demand, so that FFmpeg doesn't need to draw it on every frame.
+class SubtitleWriter(threading.Thread):
+    def __init__(self, telop_file, footage_file, start):
+        super().__init__(daemon=True)
+        self.telop_file = telop_file
+        self.file = ivr.footage_sidecar_file(footage_file, SUBTITLE_FILE_EXT)
+        self.start_time = start
+        self.stopped = threading.Event()
+
+    def run(self):
+        cue_text = None
+        cue_begin = 0.0
+        with open(self.file, mode="w") as f:
+            f.write("WEBVTT\n\n")
+            f.flush()
+            while True:
+                stopped = self.stopped.wait(SAMPLING_INTERVAL_SECONDS)
+                now = datetime.datetime.now()
+                elapsed = (now - self.start_time).total_seconds()
+                text = read_telop(self.telop_file)
+                if text is None:
+                    text = cue_text
+
+                # the cue is written when the text changes, so the same text continues to be a cue
+                if stopped or text != cue_text:
+                    if (
+                        cue_text is not None
+                        and len(cue_text) != 0
+                        and elapsed > cue_begin
+                    ):
+                        f.write(
+                            "{} --> {}\n{}\n\n".format(
+                                vtt_timestamp(cue_begin),
+                                vtt_timestamp(elapsed),
+                                cue_text,
+                            )
+                        )
+                        f.flush()
+                    cue_text = text
+                    cue_begin = elapsed
+                if stopped:
+                    break
+
+    # Write the last cue and stop the thread.
+    def stop(self):
+        self.stopped.set()
+        self.join(5)
@@ -0,0 +1,167 @@
+import collections
+import math
+import os
+import re
+import struct
+import time
+
+import ivr
+
+# Extension of the telemetry file that accompanies the footage file.
+TELEMETRY_FILE_EXT = "tlm"
+
+# The telemetry file consists of this magic number (including version) and fixed-length records.
+MAGIC = b"IVRT\x01\x00\x00\x00"
+
+# segment-relative PTS [sec], wall-clock time [epoch sec], latitude, longitude, altitude [m],
+# speed [m/s], heading [deg], and flags of clock-trust state.
+# Missing values are NaN.
+RECORD = struct.Struct("<ddddfffB3x")
+
+TelemetryRecord = collections.namedtuple(
+    "TelemetryRecord", ["pts", "time", "lat", "lon", "alt", "speed", "heading", "flags"]
+)
+
+FLAG_LOCALTIME_TRUSTED = 0x01  # the system clock is synchronized with NTP or RTC
+FLAG_GPS_TIME = 0x02  # the wall-clock time was given by GPS
+
+# Number of records or seconds to be buffered before being appended to the file.
+FLUSH_RECORDS = 6
+FLUSH_SECONDS = 30
+
+
+# Refer to the footage file currently being recorded and the time it started, as written by the
+# recorder. Returns None if no recording is in progress. The camera is the name of the secondary
+# camera, or None for the primary camera.
+def current_segment(camera=None):
+    try:
+        with open(ivr.segment_file(camera), mode="r") as f:
+            lines = f.read().splitlines()
+        return (lines[0], float(lines[1]))
+    except (FileNotFoundError, IndexError, ValueError):
+        return None
+
+
+# Write the footage file being recorded and the time it started, to be referred by other processes.
+def save_segment(footage_file, start, profile=None, camera=None):
+    text = "{}\n{}".format(footage_file, start.timestamp())
+    if profile is not None:
+        text += "\n{}".format(profile)
+    ivr.write(ivr.segment_file(camera), text)
+
+
+# Refer to the recording profile of the footage file being recorded, such as "full" or "parked".
+# Returns None if it's not being recorded.
+def current_profile():
+    try:
+        with open(ivr.segment_file(), mode="r") as f:
+            lines = f.read().splitlines()
+        return lines[2]
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+# Clear the footage file being recorded.
+def remove_segment(camera=None):
+    file = ivr.segment_file(camera)
+    if os.path.isfile(file):
+        os.remove(file)
+
+
+# Refer to the names of the footage files being recorded by all cameras.
+def recording_files():
+    files = set()
+    for f in os.listdir(ivr.temp_dir()):
+        m = re.fullmatch(r"segment(?:-([a-zA-Z0-9]+))?\.txt", f)
+        if m is not None:
+            segment = current_segment(m.group(1))
+            if segment is not None:
+                files.add(os.path.basename(segment[0]))
+    return files
+
+
+def parse_float(x):
+    return math.nan if x is None or x == "n/a" else float(x)
+
+
+# Appends a record per GPS fix to the telemetry file of the footage currently being recorded.
+# The records are buffered and written together to reduce the number of writes to the storage.
+class TelemetryWriter:
+    def __init__(self):
+        self.segment = None
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    # Add the GPS fix (see gpsfix.py) obtained at the specified local time.
+    def add(self, now, fix, localtime_trusted):
+        segment = current_segment()
+        if segment != self.segment:
+            self.flush()
+            self.segment = segment
+        if segment is None:
+            return
+
+        flags = FLAG_LOCALTIME_TRUSTED if localtime_trusted else 0
+        if fix.time is not None:
+            tm = fix.time.timestamp()
+            flags |= FLAG_GPS_TIME
+        else:
+            tm = now.timestamp()
+        record = RECORD.pack(
+            now.timestamp() - segment[1],
+            tm,
+            parse_float(fix.lat),
+            parse_float(fix.lon),
+            parse_float(fix.alt),
+            parse_float(fix.speed),
+            parse_float(fix.track),
+            flags,
+        )
+        self.buffer.append(record)
+
+        elapsed = time.monotonic() - self.last_flush
+        if len(self.buffer) >= FLUSH_RECORDS or elapsed >= FLUSH_SECONDS:
+            self.flush()
+
+    # Append the buffered records to the telemetry file.
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.segment is None or len(self.buffer) == 0:
+            self.buffer = []
+            return
+        footage = self.segment[0]
+        if not os.path.isfile(footage):
+            # the footage has already been removed
+            self.buffer = []
+            return
+        file = ivr.footage_sidecar_file(footage, TELEMETRY_FILE_EXT)
+        with open(file, mode="ab") as f:
+            if f.tell() == 0:
+                f.write(MAGIC)
+            f.write(b"".join(self.buffer))
+        self.buffer = []
+
+
+# Read all records from the specified telemetry file, in order of PTS.
+# An incomplete record at the end of file, such as by power failure, is ignored.
+def load(file):
+    with open(file, mode="rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("not a telemetry file: {}".format(file))
+    length = (len(data) - len(MAGIC)) // RECORD.size * RECORD.size
+    body = memoryview(data)[len(MAGIC) : len(MAGIC) + length]
+    return [TelemetryRecord._make(r) for r in RECORD.iter_unpack(body)]
+
+
+# Refer to the latest record at or before the specified PTS. Returns None if there is no such
+# record.
+def lookup(records, pts):
+    lo, hi = 0, len(records)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if records[mid].pts <= pts:
+            lo = mid + 1
+        else:
+            hi = mid
+    return records[lo - 1] if lo > 0 else None
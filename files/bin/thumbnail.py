@@ -0,0 +1,209 @@
+#
+# Thumbnail index of the closed footage files, to browse a day at a glance without decoding video.
+# For each footage file, a keyframe is taken every interval seconds and packed into a contact sheet
+# (footage-*.jpg) with an index of their offsets (footage-*.thm). Both share the base name with the
+# footage, so they are removed together by ensure_storage_space().
+#
+# The index is JSON such as:
+#   {"start": 1643724000.0, "interval": 60, "width": 160, "height": 90, "columns": 10,
+#    "offsets": [0.0, 60.0, 120.0, ...]}
+# where the i-th thumbnail is at (i % columns * width, i // columns * height) in the sheet and shows
+# the footage at start + offsets[i] in epoch seconds.
+#
+import json
+import math
+import os
+import re
+import signal
+import threading
+
+import avi
+import ivr
+import pressure
+import remux
+import retention
+
+# Extensions of the contact sheet and the index.
+SHEET_FILE_EXT = "jpg"
+INDEX_FILE_EXT = "thm"
+
+# Width of each thumbnail. The height follows the aspect ratio of the footage.
+THUMBNAIL_WIDTH = 160
+
+# Number of thumbnails in a row of the contact sheet.
+THUMBNAIL_COLUMNS = 10
+
+# Quality of the contact sheet in JPEG qscale, from 2 (best) to 31 (worst).
+SHEET_QUALITY = 5
+
+# Number of failures after which the footage file is no longer indexed.
+MAX_FAILURES = 3
+
+# Frames that passed the showinfo filter, and the duration of the input in the log of FFmpeg.
+SHOWINFO_PATTERN = re.compile(r"\[Parsed_showinfo.*\bpts_time:(\S+).*\bs:(\d+)x(\d+)")
+DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+# Refer to the contact sheet file being written for the footage file. It's hidden and doesn't
+# match the footage file pattern, so that an interrupted one isn't counted as a footage.
+def temporary_sheet_file(footage):
+    dir = os.path.dirname(footage)
+    sheet = ivr.footage_sidecar_file(os.path.basename(footage), SHEET_FILE_EXT)
+    return os.path.join(dir, "." + sheet)
+
+
+# Remove the contact sheets left by the jobs interrupted by the last shutdown.
+def remove_temporary_sheets(dir):
+    for f in os.listdir(dir):
+        if f.startswith(".") and re.fullmatch(ivr.FOOTAGE_FILE_PATTERN, f[1:]):
+            if ivr.file_extension(f) == "." + SHEET_FILE_EXT:
+                os.remove(os.path.join(dir, f))
+
+
+# Estimate the number of seconds of the footage file to lay out the contact sheet. The AVI index
+# is exact. For the other containers, it's estimated from the name and the last modified time,
+# with a margin since a footage file can be longer than an hour.
+def estimate_duration(file):
+    if ivr.file_extension(file) == ".avi":
+        index = avi.Index(file)
+        if index.update() and index.frames != 0:
+            return index.duration()
+    return retention.footage_duration(file, os.stat(file).st_mtime) + 60
+
+
+# An indexer that makes the thumbnails of the closed footage files one at a time in the background,
+# decoding only the keyframes at the lowest CPU and idle I/O priority.
+class ThumbnailIndexer:
+    def __init__(self, dir, interval):
+        self.dir = dir
+        self.interval = interval
+        self.failures = {}
+        self.thread = None
+        self.process = None
+        self.stopped = False
+        remove_temporary_sheets(dir)
+
+    # Start to index the newest closed footage file that hasn't been indexed yet.
+    def update(self):
+        if self.stopped or (self.thread is not None and self.thread.is_alive()):
+            return
+        for f in remux.closed_footage_files(self.dir, (".avi", ".mp4")):
+            index = ivr.footage_sidecar_file(f, INDEX_FILE_EXT)
+            if os.path.isfile(os.path.join(self.dir, index)):
+                continue
+            if self.failures.get(f, 0) >= MAX_FAILURES:
+                continue
+            self.thread = threading.Thread(target=self.index, args=(f,), daemon=True)
+            self.thread.start()
+            return
+
+    # Terminate the running job. It isn't counted as a failure, and is executed again on the next
+    # start.
+    def stop(self):
+        self.stopped = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGCONT)
+            self.process.terminate()
+
+    def set_process(self, proc):
+        self.process = proc
+        if self.stopped:
+            proc.terminate()
+
+    def index(self, name):
+        try:
+            if not self.make_thumbnails(name) and not self.stopped:
+                self.failures[name] = self.failures.get(name, 0) + 1
+        except Exception as e:
+            ivr.log("ERROR: failed to make the thumbnails of {}: {}".format(name, e))
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    # Make the contact sheet and the index of the footage file. Returns False if it fails.
+    def make_thumbnails(self, name):
+        src = os.path.join(self.dir, name)
+        temp = temporary_sheet_file(src)
+        sheet = ivr.footage_sidecar_file(src, SHEET_FILE_EXT)
+        index_file = ivr.footage_sidecar_file(src, INDEX_FILE_EXT)
+        try:
+            # the modification time is kept by the remux and the retention
+            stat = os.stat(src)
+        except FileNotFoundError:
+            return True
+        estimated = estimate_duration(src)
+        count = int(estimated // self.interval) + 1
+        rows = max(1, math.ceil(count / THUMBNAIL_COLUMNS))
+
+        # the first keyframe and then the first keyframe at least interval seconds after the last
+        select = "select='isnan(prev_selected_t)+gte(t-prev_selected_t,{})'".format(
+            self.interval
+        )
+        filters = [
+            select,
+            "scale={}:-2".format(THUMBNAIL_WIDTH),
+            "showinfo",
+            "tile={}x{}".format(THUMBNAIL_COLUMNS, rows),
+        ]
+        command = ["ffmpeg", "-y", "-nostdin", "-hide_banner", "-nostats"]
+        command.extend(["-loglevel", "info", "-skip_frame", "nokey", "-i", src])
+        command.extend(["-map", "0:v:0", "-an", "-vf", ",".join(filters)])
+        command.extend(["-frames:v", "1", "-q:v", str(SHEET_QUALITY)])
+        command.extend(["-f", "image2", temp])
+        returncode, stderr = pressure.run_low_priority(
+            command,
+            "making thumbnails of {}".format(name),
+            on_start=self.set_process,
+        )
+        self.process = None
+
+        try:
+            frames = SHOWINFO_PATTERN.findall(stderr)
+            if returncode != 0 and self.stopped:
+                # terminated by stop()
+                return False
+            if returncode != 0 or len(frames) == 0:
+                error = stderr.strip().splitlines()[-1:] or ["no keyframe"]
+                ivr.log(
+                    "ERROR: failed to make the thumbnails of {}: {}".format(
+                        name, error[0]
+                    )
+                )
+                return False
+            m = DURATION_PATTERN.search(stderr)
+            if m is not None:
+                duration = (
+                    int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+                )
+            else:
+                duration = estimated
+            _, width, height = frames[0]
+            index = {
+                "start": stat.st_mtime - duration,
+                "interval": self.interval,
+                "width": int(width),
+                "height": int(height),
+                "columns": THUMBNAIL_COLUMNS,
+                "offsets": [
+                    round(float(t), 3) for t, _, _ in frames[: THUMBNAIL_COLUMNS * rows]
+                ],
+            }
+            os.rename(temp, sheet)
+            ivr.write(index_file, json.dumps(index))
+        finally:
+            if os.path.isfile(temp):
+                os.remove(temp)
+
+        # the footage may have been removed by ensure_storage_space() while indexing
+        stem = os.path.splitext(src)[0]
+        if not any([os.path.isfile("{}.{}".format(stem, x)) for x in ["avi", "mp4"]]):
+            for file in [sheet, index_file]:
+                if os.path.isfile(file):
+                    os.remove(file)
+            return True
+        ivr.log(
+            "thumbnails made: {} ({} thumbnails, {}B)".format(
+                sheet,
+                len(index["offsets"]),
+                ivr.with_aux_unit(os.path.getsize(sheet)),
+            )
+        )
+        return True
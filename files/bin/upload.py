@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+#
+# Offload the footage, event clip, tracklog and log files to a collection server over HTTP, such
+# as when the vehicle returns to a depot with Wi-Fi. Each file is uploaded in chunks with a
+# checksum, and the upload is resumed from the offset that the server has received. Uploaded files
+# are recorded in a manifest so that the coordinator can delete them first.
+#
+# The protocol is as follows, where the path is the URL followed by the device ID and file name:
+#   HEAD: the server returns the number of bytes it has received in the Upload-Offset header, or
+#         404 if it has nothing.
+#   PUT:  the client sends the chunk with Content-Range and X-Checksum-Sha256 headers. The server
+#         returns Upload-Offset after appending it, or 409 with Upload-Offset if the range doesn't
+#         start at the offset.
+#
+# `upload.py --receive DIR` runs a minimal collection server that stores the files in DIR.
+#
+import argparse
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import re
+import signal
+import socket
+import sys
+import time
+import traceback
+import urllib.parse
+
+import ivr
+import profiling
+import telemetry
+
+# Kinds of files to be uploaded, in order of priority.
+UPLOAD_FILE_PATTERNS = [
+    ivr.EVENT_FILE_PATTERN,
+    ivr.FOOTAGE_FILE_PATTERN,
+    ivr.TRACKLOG_FILE_PATTERN,
+    ivr.IVRLOG_FILE_PATTERN,
+]
+
+# Seconds since the last modification after which the file is considered closed.
+CLOSED_SECONDS = 10 * 60
+
+# Interval to look for files to be uploaded, and to retry after a failure.
+SCAN_INTERVAL_SECONDS = 60
+
+# Size of data to be sent at a time while limiting the bandwidth.
+BLOCK_SIZE = 64 * 1024
+
+# Timeout of the connection to the server.
+TIMEOUT_SECONDS = 30
+
+# Extensions of the files written by the background jobs, which aren't uploaded.
+EXCLUDED_FILE_EXTS = [".part"]
+
+
+class UploadException(Exception):
+    pass
+
+
+# Refer to the manifest file that records the files that have been uploaded.
+def manifest_file(dir):
+    return os.path.join(dir, ".upload")
+
+
+# Read the manifest, which maps the names of the uploaded files to their size, modification time
+# and upload time.
+def load_manifest(dir):
+    try:
+        with open(manifest_file(dir), mode="r") as f:
+            return dict(json.load(f))
+    except FileNotFoundError:
+        return {}
+    except (ValueError, TypeError) as e:
+        ivr.log("WARN: the upload manifest is broken and discarded: {}".format(e))
+        return {}
+
+
+def save_manifest(dir, manifest):
+    ivr.write(manifest_file(dir), json.dumps(manifest))
+
+
+# Determine whether the file in the directory is the same as it was uploaded. The file that has been
+# written since the upload isn't, such as the track-log and log files that grow all day. The footage
+# converted by the retention engine keeps its modification time and only shrinks, so it's still
+# regarded as uploaded.
+def is_uploaded(dir, name, manifest):
+    entry = manifest.get(name)
+    if not isinstance(entry, dict):
+        return False
+    try:
+        stat = os.stat(os.path.join(dir, name))
+    except FileNotFoundError:
+        return False
+    if stat.st_size > entry.get("size", 0):
+        return False
+    mtime = entry.get("mtime")
+    return mtime is None or stat.st_mtime <= mtime
+
+
+# Refer to the names of the files in the directory that have been uploaded.
+def uploaded_files(dir):
+    manifest = load_manifest(dir)
+    return set([f for f in manifest if is_uploaded(dir, f, manifest)])
+
+
+# Refer to the closed files that haven't been uploaded yet, in order of priority and then oldest
+# first, since the old footage will be deleted first.
+def pending_files(dir, manifest):
+    recording = [os.path.splitext(f)[0] for f in telemetry.recording_files()]
+    now = time.time()
+    files = []
+    for f in os.listdir(dir):
+        if ivr.file_extension(f) in EXCLUDED_FILE_EXTS or is_uploaded(dir, f, manifest):
+            continue
+        if os.path.splitext(f)[0] in recording:
+            continue
+        for priority, pattern in enumerate(UPLOAD_FILE_PATTERNS):
+            if re.fullmatch(pattern, f):
+                try:
+                    mtime = os.stat(os.path.join(dir, f)).st_mtime
+                except FileNotFoundError:
+                    break
+                if now - mtime >= CLOSED_SECONDS:
+                    files.append((priority, mtime, f))
+                break
+    files.sort()
+    return [f for _, _, f in files]
+
+
+# Limits the average number of bytes per second. No limit if the rate is None.
+class Throttle:
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def consume(self, size):
+        if self.rate is None:
+            return
+        self.sent += size
+        wait = self.sent / self.rate - (time.monotonic() - self.start)
+        if wait > 0:
+            time.sleep(wait)
+
+
+# A client of the collection server.
+class Uploader:
+    def __init__(self, url, device, token=None, chunk_size=1024 * 1024, bandwidth=None):
+        url = urllib.parse.urlsplit(url)
+        if url.scheme not in ["http", "https"]:
+            raise ValueError("unsupported URL: {}".format(url.geturl()))
+        self.url = url
+        self.base = "{}/{}".format(url.path.rstrip("/"), urllib.parse.quote(device))
+        self.token = token
+        self.chunk_size = chunk_size
+        self.bandwidth = bandwidth
+
+    def connect(self):
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(self.url.netloc, timeout=TIMEOUT_SECONDS)
+        return http.client.HTTPConnection(self.url.netloc, timeout=TIMEOUT_SECONDS)
+
+    def headers(self, headers):
+        if self.token is not None:
+            headers["Authorization"] = "Bearer {}".format(self.token)
+        return headers
+
+    # Upload the file, resuming from the offset that the server has received. Returns the stat of
+    # the file when it was opened, which is the part that has been uploaded.
+    def upload(self, file):
+        path = "{}/{}".format(self.base, urllib.parse.quote(os.path.basename(file)))
+        throttle = Throttle(self.bandwidth)
+        conn = self.connect()
+        try:
+            conn.request("HEAD", path, headers=self.headers({}))
+            res = conn.getresponse()
+            res.read()
+            if res.status == 404:
+                offset = 0
+            elif res.status == 200:
+                offset = int(res.getheader("Upload-Offset", "0"))
+            else:
+                raise UploadException("HEAD {} => {}".format(path, res.status))
+
+            # the server corrects the offset by 409 when it differs, such as after a restart
+            conflict = False
+            with open(file, mode="rb") as f:
+                stat = os.fstat(f.fileno())
+                size = stat.st_size
+                while offset < size:
+                    f.seek(offset)
+                    chunk = f.read(self.chunk_size)
+                    headers = {
+                        "Content-Length": str(len(chunk)),
+                        "Content-Range": "bytes {}-{}/{}".format(
+                            offset, offset + len(chunk) - 1, size
+                        ),
+                        "Content-Type": "application/octet-stream",
+                        "X-Checksum-Sha256": hashlib.sha256(chunk).hexdigest(),
+                    }
+                    body = blocks(chunk, throttle)
+                    conn.request("PUT", path, body=body, headers=self.headers(headers))
+                    res = conn.getresponse()
+                    res.read()
+                    if res.status == 409 and conflict:
+                        raise UploadException("PUT {} => conflict again".format(path))
+                    elif res.status not in [200, 201, 204, 409]:
+                        raise UploadException("PUT {} => {}".format(path, res.status))
+                    conflict = res.status == 409
+                    offset = int(res.getheader("Upload-Offset", offset + len(chunk)))
+            return stat
+        finally:
+            conn.close()
+
+
+# Split the chunk into blocks to be sent within the bandwidth.
+def blocks(chunk, throttle):
+    for i in range(0, len(chunk), BLOCK_SIZE):
+        block = chunk[i : i + BLOCK_SIZE]
+        throttle.consume(len(block))
+        yield block
+
+
+# Upload the files in the directory until terminated.
+def start_uploader(dir, uploader):
+    url = uploader.url
+    ivr.log("start uploader: {}://{}{}".format(url.scheme, url.netloc, uploader.base))
+    reachable = True
+    while True:
+        manifest = load_manifest(dir)
+        names = set(os.listdir(dir))
+        manifest = {k: v for k, v in manifest.items() if k in names}
+        for name in pending_files(dir, manifest):
+            file = os.path.join(dir, name)
+            t0 = time.monotonic()
+            try:
+                stat = uploader.upload(file)
+            except FileNotFoundError:
+                continue
+            except (OSError, http.client.HTTPException, UploadException) as e:
+                if reachable:
+                    ivr.log("WARN: failed to upload {}: {}".format(name, e))
+                reachable = False
+                break
+            if not reachable:
+                ivr.log("upload server is available again")
+                reachable = True
+            manifest[name] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "uploaded": time.time(),
+            }
+            save_manifest(dir, manifest)
+            ivr.log(
+                "file uploaded: {} ({}B, {:.1f} sec)".format(
+                    name, ivr.with_aux_unit(stat.st_size), time.monotonic() - t0
+                )
+            )
+        time.sleep(SCAN_INTERVAL_SECONDS)
+
+
+# A request handler of the minimal collection server. The directory is set by start_receiver().
+class ReceiverRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    dir = None
+
+    # Refer to the file of the request path as /<any>/<device>/<name>. Returns None if it isn't a
+    # safe file name.
+    def target_file(self):
+        parts = urllib.parse.unquote(self.path.split("?", 1)[0]).split("/")
+        if len(parts) < 3:
+            return None
+        device, name = parts[-2:]
+        for part in [device, name]:
+            if not re.fullmatch(r"[A-Za-z0-9_\-][A-Za-z0-9_\-.]*", part):
+                return None
+        return os.path.join(self.dir, device, name)
+
+    def send_offset(self, status, offset):
+        self.send_response(status)
+        self.send_header("Upload-Offset", str(offset))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        file = self.target_file()
+        if file is None:
+            self.send_error(400)
+        elif os.path.isfile(file):
+            self.send_offset(200, os.path.getsize(file))
+        elif os.path.isfile(file + ".part"):
+            self.send_offset(200, os.path.getsize(file + ".part"))
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        file = self.target_file()
+        m = re.fullmatch(
+            r"bytes (\d+)-(\d+)/(\d+)", self.headers.get("Content-Range", "")
+        )
+        length = int(self.headers.get("Content-Length", "0"))
+        chunk = self.rfile.read(length)
+        if file is None or m is None:
+            self.send_error(400)
+            return
+        first, last, size = [int(x) for x in m.groups()]
+        if os.path.isfile(file):
+            self.send_offset(409, os.path.getsize(file))
+            return
+        part = file + ".part"
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        if first != offset or last - first + 1 != len(chunk):
+            self.send_offset(409, offset)
+            return
+        if hashlib.sha256(chunk).hexdigest() != self.headers.get("X-Checksum-Sha256"):
+            self.send_error(400, "checksum mismatch")
+            return
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(part, mode="ab") as f:
+            f.write(chunk)
+        offset += len(chunk)
+        if offset >= size:
+            os.rename(part, file)
+        self.send_offset(204, offset)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Receive the uploaded files into the directory until terminated.
+def start_receiver(dir, port):
+    ReceiverRequestHandler.dir = dir
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), ReceiverRequestHandler)
+    ivr.log("start upload receiver: {} on port {}".format(dir, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Upload the recorded files to a collection server"
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory where the footage and other files are stored (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-u",
+        "--url",
+        metavar="URL",
+        help="URL of the collection server, such as http://depot.local:8000/ivr",
+    )
+    parser.add_argument(
+        "-id",
+        "--device-id",
+        metavar="ID",
+        default=socket.gethostname(),
+        help="ID of this device on the server (default: host name)",
+    )
+    parser.add_argument(
+        "-t",
+        "--token",
+        metavar="TOKEN",
+        help="Bearer token to authenticate to the server",
+    )
+    parser.add_argument(
+        "-bw",
+        "--bandwidth",
+        metavar="BYTES",
+        help="Maximum upload bytes per second, such as 500k, 2M (default: unlimited)",
+    )
+    parser.add_argument(
+        "-cs",
+        "--chunk-size",
+        metavar="BYTES",
+        default="1M",
+        help="Size of each chunk to be uploaded (default: 1M)",
+    )
+    parser.add_argument(
+        "-r",
+        "--receive",
+        metavar="DIR",
+        help="Run as a minimal collection server that stores the files in DIR",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        metavar="PORT",
+        type=int,
+        default=8000,
+        help="Port of the collection server with --receive (default: 8000)",
+    )
+
+    args = parser.parse_args()
+    if args.receive is None and args.url is None:
+        parser.error("--url is required to upload files")
+
+    try:
+        ivr.save_pid()
+        profiling.start()
+
+        # register SIGTERM handler
+        signal.signal(signal.SIGTERM, ivr.term_handler)
+        signal.signal(signal.SIGINT, ivr.term_handler)
+
+        if args.receive is not None:
+            start_receiver(args.receive, args.port)
+        else:
+            bandwidth = None
+            if args.bandwidth is not None:
+                bandwidth = ivr.without_aux_unit(args.bandwidth)
+            uploader = Uploader(
+                args.url,
+                args.device_id,
+                args.token,
+                int(ivr.without_aux_unit(args.chunk_size)),
+                bandwidth,
+            )
+            ivr.lower_priority()
+            start_uploader(args.dir, uploader)
+
+    except ivr.TermException as e:
+        ivr.log("IVR terminates the uploader")
+    except Exception as e:
+        t = "".join(list(traceback.TracebackException.from_exception(e).format()))
+        ivr.log("ERROR: {}".format(t))
+        ivr.log("IVR terminates the uploader by an error")
+        ivr.beep("uploader has stopped due to an error")
+        sys.exit(1)
+    finally:
+        ivr.remove_pid()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+# Verify the RIFF/AVI structure of the footage files, and repair the ones broken by a power cut.
+# FFmpeg writes the sizes of the RIFF and movi chunks and the idx1 index when it closes the file, so
+# the last footage before a power cut has none of them and may end with a truncated chunk, which
+# some players can't seek. Such a file is truncated to the last complete chunk, and the idx1 index
+# is rebuilt by scanning the chunk headers, without loading the file into memory.
+#
+# The files are verified in parallel processes at low priority. The result is cached in
+# data/.verify by the size and the modification time of each file, so unchanged files are skipped.
+#
+#   $ verify.py            # verify and repair, run by startup.sh at boot
+#   $ verify.py --check    # verify only
+#
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import struct
+import sys
+import time
+
+import avi
+import boot
+import ivr
+import remux
+import telemetry
+
+# Results of the verification:
+#   repaired:  truncated to the last complete chunk, and the idx1 index has been rebuilt
+#   truncated: the last extended RIFF (AVIX) has been truncated to the last complete chunk
+#   broken:    the structure can't be repaired
+#   damaged:   the structure is broken but hasn't been repaired, such as by --check
+STATUS_OK = "ok"
+STATUS_REPAIRED = "repaired"
+STATUS_TRUNCATED = "truncated"
+STATUS_BROKEN = "broken"
+STATUS_DAMAGED = "damaged"
+
+# Number of index entries written at once while rebuilding the idx1 index.
+INDEX_BATCH_SIZE = 4096
+
+# Offsets of the total number of frames in avih, and the length in strh.
+AVIH_TOTAL_FRAMES = 16
+STRH_LENGTH = 32
+
+
+# Refer to the file that caches the results of the verification.
+def cache_file(dir):
+    return os.path.join(dir, ".verify")
+
+
+def load_cache(dir):
+    try:
+        with open(cache_file(dir), mode="r") as f:
+            return dict(json.load(f))
+    except FileNotFoundError:
+        return {}
+    except (ValueError, TypeError) as e:
+        ivr.log("WARN: the verification cache is broken and discarded: {}".format(e))
+        return {}
+
+
+# Returns True if the chunk can appear in the movi list.
+def is_movi_chunk(fourcc):
+    return avi.is_stream_chunk(fourcc) or fourcc[:2] == b"ix" or fourcc == b"JUNK"
+
+
+# Read the top-level RIFF chunks of the file as a list of (offset, length, form, movi, idx1), where
+# movi and idx1 are the offsets of those chunks or None. The length is as declared, which is 0 or
+# beyond the end of the file if FFmpeg didn't close it.
+def read_riffs(f, size):
+    riffs = []
+    position = 0
+    while position + 12 <= size:
+        f.seek(position)
+        head = f.read(12)
+        fourcc, length = avi.CHUNK_HEADER.unpack_from(head)
+        if fourcc != b"RIFF" or head[8:] not in (b"AVI ", b"AVIX"):
+            break
+        movi = idx1 = None
+        end = min(size, position + 8 + length) if length != 0 else size
+        child = position + 12
+        while child + 12 <= end:
+            f.seek(child)
+            sub = f.read(12)
+            sub_fourcc, sub_length = avi.CHUNK_HEADER.unpack_from(sub)
+            if sub_fourcc == b"LIST" and sub[8:] == b"movi":
+                movi = child
+                if sub_length == 0:
+                    break  # the following chunks can't be located
+            elif sub_fourcc == b"idx1":
+                idx1 = child
+            child += 8 + sub_length + (sub_length & 1)
+        riffs.append((position, length, head[8:], movi, idx1))
+        if length == 0:
+            break
+        position += 8 + length + (length & 1)
+    return riffs
+
+
+# Returns True if the RIFF chunks cover the whole file, and the first one has the idx1 index.
+def is_complete(riffs, size):
+    if len(riffs) == 0 or riffs[0][4] is None:
+        return False
+    end = 0
+    for offset, length, _, movi, _ in riffs:
+        if length == 0 or movi is None or offset + 8 + length > size:
+            return False
+        end = offset + 8 + length + (length & 1)
+    return end == size or end == size + 1
+
+
+# Scan the chunks in the movi list from the position, and refer to the end of the last complete
+# chunk. Only the chunk headers are read.
+def end_of_complete_chunks(f, position, size):
+    while position + 8 <= size:
+        f.seek(position)
+        head = f.read(12)
+        fourcc, length = avi.CHUNK_HEADER.unpack_from(head)
+        if fourcc == b"LIST" and head[8:] == b"rec ":
+            position += 12  # step into the rec list
+            continue
+        end = position + 8 + length + (length & 1)
+        if not is_movi_chunk(fourcc) or end > size:
+            break
+        position = end
+    return position
+
+
+# Write the idx1 index of the chunks in the movi list at the end of the file, in batches. Returns
+# the number of video frames.
+def write_legacy_index(f, index, movi, end):
+    f.seek(end)
+    f.write(avi.CHUNK_HEADER.pack(b"idx1", 0))
+    frames = 0
+    count = 0
+    entries = []
+    position = movi + 12
+    while position < end:
+        f.seek(position)
+        head = f.read(8 + avi.PEEK_SIZE)
+        fourcc, length = avi.CHUNK_HEADER.unpack_from(head)
+        if fourcc == b"LIST":
+            position += 12
+            continue
+        if avi.is_stream_chunk(fourcc):
+            flags = avi.AVIIF_KEYFRAME
+            if fourcc[:2] == index.video and fourcc[2:] in (b"dc", b"db"):
+                data = head[8 : 8 + length]
+                if not index.all_keyframes and not avi.is_h264_keyframe(data):
+                    flags = 0
+                frames += 1
+            # the offset is relative to the "movi" of the list, as FFmpeg writes
+            entries.append(
+                avi.INDEX_ENTRY.pack(fourcc, flags, position - (movi + 8), length)
+            )
+        position += 8 + length + (length & 1)
+        if len(entries) >= INDEX_BATCH_SIZE:
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(entries))
+            count += len(entries)
+            entries = []
+    f.seek(0, os.SEEK_END)
+    f.write(b"".join(entries))
+    count += len(entries)
+    f.seek(end + 4)
+    f.write(struct.pack("<I", count * avi.INDEX_ENTRY.size))
+    return frames
+
+
+# Update the number of frames in the main header and the header of the video stream.
+def write_frame_count(f, index, frames):
+    avih = index.header.find(b"avih")
+    if avih >= 0:
+        f.seek(avih + 8 + AVIH_TOTAL_FRAMES)
+        f.write(struct.pack("<I", frames))
+    streams = [m.start() for m in re.finditer(b"strh", index.header)]
+    video = int(index.video)
+    if video < len(streams):
+        f.seek(streams[video] + 8 + STRH_LENGTH)
+        f.write(struct.pack("<I", frames))
+
+
+# Truncate the broken footage file to the last complete chunk, and make its structure valid. The
+# modification time is kept so that the order of deletion doesn't change. Returns the status.
+def repair(file, riffs, size):
+    index = avi.Index(file)
+    with open(file, mode="r+b") as f:
+        if not index.read_header(f):
+            return STATUS_BROKEN
+
+        # drop the extended RIFF whose movi list hasn't been written
+        while len(riffs) > 1 and riffs[-1][3] is None:
+            riffs.pop()
+        offset, _, form, movi, _ = riffs[-1]
+        if movi is None:
+            return STATUS_BROKEN
+        end = end_of_complete_chunks(f, movi + 12, size)
+        f.truncate(end)
+
+        f.seek(movi + 4)
+        f.write(struct.pack("<I", end - (movi + 8)))
+        if form == b"AVI ":
+            frames = write_legacy_index(f, index, movi, end)
+            write_frame_count(f, index, frames)
+            status = STATUS_REPAIRED
+        else:
+            status = STATUS_TRUNCATED
+        riff_end = f.seek(0, os.SEEK_END)
+        f.seek(offset + 4)
+        f.write(struct.pack("<I", riff_end - (offset + 8)))
+    return status
+
+
+# Verify the footage file, and repair it unless check_only. Returns the name, the status, the
+# sizes before and after, and the modification time.
+def verify(file, check_only):
+    stat = os.stat(file)
+    size = stat.st_size
+    with open(file, mode="rb") as f:
+        riffs = read_riffs(f, size)
+    if is_complete(riffs, size):
+        return (os.path.basename(file), STATUS_OK, size, size, stat.st_mtime)
+    if check_only:
+        return (os.path.basename(file), STATUS_DAMAGED, size, size, stat.st_mtime)
+
+    # the remux and the retention don't convert the file while it's locked
+    part = ivr.footage_sidecar_file(file, remux.PARTIAL_FILE_EXT)
+    if not remux.lock_partial_file(part):
+        return (os.path.basename(file), STATUS_DAMAGED, size, size, stat.st_mtime)
+    try:
+        status = repair(file, riffs, size)
+        os.utime(file, (stat.st_atime, stat.st_mtime))
+    finally:
+        os.remove(part)
+    return (os.path.basename(file), status, size, os.path.getsize(file), stat.st_mtime)
+
+
+# Refer to the file in which startup.sh lists the files in the data directory before starting the
+# recorder, following the identifier of the boot.
+def boot_files_file():
+    return os.path.join(ivr.temp_dir(), "boot-files.txt")
+
+
+# Refer to the names of the files that existed before the recorder was started in the current boot,
+# or None if they aren't listed. The recorder writes its segment file only after FFmpeg has created
+# the footage, and the system clock is often wrong at boot without RTC, so the footage recorded in
+# this boot is told from the one left by the last power cut by the list, not by the modification
+# time.
+def boot_files():
+    try:
+        with open(boot_files_file(), mode="r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    if len(lines) == 0 or lines[0] != boot.boot_id():
+        return None
+    return set(lines[1:])
+
+
+# Verify the footage files in the directory in parallel, except for the ones being recorded and
+# the ones unchanged since the last verification. Returns the results.
+def verify_all(dir, workers, check_only=False):
+    cache = load_cache(dir)
+    recording = telemetry.recording_files()
+    existing = boot_files()
+    files = []
+    for f in os.listdir(dir):
+        if not re.fullmatch(ivr.FOOTAGE_FILE_PATTERN, f) or f in recording:
+            continue
+        if ivr.file_extension(f) != ".avi":
+            continue
+        if existing is not None and f not in existing:
+            # recorded in the current boot
+            continue
+        try:
+            stat = os.stat(os.path.join(dir, f))
+        except FileNotFoundError:
+            continue
+        cached = cache.get(f)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime]:
+            continue
+        files.append(os.path.join(dir, f))
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(verify, file, check_only): file for file in files}
+        for future in concurrent.futures.as_completed(futures):
+            file = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                ivr.log("ERROR: failed to verify {}: {}".format(file, e))
+                continue
+            name, status, before, after, mtime = result
+            results.append(result)
+            if status != STATUS_DAMAGED:
+                cache[name] = [after, mtime, status]
+            if status not in (STATUS_OK, STATUS_DAMAGED):
+                ivr.log(
+                    "footage {}: {} ({}B -> {}B)".format(
+                        status,
+                        file,
+                        ivr.with_aux_unit(before),
+                        ivr.with_aux_unit(after),
+                    )
+                )
+            elif status == STATUS_DAMAGED:
+                ivr.log("WARN: footage damaged: {}".format(file))
+
+    # forget the files that have been removed
+    names = set(os.listdir(dir))
+    cache = {name: value for name, value in cache.items() if name in names}
+    ivr.write(cache_file(dir), json.dumps(cache))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify the footage files and repair the ones broken by a power cut"
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        metavar="DIR",
+        default=ivr.data_dir(),
+        help="Directory where the footage files are stored (default: {})".format(
+            ivr.data_dir()
+        ),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="NUM",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes to verify the files (default: {})".format(
+            os.cpu_count()
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--check",
+        action="store_true",
+        help="Only verify the files without repairing them",
+    )
+    args = parser.parse_args()
+
+    # the worker processes inherit the priorities
+    ivr.lower_priority()
+    t0 = time.monotonic()
+    results = verify_all(args.dir, args.workers, args.check)
+    counts = {}
+    for _, status, _, _, _ in results:
+        counts[status] = counts.get(status, 0) + 1
+    summary = ", ".join(["{} {}".format(n, s) for s, n in sorted(counts.items())])
+    ivr.log(
+        "footage verified in {:.1f} sec: {}".format(
+            time.monotonic() - t0, summary or "no files to verify"
+        )
+    )
+    print("{} files verified: {}".format(len(results), summary or "none"))
+    sys.exit(1 if counts.get(STATUS_BROKEN, 0) + counts.get(STATUS_DAMAGED, 0) else 0)